@@ -0,0 +1,253 @@
+"""Benchmarks for the chart processing pipeline on synthetic charts.
+
+Usage:
+    python benchmarks.py streaming [--size-mb 500]
+    python benchmarks.py mini-batch [--num-series 20000] [--num-points 240]
+        [--batch-size 1024]
+    python benchmarks.py dtw [--charts 002,100,101,102]
+    python benchmarks.py frequency [--num-series 10000] [--num-labels 2000]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+import numpy as np
+
+def write_synthetic_chart(path, num_series, num_points, seed=0):
+    """Writes a synthetic chart in the Cloud Monitoring json format one
+    time series at a time, so that large charts can be generated without
+    holding them in memory.
+
+    Args:
+        path: The path of the file that is written.
+        num_series: The number of time series.
+        num_points: The number of points of each time series.
+        seed: The seed for the random values.
+    """
+    rng = np.random.RandomState(seed)
+    dates = ["2020-06-26T%02d:%02d:%02dZ" % (i // 3600 % 24, i // 60 % 60,
+                                            i % 60)
+             for i in range(num_points - 1, -1, -1)]
+    with open(path, "w") as json_file:
+        json_file.write('{"timeSeries": [')
+        for index in range(num_series):
+            values = rng.normal(index % 10, 1, num_points)
+            time_series = {
+                "metric": {"labels": {"instance_name": "instance-%d" % index}},
+                "resource": {"type": "gce_instance", "labels": {
+                    "instance_id": str(index),
+                    "zone": "us-central1-%s" % "abcf"[index % 4],
+                    "project_id": "project"}},
+                "points": [{"interval": {"startTime": date, "endTime": date},
+                            "value": {"doubleValue": value}}
+                           for date, value in zip(dates, values.tolist())]}
+            if index:
+                json_file.write(", ")
+            json.dump(time_series, json_file)
+        json_file.write("]}")
+
+def synthetic_series(num_series, num_points, num_groups=50, seed=0):
+    """Returns an array of num_series noisy time series drawn around
+    num_groups random shapes, scaled to [0, 10] like the charts."""
+    rng = np.random.RandomState(seed)
+    shapes = rng.uniform(0, 10, (num_groups, num_points))
+    groups = rng.randint(num_groups, size=num_series)
+    data = shapes[groups] + rng.normal(0, 0.5, (num_series, num_points))
+    return np.clip(data, 0, 10)
+
+def inertia(data, labels):
+    """Returns the sum of squared distances of the rows of data to the
+    mean of their cluster."""
+    _, inverse = np.unique(labels, return_inverse=True)
+    sizes = np.bincount(inverse)
+    means = np.zeros((len(sizes), data.shape[1]))
+    np.add.at(means, inverse, data)
+    means /= sizes[:, np.newaxis]
+    return float(np.sum((data - means[inverse]) ** 2))
+
+def _measure(target, args, queue):
+    start = time.perf_counter()
+    target(*args)
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux.
+    queue.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+def measure(target, *args):
+    """Runs target(*args) in a fresh process and returns a tuple of the
+    wall time in seconds and the peak resident set size in MB."""
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_measure, args=(target, args, queue))
+    process.start()
+    elapsed, max_rss = queue.get()
+    process.join()
+    return elapsed, max_rss / 1024
+
+def _load_json(path):
+    import clustering
+    with open(path, "r") as json_file:
+        clustering.time_series_array(json.load(json_file), None)
+
+def _load_streaming(path):
+    import streaming
+    streaming.time_series_array(path, None)
+
+def _load_nothing(_):
+    import clustering
+    import streaming
+
+def bench_streaming(args):
+    """Compares the peak memory of json.load and the incremental reader
+    on a synthetic chart of about args.size_mb MB."""
+    num_points = 1440
+    # Each point takes about 135 bytes in the json file.
+    num_series = max(1, int(args.size_mb * 1024 * 1024 / (num_points * 135)))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "chart.json")
+        write_synthetic_chart(path, num_series, num_points)
+        size_mb = os.path.getsize(path) / 1024 / 1024
+        print("chart: %d series x %d points, %.0f MB" % (num_series,
+                                                        num_points, size_mb))
+        _, base_rss = measure(_load_nothing, path)
+        print("%-10s %10s %14s" % ("loader", "time (s)", "peak RSS (MB)"))
+        print("%-10s %10s %14.0f" % ("imports", "-", base_rss))
+        for name, target in [("json", _load_json),
+                             ("streaming", _load_streaming)]:
+            elapsed, max_rss = measure(target, path)
+            print("%-10s %10.2f %14.0f" % (name, elapsed, max_rss))
+
+def bench_mini_batch(args):
+    """Compares the wall time and the inertia of kmeans and
+    mini_batch_kmeans on a synthetic chart."""
+    import clustering
+    data = synthetic_series(args.num_series, args.num_points)
+    scaled = clustering.scale_columns(data)
+    print("chart: %d series x %d points, %d clusters" % (
+        args.num_series, args.num_points,
+        args.num_series // clustering.KMEANS_RATIO + clustering.KMEANS_MIN))
+    print("%-20s %10s %14s" % ("algorithm", "time (s)", "inertia"))
+    for name, target, extra in [
+            ("k-means", clustering.kmeans, ()),
+            ("mini-batch-k-means", clustering.mini_batch_kmeans,
+             (args.batch_size,))]:
+        start = time.perf_counter()
+        labels = target(data, "off", *extra)
+        elapsed = time.perf_counter() - start
+        print("%-20s %10.2f %14.1f" % (name, elapsed, inertia(scaled, labels)))
+
+def bench_dtw(args):
+    """Reports how many DTW distances the lower bounds prune on the
+    charts, for the dbscan radius graph and for the assignment of the
+    time series to the initial centroids of k-medians."""
+    import charts
+    import clustering
+    import dtw
+    print("%-6s %-10s %10s %8s %9s %9s %10s" % (
+        "chart", "search", "pairs", "lb_kim", "lb_keogh", "computed",
+        "time (s)"))
+    for chart_id in args.charts.split(","):
+        data, _, _, _, _ = charts.load_arrays(chart_id, None)
+        data = clustering.impute(data)
+        num_dates = data.shape[1]
+        window = dtw.window_size(num_dates)
+
+        start = time.perf_counter()
+        _, stats = dtw.radius_graph(data, clustering.EPS_DTW_NONE, num_dates,
+                                    window)
+        elapsed = time.perf_counter() - start
+        pairs = max(1, stats["pairs"])
+        print("%-6s %-10s %10d %7.1f%% %8.1f%% %8.1f%% %10.2f" % (
+            chart_id, "radius", stats["pairs"],
+            100 * stats["lb_kim"] / pairs, 100 * stats["lb_keogh"] / pairs,
+            100 * stats["computed"] / pairs, elapsed))
+
+        num_clusters = len(data) // clustering.KMEANS_RATIO + \
+            clustering.KMEANS_MIN
+        if num_clusters >= len(data):
+            # k-medians needs more time series than clusters.
+            continue
+        centroids = clustering.k_means_init(data, num_clusters, 0)
+        start = time.perf_counter()
+        _, _, stats = dtw.nearest(data, centroids, num_dates, window)
+        elapsed = time.perf_counter() - start
+        pairs = max(1, stats["pairs"])
+        print("%-6s %-10s %10d %8s %8.1f%% %8.1f%% %10.2f" % (
+            chart_id, "nearest", stats["pairs"], "-",
+            100 - 100 * stats["computed"] / pairs,
+            100 * stats["computed"] / pairs, elapsed))
+
+def _loop_cluster_to_labels(cluster_labels, resource_to_label):
+    """The label frequencies of 0-based clusters, one time series at a
+    time, as computed before cluster_to_labels was vectorized."""
+    counts = np.bincount(cluster_labels)
+    cluster_to_label = np.zeros((len(counts), resource_to_label.shape[1]))
+    for index, element in enumerate(cluster_labels):
+        cluster_to_label[element] += resource_to_label[index]
+    return np.multiply(cluster_to_label.T, 1/counts).T
+
+def _loop_sort_labels(label_dict, cluster_labels, ts_to_labels):
+    """Sorts the label columns one at a time, as sort_labels did before it
+    was vectorized."""
+    system_labels = list(label_dict.keys())
+    ordered = np.argsort(np.array(system_labels))
+    ordered_labels = [0]*len(system_labels)
+    ordered_ts_labels = np.zeros(ts_to_labels.shape)
+    ordered_cluster_labels = np.zeros(cluster_labels.shape)
+    for i, elt in enumerate(ordered):
+        ordered_ts_labels[:, i] = ts_to_labels[:, elt]
+        ordered_cluster_labels[:, i] = cluster_labels[:, elt]
+        ordered_labels[i] = system_labels[elt]
+    return ordered_labels, ordered_cluster_labels, ordered_ts_labels
+
+def bench_frequency(args):
+    """Compares the label frequencies of the frequency route, computed one
+    time series and one label at a time and vectorized, on random
+    clusters and dense labels."""
+    import clustering
+    rng = np.random.RandomState(0)
+    num_clusters = args.num_series // clustering.KMEANS_RATIO + \
+        clustering.KMEANS_MIN
+    cluster_labels = rng.randint(num_clusters, size=args.num_series)
+    ts_to_labels = (rng.rand(args.num_series, args.num_labels) <
+                    10 / args.num_labels).astype(int)
+    label_dict = {"label-%d" % rng.randint(1 << 30): index
+                  for index in range(args.num_labels)}
+    print("chart: %d series, %d labels, %d clusters" % (
+        args.num_series, len(label_dict), num_clusters))
+    print("%-10s %10s" % ("version", "time (s)"))
+    results = []
+    for name, frequencies, sort in [
+            ("loop", _loop_cluster_to_labels, _loop_sort_labels),
+            ("vectorized", clustering.cluster_to_labels,
+             clustering.sort_labels)]:
+        start = time.perf_counter()
+        cluster_to_label = frequencies(cluster_labels, ts_to_labels)
+        results.append(sort(label_dict, cluster_to_label, ts_to_labels))
+        print("%-10s %10.2f" % (name, time.perf_counter() - start))
+    print("same result: %s" % all(
+        np.allclose(loop, vectorized)
+        for loop, vectorized in zip(results[0][1:], results[1][1:])))
+
+BENCHMARKS = {"streaming": bench_streaming, "mini-batch": bench_mini_batch,
+              "dtw": bench_dtw, "frequency": bench_frequency}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--size-mb", type=float, default=500,
+                        help="approximate size of the synthetic chart")
+    parser.add_argument("--num-series", type=int, default=20000,
+                        help="number of time series of the synthetic chart")
+    parser.add_argument("--num-points", type=int, default=240,
+                        help="number of points of each time series")
+    parser.add_argument("--batch-size", type=int, default=1024,
+                        help="batch size of mini-batch k-means")
+    parser.add_argument("--num-labels", type=int, default=2000,
+                        help="number of labels of the frequency benchmark")
+    parser.add_argument("--charts", default="002,100,101,102",
+                        help="comma separated ids of the charts")
+    parsed = parser.parse_args()
+    BENCHMARKS[parsed.benchmark](parsed)
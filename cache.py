@@ -0,0 +1,133 @@
+"""This module contains a least recently used cache bounded by memory.
+"""
+import sys
+import threading
+from collections import OrderedDict
+import numpy as np
+from scipy import sparse
+
+def nbytes(value):
+    """Estimates the number of bytes used by value.
+
+    Args:
+        value: An np array, a container of np arrays or any other object.
+
+    Returns:
+        The estimated size in bytes. np arrays and sparse matrices count
+        their buffers, and tuples, lists and dictionaries count their
+        elements. Memory-mapped arrays live in the page cache and only
+        count their header.
+    """
+    if isinstance(value, np.memmap):
+        return sys.getsizeof(value)
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if sparse.issparse(value):
+        return sum(nbytes(getattr(value, name)) for name in
+                   ("data", "indices", "indptr") if hasattr(value, name))
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(nbytes(elt) for elt in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(nbytes(k) + nbytes(v)
+                                          for k, v in value.items())
+    return sys.getsizeof(value)
+
+class LRUCache:
+    """A thread safe cache that evicts the least recently used entries
+    once the size of the cached values exceeds max_bytes.
+
+    Each entry may be stored with a signature, e.g. the mtime and size
+    of the file the value was computed from. A lookup with a different
+    signature is treated as a miss and drops the stale entry.
+
+    Attributes:
+        max_bytes: Upper bound for the total size of the cached values.
+        hits: Number of lookups that found a valid entry.
+        misses: Number of lookups that did not find a valid entry.
+        evictions: Number of entries dropped to stay under max_bytes.
+        current_bytes: Total size of the cached values.
+    """
+
+    def __init__(self, max_bytes, sizeof=nbytes):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, signature=None):
+        """Returns the value cached for key, or None if there is no
+        entry for key or if the entry has a different signature."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] != signature:
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, signature=None):
+        """Caches value for key and evicts the least recently used
+        entries until the cache fits in max_bytes. Values larger than
+        max_bytes are not cached."""
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, signature, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def resize(self, key):
+        """Measures again the value cached for key, which grew or shrank
+        since it was put, and evicts the least recently used entries until
+        the cache fits in max_bytes. An entry larger than max_bytes is
+        dropped. Does nothing if there is no entry for key."""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return
+        size = self.sizeof(entry[0])
+        with self._lock:
+            current = self._entries.get(key)
+            if current is None or current[0] is not entry[0]:
+                return
+            self._entries[key] = (current[0], current[1], size)
+            self.current_bytes += size - current[2]
+            if size > self.max_bytes:
+                self._remove(key)
+            while self.current_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        """Removes all the entries, the counters are kept."""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        """Returns a dictionary with the cache counters."""
+        return {"entries": len(self._entries), "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self.current_bytes -= size
@@ -0,0 +1,138 @@
+"""This module loads the charts and caches their parsed time series
+arrays, so that requests for the same chart skip parsing.
+
+Charts are read from the columnar format when it was converted from
+the current json file, and from the json file otherwise. Large json
+files are read incrementally. Charts are converted by running:
+    python charts.py <chart_id> [<chart_id> ...]
+"""
+import json
+import os
+import sys
+import numpy as np
+import clustering
+import columnar
+import streaming
+from cache import LRUCache
+
+DATA_DIR = "./data"
+
+# Upper bound for the memory used by the cached charts.
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Json files from this size on are read incrementally, which keeps the
+# peak memory close to the size of the arrays instead of several times
+# the size of the file.
+STREAMING_MIN_BYTES = 64 * 1024 * 1024
+
+chart_cache = LRUCache(CACHE_MAX_BYTES)
+
+def chart_path(chart_id):
+    """Returns the path of the json file for the chart chart_id."""
+    return os.path.join(DATA_DIR, "chart-" + str(chart_id) + ".json")
+
+def columnar_path(chart_id):
+    """Returns the path of the columnar directory for the chart chart_id."""
+    return os.path.join(DATA_DIR, "chart-" + str(chart_id))
+
+def chart_signature(chart_id):
+    """Returns a tuple (format, mtime, size) of the file the chart is
+    loaded from, which changes whenever the file is rewritten. Raises an
+    OSError if the chart does not exist.
+
+    The columnar format is used if it exists and is not older than the
+    json file.
+    """
+    try:
+        json_stat = os.stat(chart_path(chart_id))
+    except OSError:
+        json_stat = None
+    try:
+        meta_stat = os.stat(os.path.join(columnar_path(chart_id), "meta.json"))
+        if json_stat is None or meta_stat.st_mtime_ns >= json_stat.st_mtime_ns:
+            return "columnar", meta_stat.st_mtime_ns, meta_stat.st_size
+    except OSError:
+        if json_stat is None:
+            raise
+    return "json", json_stat.st_mtime_ns, json_stat.st_size
+
+def load_arrays(chart_id, key, dtype=np.float64, step=None,
+                aggregation="mean"):
+    """Returns the output of clustering.time_series_array for the chart
+    chart_id, using the cached arrays when the file has not changed.
+
+    The cached arrays are shared between requests and are read only.
+    Missing values are NaN, see clustering.impute.
+
+    Args:
+        chart_id: The id of the chart.
+        key: The key for the time series labels that are saved. If None,
+            then all label values may be kept, otherwise only label
+            values with that key are kept.
+        dtype: The float type of the data array.
+        step: If not None, the time series are resampled to time buckets
+            of step seconds with clustering.resample.
+        aggregation: How values in the same time bucket are combined.
+
+    Returns:
+        The tuple (data, label_dict, ts_to_labels, date_to_index,
+        min_max) returned by clustering.time_series_array.
+    """
+    signature = chart_signature(chart_id)
+    cache_key = (chart_id, key, np.dtype(dtype).name, step,
+                 aggregation if step else None)
+    arrays = chart_cache.get(cache_key, signature)
+    if arrays is not None:
+        return arrays
+
+    if step:
+        data, label_dict, ts_to_labels, date_to_index, min_max = load_arrays(
+            chart_id, key, dtype)
+        data, date_to_index = clustering.resample(data, date_to_index, step,
+                                                  aggregation)
+        arrays = data, label_dict, ts_to_labels, date_to_index, min_max
+    else:
+        arrays = None
+        if signature[0] == "columnar":
+            try:
+                arrays = clustering.time_series_array(
+                    columnar.ColumnarChart(columnar_path(chart_id)), key,
+                    dtype, np.nan)
+            except columnar.UnsupportedVersionError:
+                # A chart converted with an older version of the format
+                # is read from its json file until it is converted again.
+                pass
+        if arrays is None:
+            arrays = load_json_arrays(chart_id, key, dtype)
+    for array in arrays:
+        if hasattr(array, "setflags"):
+            array.setflags(write=False)
+    chart_cache.put(cache_key, arrays, signature)
+    return arrays
+
+def load_json_arrays(chart_id, key, dtype=np.float64):
+    """Returns the output of clustering.time_series_array for the json
+    file of the chart chart_id, which is read incrementally if it is
+    large. Raises an OSError if the file does not exist."""
+    if os.path.getsize(chart_path(chart_id)) >= STREAMING_MIN_BYTES:
+        return streaming.time_series_array(chart_path(chart_id), key, dtype,
+                                           np.nan)
+    with open(chart_path(chart_id), "r") as json_file:
+        return clustering.time_series_array(json.load(json_file), key, dtype,
+                                            np.nan)
+
+def convert(chart_id):
+    """Converts the json file of the chart chart_id to the columnar
+    format."""
+    with open(chart_path(chart_id), "r") as json_file:
+        data = json.load(json_file)
+    series_labels = [[time_series["metric"]["labels"],
+                      time_series["resource"]["labels"]]
+                     for time_series in data["timeSeries"]]
+    columnar.write(columnar_path(chart_id),
+                   clustering.time_series_array(data, None, missing=np.nan),
+                   series_labels)
+
+if __name__ == "__main__":
+    for arg in sys.argv[1:]:
+        convert(arg)
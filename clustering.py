@@ -1,14 +1,28 @@
 import json
-from statistics import median
+import multiprocessing
+import os
+import threading
+import warnings
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
 import numpy as np
-from sklearn.cluster import KMeans, DBSCAN
+from sklearn.cluster import KMeans, MiniBatchKMeans, DBSCAN
 from sklearn.preprocessing import scale
-from sklearn.neighbors import NearestNeighbors
-from sklearn.metrics import pairwise_distances, pairwise_distances_argmin_min
+from sklearn.metrics import pairwise_distances
 from sklearn.metrics import pairwise_distances_argmin
-from sklearn.decomposition import PCA
-from scipy.spatial import distance
+from sklearn.decomposition import PCA, IncrementalPCA
+from scipy import sparse
+from scipy.stats import norm
+from scipy.cluster.hierarchy import fcluster, linkage
+from scipy.sparse.csgraph import connected_components
+from sklearn.utils import gen_batches
+from sklearn.utils.extmath import row_norms
+import columnar
 import count
+import dtw
+import neighbors
 
 # These params where determined by testing various k, eps produced by running
 # tuning_k and tuning_eps respectively, and picking the parameters that were at
@@ -19,18 +33,106 @@ EPS_CORRELATION_NONE = 2.4
 EPS_PROXIMITY_NONE = 1.3
 EPS_PROXOMITY_ONE_HOT = 2.1
 EPS_CORRELATION_ONE_HOT = 2.7
-
-# It is common to reinitialize the centroids for k-means 10 times.
+EPS_DTW_NONE = 7.5
+EPS_DTW_ONE_HOT = 8.0
+
+# Time series farther than OUTLIER_DISTANCE from the center of their cluster
+# are outliers. In the "adaptive" outlier mode, the threshold of each cluster
+# is instead the median of the distances of its time series to the center
+# plus OUTLIER_MAD_FACTOR times their median absolute deviation.
+OUTLIER_DISTANCE = 6.75
+OUTLIER_MAD_FACTOR = 3
+OUTLIER_MODES = ("off", "on", "adaptive")
+
+# The statistics of the bands of the clusters besides the min and max: the
+# BAND_PERCENTILES percentiles, then the mean.
+BAND_PERCENTILES = (10, 50, 90)
+BAND_STATISTICS = ("p10", "p50", "p90", "mean")
+
+# The methods used for encoding the labels of the time series.
+LABEL_ENCODINGS = ("none", "one-hot")
+
+# The algorithms that compare the time series with DTW when the similarity
+# is "dtw". The other algorithms only use the euclidean distance.
+DTW_ALGORITHMS = ("k-means-constrained", "k-medians", "dbscan")
+
+# The fraction of the variance kept by the PCA before dbscan, for each
+# similarity compared with the euclidean distance.
+PCA_VARIANCE = {"correlation": .75, "proximity": .85}
+
+# Matrices with at least PCA_RANDOMIZED_MIN_SIZE rows and columns use a
+# randomized solver, starting with PCA_RANDOMIZED_COMPONENTS components.
+# Matrices from PCA_INCREMENTAL_MIN_BYTES on, whether in memory or
+# memory-mapped, are fitted incrementally in batches of PCA_BATCH_SIZE rows.
+PCA_RANDOMIZED_MIN_SIZE = 500
+PCA_RANDOMIZED_COMPONENTS = 32
+PCA_INCREMENTAL_MIN_BYTES = 256 * 1024 * 1024
+PCA_BATCH_SIZE = 1000
+
+# It is common to reinitialize the centroids for k-means 10 times. The DTW
+# runs compare every pair of time series of a cluster to find its medoid,
+# so they are reinitialized fewer times.
 NUM_RUNS = 10
-
-def time_series_array(data, key):
+DTW_NUM_RUNS = 3
+
+# The number of values of k the fast mode of tuning_k fits on a logarithmic
+# scale, and then at most between the neighbors of the knee.
+TUNING_COARSE_POINTS = 16
+TUNING_FINE_POINTS = 16
+
+# The default number of time series in each batch of mini-batch k-means.
+MINI_BATCH_SIZE = 1024
+
+# The largest alphabet of the SAX symbolization, whose breakpoints split the
+# standard normal distribution into equally likely intervals.
+SAX_MAX_ALPHABET = 20
+
+# The linkage methods of agglomerative clustering. "ward" merges the two
+# clusters that least increase the variance, "average" the two clusters
+# with the smallest mean distance between their time series.
+LINKAGES = ("ward", "average")
+
+# The linkage tree needs the distance between every pair of time series,
+# about 100 MB for AGGLOMERATIVE_MAX_SERIES time series, so larger charts
+# are not clustered with agglomerative clustering.
+AGGLOMERATIVE_MAX_SERIES = 5000
+
+# A run of kmeans_kmedians stops after MAX_ITERATIONS iterations, or once
+# the squared shift of the centroids is at most CONVERGENCE_TOL times the
+# mean variance of the data columns, as in sklearn.
+MAX_ITERATIONS = 300
+CONVERGENCE_TOL = 1e-4
+
+# The default number of worker processes the runs of kmeans_kmedians and
+# the fits of tuning_k_fast are spread over, one per core and at most one
+# per run. 1 runs them in the calling process. The workers are started
+# with PARALLEL_START_METHOD, as forking the threaded web server may copy
+# locks held by other threads.
+NUM_WORKERS = min(NUM_RUNS, os.cpu_count() or 1)
+PARALLEL_START_METHOD = "spawn"
+
+# The float types the pipeline can run in. float32 halves the memory and
+# the memory bandwidth of the distance computations.
+DTYPES = {"float32": np.float32, "float64": np.float64}
+
+# The ways the points of a time series that fall in the same time bucket
+# can be combined when resampling.
+AGGREGATIONS = ("mean", "max", "last")
+
+# The ways missing values can be filled before clustering. "sentinel"
+# fills them with -1.
+IMPUTATIONS = ("sentinel", "median", "ffill", "linear")
+
+def time_series_array(data, key, dtype=np.float64, missing=-1):
     """Converts the time series data to an np array.
 
     Args:
-        data: A timeSeries object.
+        data: A timeSeries object or a columnar.ColumnarChart.
         key: The key for the time series labels that are saved. If None,
             then all label values may be kept, otherwise only label
             values with that key are kept.
+        dtype: The float type of the data array.
+        missing: The value of missing points, -1 or np.nan.
 
     Returns:
         An np array where each row represents a resource and each column
@@ -38,37 +140,83 @@ def time_series_array(data, key):
         to an index and an np array where each row represents a time series
         and each column represents a label as defined in the label dictionary.
     """
-    first_val = data["timeSeries"][0]["points"][0]["value"]["doubleValue"]
-    date_to_index, label_to_count, min_max = {}, {}, [first_val, first_val]
-    count.get_dates_labels(data, date_to_index, label_to_count, min_max, key)
-    if not key:
-        labels = list(filter(lambda k: label_to_count[k] >= 2 and
-                             label_to_count[k] < len(data["timeSeries"]),
-                             label_to_count.keys()))
-    else:
-        labels = list(label_to_count.keys())
+    if isinstance(data, columnar.ColumnarChart):
+        return data.time_series_array(key, dtype, missing)
+    return build_arrays(flatten_time_series(data["timeSeries"], key), key,
+                        dtype, missing)
+
+def flatten_time_series(time_series_list, key):
+    """Walks every point of every time series once and flattens them
+    into typed arrays.
+
+    Args:
+        time_series_list: An iterable of time series objects.
+        key: The key for the time series labels that are counted. If
+            None, then all label values are counted.
+
+    Returns:
+        A dictionary with the number of points of each time series
+        ("counts"), the date index ("date_indexes") and value ("values")
+        of each point, a dictionary mapping each date to its index in
+        first seen order ("date_to_index"), a dictionary mapping each
+        label to its count ("label_to_count") and a list with the label
+        values of each time series ("series_labels").
+    """
+    counts, date_indexes, values = array("q"), array("q"), array("d")
+    date_to_index, label_to_count, series_labels = {}, {}, []
+
+    for time_series in time_series_list:
+        points = time_series["points"]
+        counts.append(len(points))
+        for point in points:
+            date_indexes.append(date_to_index.setdefault(
+                point["interval"]["startTime"], len(date_to_index)))
+            values.append(point["value"]["doubleValue"])
+
+        metric_labels = time_series["metric"]["labels"]
+        resource_labels = time_series["resource"]["labels"]
+        count.count_labels(metric_labels, label_to_count, key)
+        count.count_labels(resource_labels, label_to_count, key)
+        series_labels.append(list(metric_labels.values()) +
+                             list(resource_labels.values()))
+
+    return {"counts": counts, "date_indexes": date_indexes, "values": values,
+            "date_to_index": date_to_index, "label_to_count": label_to_count,
+            "series_labels": series_labels}
+
+def build_arrays(flat, key, dtype=np.float64, missing=-1):
+    """Builds the data array and label array from flattened points with
+    vectorized operations.
+
+    Args:
+        flat: A dictionary of flattened points as returned by
+            flatten_time_series.
+        key: The key for the time series labels that are saved. If None,
+            then all label values may be kept, otherwise only label
+            values with that key are kept.
+        dtype: The float type of the data array.
+        missing: The value of missing points, -1 or np.nan.
+
+    Returns:
+        The same tuple as time_series_array.
+    """
+    counts = np.frombuffer(flat["counts"], dtype=np.int64)
+    values = np.frombuffer(flat["values"], dtype=np.float64)
+    date_indexes = np.frombuffer(flat["date_indexes"], dtype=np.int64)
+    date_to_index = flat["date_to_index"]
+    label_to_count = flat["label_to_count"]
+    num_instances = len(counts)
+
+    min_max = [float(np.min(values)), float(np.max(values))]
+    data_array = np.full((num_instances, len(date_to_index)), missing,
+                         dtype=dtype)
+    series_indexes = np.repeat(np.arange(num_instances), counts)
+    data_array[series_indexes, date_indexes] = scale_to_range(min_max, values)
+
+    labels = count.select_labels(label_to_count, num_instances, key)
     label_to_index = dict(zip(labels, range(len(labels))))
-    num_instances = len(data["timeSeries"])
-    num_times = len(date_to_index)
-    data_array = [0]*num_instances
-    instance_labels = [0]*num_instances
-
-    for index, time_series in enumerate(data["timeSeries"]):
-        points = [-1]*num_times
-        for point in time_series["points"]:
-            start_time = point["interval"]["startTime"]
-            points[date_to_index[start_time]] = scale_to_range(
-                min_max, point["value"]["doubleValue"])
-        data_array[index] = points
-
-        encoding = [0]*len(label_to_index)
-        count.one_hot_encoding(time_series["metric"]["labels"],
-                               label_to_index, encoding)
-        count.one_hot_encoding(time_series["resource"]["labels"],
-                               label_to_index, encoding)
-        instance_labels[index] = encoding
-    data_array = np.array(data_array)
-    instance_labels = np.array(instance_labels)
+    instance_labels = count.encode_labels(flat["series_labels"],
+                                          label_to_index)
     return data_array, label_to_index, instance_labels, date_to_index, min_max
 
 def scale_to_range(min_max_old, element, min_max_new=[0, 10]):
@@ -76,8 +224,8 @@ def scale_to_range(min_max_old, element, min_max_new=[0, 10]):
 
     Args:
         min_max_old: Original range of the data, [min, max].
-        element: Integer that will be scaled to the new range, must be
-            within the old_range.
+        element: Integer or np array that will be scaled to the new
+            range, must be within the old_range.
         min_max_new: New range of the data.
 
     Returns:
@@ -87,6 +235,99 @@ def scale_to_range(min_max_old, element, min_max_new=[0, 10]):
     old_range = min_max_old[1] - min_max_old[0]
     return  ((element - min_max_old[0]) * new_range) / old_range
 
+def dense(matrix):
+    """Returns matrix as an np array, converting it if it is a sparse
+    matrix."""
+    if sparse.issparse(matrix):
+        return matrix.toarray()
+    return matrix
+
+def scale_columns(data):
+    """Standardizes each column of data. Sparse matrices are not
+    centered, which would make them dense. Centering shifts every time
+    series by the same vector, so euclidean distances, and the clusters
+    found with them, do not change.
+
+    Dense matrices are standardized as sklearn's scale, whose check that
+    the centered columns have a zero mean is too strict for float32 and
+    warns on most float32 charts.
+    """
+    if sparse.issparse(data):
+        return scale(data, with_mean=False)
+    mean = np.nanmean(data, axis=0)
+    std = np.nanstd(data, axis=0)
+    # Constant columns are only centered, as in sklearn.
+    std[std < 10 * np.finfo(std.dtype).eps] = 1
+    return (data - mean) / std
+
+def parse_dates(dates):
+    """Converts RFC 3339 UTC dates, e.g. "2020-06-26T11:29:00Z", to
+    seconds since the epoch.
+
+    Args:
+        dates: A list of date strings.
+
+    Returns:
+        An int64 np array of the seconds since the epoch of each date.
+    """
+    times = np.array([date.rstrip("Z") for date in dates],
+                     dtype="datetime64[ns]")
+    return times.astype(np.int64) // 10**9
+
+def format_dates(times):
+    """Converts seconds since the epoch to RFC 3339 UTC dates."""
+    return [date + "Z" for date in np.datetime_as_string(
+        np.asarray(times).astype("datetime64[s]"), unit="s")]
+
+def resample(data, date_to_index, step, aggregation="mean"):
+    """Aligns the time series onto a sorted grid of time buckets that are
+    step seconds wide, which merges columns of misaligned timestamps.
+
+    Args:
+        data: Array where each row is a time series and each column is
+            a date. Missing values are NaN.
+        date_to_index: A dictionary mapping each date to its column.
+        step: The width of the time buckets in seconds. Buckets start at
+            multiples of step since the epoch.
+        aggregation: How the values of a time series in the same bucket
+            are combined, must be one of AGGREGATIONS.
+
+    Returns:
+        A tuple (resampled, bucket_to_index) where resampled has a
+        column for each bucket that has at least one date, in time
+        order, and bucket_to_index maps the start date of each bucket
+        to its column. A time series without values in a bucket has NaN.
+    """
+    dates = sorted(date_to_index, key=date_to_index.get)
+    times = parse_dates(dates)
+    order = np.argsort(times, kind="stable")
+    buckets = times[order] // step
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    sorted_data = data[:, order]
+    valid = ~np.isnan(sorted_data)
+
+    if aggregation == "mean":
+        sums = np.add.reduceat(np.where(valid, sorted_data, 0), starts, axis=1)
+        counts = np.add.reduceat(valid, starts, axis=1)
+        resampled = np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+    elif aggregation == "max":
+        resampled = np.fmax.reduceat(sorted_data, starts, axis=1)
+    elif aggregation == "last":
+        # Index of the latest column with a value, up to each column.
+        latest = np.maximum.accumulate(
+            np.where(valid, np.arange(len(order)), -1), axis=1)
+        ends = np.r_[starts[1:], len(order)] - 1
+        latest = latest[:, ends]
+        rows = np.arange(len(data))[:, np.newaxis]
+        resampled = np.where(latest >= starts,
+                             sorted_data[rows, np.maximum(latest, 0)], np.nan)
+    else:
+        raise ValueError("Unknown aggregation: " + str(aggregation))
+
+    bucket_dates = format_dates(buckets[starts] * step)
+    bucket_to_index = dict(zip(bucket_dates, range(len(bucket_dates))))
+    return resampled.astype(data.dtype), bucket_to_index
+
 def fill_with_median(data):
     """Fills missing values (-1) in a time series to the median of the
     time series.
@@ -95,15 +336,80 @@ def fill_with_median(data):
         data: A list where each row is a resource and each column is a
         time.
     """
-    data_array = data
-    for row in data_array:
-        med = median(list(filter(lambda elt: elt != -1, row)))
-        for i, val in enumerate(row):
-            if val == -1:
-                row[i] = med
-    return data_array
+    data_array = np.array(data, dtype=float)
+    data_array[data_array == -1] = np.nan
+    return impute(data_array, "median").tolist()
 
-def preprocess(data, label_encoding, similarity, ts_to_labels, algorithm):
+def impute(data, strategy="sentinel", date_to_index=None):
+    """Fills the missing values (NaN) of each time series.
+
+    Args:
+        data: Array where each row is a time series and each column is
+            a date.
+        strategy: One of IMPUTATIONS. "sentinel" fills missing values
+            with -1, "median" with the median of the time series,
+            "ffill" with the previous value in time and "linear" by
+            interpolating between the previous and next value in time.
+            "ffill" and "linear" use the next value before the first
+            value of a time series.
+        date_to_index: A dictionary mapping each date to its column,
+            used to order the columns by time. If None, the columns are
+            in time order.
+
+    Returns:
+        An array of the same type as data without NaN. Time series
+        without any value are filled with -1.
+    """
+    missing = np.isnan(data)
+    if not missing.any():
+        return data
+    if strategy == "sentinel":
+        return np.where(missing, -1, data).astype(data.dtype)
+
+    if strategy == "median":
+        medians = np.full(len(data), -1, dtype=data.dtype)
+        has_values = ~missing.all(axis=1)
+        medians[has_values] = np.nanmedian(data[has_values], axis=1)
+        return np.where(missing, medians[:, np.newaxis], data)
+
+    num_dates = data.shape[1]
+    if date_to_index is None:
+        times = np.arange(num_dates)
+    else:
+        times = parse_dates(sorted(date_to_index, key=date_to_index.get))
+    order = np.argsort(times, kind="stable")
+    times = times[order]
+    sorted_data = data[:, order]
+    valid = ~missing[:, order]
+    cols = np.arange(num_dates)
+    # Columns of the previous and next value of each time series.
+    prev = np.maximum.accumulate(np.where(valid, cols, -1), axis=1)
+    next_ = np.minimum.accumulate(
+        np.where(valid, cols, num_dates)[:, ::-1], axis=1)[:, ::-1]
+    has_prev, has_next = prev >= 0, next_ < num_dates
+    prev, next_ = np.maximum(prev, 0), np.minimum(next_, num_dates - 1)
+    rows = np.arange(len(data))[:, np.newaxis]
+    prev_values, next_values = sorted_data[rows, prev], sorted_data[rows, next_]
+
+    filled = np.where(has_prev, prev_values, next_values)
+    if strategy == "linear":
+        gap = (times[next_] - times[prev]).astype(np.float64)
+        both = has_prev & has_next & (gap > 0)
+        fraction = np.where(both, (times - times[prev]) / np.where(
+            both, gap, 1), 0)
+        filled = np.where(both, prev_values + (next_values - prev_values) *
+                          fraction, filled)
+    elif strategy != "ffill":
+        raise ValueError("Unknown imputation: " + str(strategy))
+    filled[np.isnan(filled)] = -1
+
+    imputed = np.empty_like(data)
+    imputed[:, order] = filled
+    return imputed
+
+def preprocess(data, label_encoding, similarity, ts_to_labels, algorithm,
+               projection=None, segments=None, alphabet_size=None,
+               date_to_index=None, imputation=None):
     """Updates the data according to label_encoding and similarity.
 
     Args:
@@ -112,40 +418,249 @@ def preprocess(data, label_encoding, similarity, ts_to_labels, algorithm):
         label_encoding: The method used for encoding the labels. Must
             be "none" or "one-hot".
         similarity: The similarity measure used for scaling the data
-            before clustering. Must be "proximity" or "correlation".
-        ts_to_labels: Array where each row is a time series and each
-            column is a label.
+            before clustering. Must be "proximity", "correlation" or
+            "dtw". The data is not projected for "dtw", whose distance
+            depends on the order of the dates.
+        ts_to_labels: Array or sparse matrix where each row is a time
+            series and each column is a label.
         algorithm: The algorithm that will be run on data.
+        projection: The projection from dbscan_projection applied to
+            the data for dbscan. If None, it is fitted on data.
+        segments: If not None, the dates are first reduced to this
+            number of segments, see reduce_dates.
+        alphabet_size: If not None, the time series are symbolized
+            with this number of symbols, see reduce_dates.
+        date_to_index: A dictionary mapping each date to its column,
+            used to order the columns by time before reducing them.
+        imputation: If not None, the missing values are first filled
+            with this strategy, see impute. For dbscan, the imputation,
+            the date reduction and the projection are applied to one
+            batch of rows at a time, so data, e.g. a memory-mapped
+            matrix, is never copied whole.
 
     Returns:
         An np array updated according to label_encoding, similarity and
-        algorithm.
+        algorithm, with the float type of data. If the labels are
+        appended and ts_to_labels is sparse, a sparse CSR matrix is
+        returned instead.
     """
-    updated_data = data
-    if similarity == "correlation":
-        updated_data = scale_to_zero(updated_data)
-    if algorithm == "dbscan":
+    def reduce(rows):
+        if imputation is not None:
+            rows = impute(rows, imputation, date_to_index)
+        return reduce_dates(rows, segments, alphabet_size, date_to_index)
+
+    if algorithm == "dbscan" and similarity != "dtw":
+        if projection is None:
+            projection = dbscan_projection(data, similarity, reduce)
+        minimum = projection["minimum"]
+        if minimum is None:
+            updated_data = project(data, projection, reduce)
+        else:
+            updated_data = project(data, projection, lambda rows: scale_to_zero(
+                reduce(rows), minimum))
+    else:
+        updated_data = reduce(data)
         if similarity == "correlation":
-            pca = PCA(n_components=.75)
-        elif similarity == "proximity":
-            pca = PCA(n_components=.85)
-        pca.fit(updated_data)
-        updated_data = pca.transform(updated_data)
+            updated_data = scale_to_zero(updated_data)
     if label_encoding == "one-hot":
-        updated_data = np.concatenate((updated_data, ts_to_labels), axis=1)
+        if sparse.issparse(ts_to_labels):
+            updated_data = sparse.hstack((updated_data, ts_to_labels),
+                                         format="csr", dtype=updated_data.dtype)
+        else:
+            updated_data = np.concatenate(
+                (updated_data, np.asarray(ts_to_labels,
+                                          dtype=updated_data.dtype)), axis=1)
     return updated_data
 
-def scale_to_zero(data):
+def reduce_dates(data, segments=None, alphabet_size=None, date_to_index=None):
+    """Reduces the number of dates of data with paa, then symbolizes the
+    time series with sax. Either step is skipped if its parameter is
+    None."""
+    if segments is not None:
+        data = paa(data, segments, date_to_index)
+    if alphabet_size is not None:
+        data = sax(data, alphabet_size)
+    return data
+
+def paa(data, segments, date_to_index=None):
+    """Piecewise Aggregate Approximation: splits the dates into segments
+    of consecutive dates of nearly equal sizes and replaces each time
+    series by its mean over each segment, scaled by the square root of
+    the number of dates per segment. The euclidean distance between the
+    reduced time series then lower-bounds, and approximates, the distance
+    between the full time series, so the eps and the outlier thresholds
+    tuned on full resolution still apply.
+
+    Args:
+        data: Array where each row is a time series and each column is
+            a date.
+        segments: The number of segments. If there are no more dates
+            than segments, data is returned unchanged.
+        date_to_index: A dictionary mapping each date to its column,
+            used to order the columns by time. If None, the columns are
+            in time order.
+
+    Returns:
+        An array with a column per segment in time order and the float
+        type of data.
+    """
+    num_dates = data.shape[1]
+    if num_dates <= segments:
+        return data
+    if date_to_index is not None:
+        times = parse_dates(sorted(date_to_index, key=date_to_index.get))
+        data = data[:, np.argsort(times, kind="stable")]
+    starts = np.arange(segments) * num_dates // segments
+    sizes = np.diff(np.append(starts, num_dates))
+    sums = np.add.reduceat(data, starts, axis=1)
+    scale = np.sqrt(num_dates / segments)
+    return (sums * (scale / sizes)).astype(data.dtype, copy=False)
+
+def sax(data, alphabet_size):
+    """Symbolic Aggregate approXimation: standardizes each time series
+    and replaces each value by the interval of the standard normal
+    distribution it falls in, out of alphabet_size equally likely
+    intervals.
+
+    Args:
+        data: Array where each row is a time series and each column is
+            a date or a segment.
+        alphabet_size: The number of symbols, from 2 to SAX_MAX_ALPHABET.
+
+    Returns:
+        An array of the symbols, scaled to [0, 10] like the time series,
+        with the float type of data. Constant time series get the middle
+        symbol, or the lower of the two middle symbols.
+    """
+    deviations = np.std(data, axis=1, keepdims=True)
+    standardized = (data - np.mean(data, axis=1, keepdims=True)) / \
+        np.where(deviations > 0, deviations, 1)
+    breakpoints = norm.ppf(np.arange(1, alphabet_size) / alphabet_size)
+    symbols = np.searchsorted(breakpoints, standardized)
+    return (symbols * (10 / (alphabet_size - 1))).astype(data.dtype,
+                                                         copy=False)
+
+def dbscan_projection(data, similarity, transform=None):
+    """Fits the PCA projection preprocess applies to data for dbscan.
+
+    Args:
+        data: Array where each row is a time series and each column is
+            a date.
+        similarity: The similarity measure used for scaling the data
+            before clustering. Must be "proximity" or "correlation".
+        transform: A function applied to the rows of data before the
+            scaling of the similarity, see fit_pca.
+
+    Returns:
+        The projection of fit_pca, with the smallest value of the
+        transformed data that scale_to_zero used as "minimum" for
+        "correlation", and None otherwise.
+    """
+    if transform is None:
+        transform = _unchanged
+    minimum = None
+    scaled = transform
+    if similarity == "correlation":
+        minimum = min(np.min(transform(data[batch])) for batch in
+                      gen_batches(len(data), PCA_BATCH_SIZE))
+
+        def scaled(rows):
+            return scale_to_zero(transform(rows), minimum)
+    projection = fit_pca(data, PCA_VARIANCE[similarity], scaled)
+    projection["minimum"] = minimum
+    return projection
+
+def _unchanged(rows):
+    """Returns rows, the transform that changes nothing."""
+    return rows
+
+def fit_pca(data, variance, transform=None):
+    """Fits a PCA keeping the fewest components that explain more than
+    variance of the variance of data, as PCA(n_components=variance).
+    Matrices with at least PCA_RANDOMIZED_MIN_SIZE rows and columns use a
+    randomized solver which computes more components until enough
+    variance is explained. Matrices from PCA_INCREMENTAL_MIN_BYTES on are
+    fitted incrementally, one batch of rows at a time, so that they are
+    never copied whole. The solver only depends on the shape and size of
+    the transformed data, so a memory-mapped matrix gets the same
+    projection as in memory.
+
+    Args:
+        data: Array where each row is a time series and each column is
+            a date.
+        variance: The fraction of the variance that is kept.
+        transform: A function applied to the rows of data before they
+            are fitted, e.g. the imputation and the date reduction. It is
+            called on slices of rows and must transform each row on its
+            own. If None, data is fitted unchanged.
+
+    Returns:
+        A dictionary with the "mean" of the columns, the principal
+        "components" as rows, their "explained_variance_ratio" and the
+        "solver" used.
+    """
+    if transform is None:
+        transform = _unchanged
+    first = transform(data[:1])
+    num_rows, num_columns = len(data), first.shape[1]
+    max_components = min(num_rows, num_columns)
+    if num_rows * num_columns * first.itemsize >= PCA_INCREMENTAL_MIN_BYTES:
+        solver = "incremental"
+        num_components = min(max_components, PCA_BATCH_SIZE)
+        pca = IncrementalPCA(n_components=num_components)
+        # The same batches as IncrementalPCA.fit, which merges a last
+        # batch with fewer rows than components into the previous one.
+        for batch in gen_batches(num_rows, PCA_BATCH_SIZE,
+                                 min_batch_size=num_components):
+            pca.partial_fit(transform(data[batch]))
+    elif max_components >= PCA_RANDOMIZED_MIN_SIZE:
+        solver = "randomized"
+        data = transform(data)
+        num_components = PCA_RANDOMIZED_COMPONENTS
+        while True:
+            pca = PCA(n_components=num_components, svd_solver="randomized",
+                      random_state=0).fit(data)
+            if (np.sum(pca.explained_variance_ratio_) > variance or
+                    num_components == max_components):
+                break
+            num_components = min(2 * num_components, max_components)
+    else:
+        solver = "exact"
+        pca = PCA(n_components=variance).fit(transform(data))
+    ratios = pca.explained_variance_ratio_
+    num_components = min(np.searchsorted(np.cumsum(ratios), variance,
+                                         side="right") + 1, len(ratios))
+    return {"mean": pca.mean_, "components": pca.components_[:num_components],
+            "explained_variance_ratio": ratios[:num_components],
+            "solver": solver}
+
+def project(data, projection, transform=None):
+    """Projects the rows of data on the components of projection, as
+    PCA.transform. With transform, see fit_pca, the rows are transformed
+    and projected one batch of PCA_BATCH_SIZE rows at a time."""
+    components = projection["components"]
+    offset = projection["mean"] @ components.T
+    if transform is None:
+        projected = data @ components.T - offset
+        return projected.astype(data.dtype, copy=False)
+    batches = [transform(data[batch]) @ components.T - offset
+               for batch in gen_batches(len(data), PCA_BATCH_SIZE)]
+    return np.concatenate(batches).astype(data.dtype, copy=False)
+
+def scale_to_zero(data, minimum=None):
     """Scales the data such that the minimum of each time series is at
     zero.
 
     Args:
         data: A timeSeries object.
+        minimum: The smallest value of the matrix the rows of data come
+            from, to scale a slice of rows like the whole matrix. If
+            None, the smallest value of data.
 
     Returns:
         An np array of the scaled data.
     """
-    min_data = np.min(data)
+    min_data = np.min(data) if minimum is None else minimum
     scaled_data = [arr - abs(min_data - val) for arr, val in zip(
         data, data.min(axis=1))]
     return scaled_data + abs(min_data)
@@ -163,29 +678,142 @@ def tuning_k(data):
         run with k set to n+1.
     """
     distances = []
-    data = scale(data)
-    for i in range(1, len(data) // 2):
+    data = scale_columns(data)
+    for i in range(1, data.shape[0] // 2):
         kmeans_result = KMeans(n_clusters=i, random_state=0).fit(data)
         distances.append(kmeans_result.inertia_)
     return distances
 
-def tuning_eps(data):
+def tuning_k_fast(data, workers=1):
+    """Finds the elbow of the inertia curve of k-means without fitting
+    every k. The k are first sampled on a logarithmic scale, each fit
+    starting from the centroids of the previous one. The k between the
+    neighbors of the knee of that curve are then fitted in parallel.
+
+    Args:
+        data: A timeSeries object.
+        workers: The number of processes the fits between the neighbors
+            of the knee are spread over.
+
+    Returns:
+        A dictionary with the fitted k in increasing order ("ks"), the
+        sum of squared distances of samples to their cluster center for
+        each k ("inertia") and the k at the knee of the curve ("knee"),
+        covering the same k as tuning_k.
+    """
+    data = dense(scale_columns(data))
+    max_k = data.shape[0] // 2 - 1
+    if max_k < 1:
+        return {"ks": [], "inertia": [], "knee": None}
+
+    coarse = np.unique(np.geomspace(1, max_k, TUNING_COARSE_POINTS).round())
+    coarse = coarse.astype(int).tolist()
+    inertia, centers = {}, {}
+    previous = None
+    for k in coarse:
+        previous, inertia[k] = fit_kmeans(data, k, previous)
+        centers[k] = previous
+
+    position = coarse.index(knee(coarse, [inertia[k] for k in coarse]))
+    lower = coarse[max(position - 1, 0)]
+    upper = coarse[min(position + 1, len(coarse) - 1)]
+    fine = np.arange(lower + 1, upper)
+    if len(fine) > TUNING_FINE_POINTS:
+        fine = fine[np.linspace(0, len(fine) - 1, TUNING_FINE_POINTS).round()
+                    .astype(int)]
+    args_list = []
+    for k in np.unique(fine).tolist():
+        if k not in inertia:
+            start = max(coarse_k for coarse_k in coarse if coarse_k < k)
+            args_list.append((k, centers[start]))
+    if workers > 1 and len(args_list) > 1:
+        fits = parallel_map(fit_kmeans, data, args_list, workers)
+    else:
+        fits = [fit_kmeans(data, *args) for args in args_list]
+    for (k, _), (_, fit_inertia) in zip(args_list, fits):
+        inertia[k] = fit_inertia
+
+    ks = sorted(inertia)
+    curve = [inertia[k] for k in ks]
+    return {"ks": ks, "inertia": curve, "knee": knee(ks, curve)}
+
+def fit_kmeans(data, num_clusters, centers=None):
+    """Fits k-means with num_clusters clusters.
+
+    Args:
+        data: An np array where each row is a time series and each
+            column is a time.
+        num_clusters: The number of clusters.
+        centers: The centroids of a previous fit with fewer clusters
+            which the fit starts from, or None for a k-means++
+            initialization. The missing centroids are picked with the
+            k-means++ sampling and k-means is run once from them. As a
+            warm start may be stuck in a worse local minimum, a single
+            k-means++ initialization is run as well, instead of the
+            several ones of a fit without centers, and the better fit is
+            kept.
+
+    Returns:
+        A tuple (centers, inertia) with the centroids and the sum of
+        squared distances of samples to their cluster center.
+    """
+    if centers is None:
+        result = KMeans(n_clusters=num_clusters, random_state=0).fit(data)
+    else:
+        random_state = np.random.RandomState(num_clusters)
+        init = [center for center in centers]
+        distances = pairwise_distances(data, centers).min(axis=1) ** 2
+        while len(init) < num_clusters:
+            if not np.any(distances):
+                distances = np.ones(len(data))
+            picked = random_state.choice(len(data),
+                                         p=distances / np.sum(distances))
+            init.append(data[picked])
+            distances = np.minimum(distances, pairwise_distances(
+                data, [data[picked]])[:, 0] ** 2)
+        result = KMeans(n_clusters=num_clusters, init=np.array(init),
+                        n_init=1).fit(data)
+        seeded = KMeans(n_clusters=num_clusters, n_init=1,
+                        random_state=0).fit(data)
+        if seeded.inertia_ < result.inertia_:
+            result = seeded
+    return result.cluster_centers_, float(result.inertia_)
+
+def knee(ks, inertia):
+    """Returns the k at the knee of a decreasing convex inertia curve,
+    the point farthest below the line between its ends once both axes
+    are normalized to [0, 1] (Kneedle).
+
+    Args:
+        ks: The k in increasing order.
+        inertia: The inertia for each k.
+    """
+    ks, inertia = np.asarray(ks, dtype=float), np.asarray(inertia)
+    if len(ks) < 3 or np.ptp(inertia) == 0:
+        return int(ks[0]) if len(ks) else None
+    x = (ks - ks[0]) / (ks[-1] - ks[0])
+    y = (inertia - inertia.min()) / np.ptp(inertia)
+    return int(ks[np.argmax(1 - x - y)])
+
+def tuning_eps(data, index=None):
     """Runs nearest neighbors to identify the distance of the closest
     neighbor of each time series.
 
     Args:
         data: A timeSeries object.
+        index: A neighbors.NeighborIndex built on data. If None, one is
+            built.
 
     Returns:
         A sorted list of the distance of each time series to its
         closest neighbor.
     """
-    neighbors = NearestNeighbors(n_neighbors=2)
-    fitted = neighbors.fit(data)
-    distances, _ = fitted.kneighbors(data)
-    return (np.sort(distances[:, 1])).tolist()
+    if index is None:
+        index = neighbors.NeighborIndex(data)
+    distances, _ = index.kneighbors(1)
+    return (np.sort(distances[:, 0])).tolist()
 
-def tuning_eps_options(data, start, end, min_clusters):
+def tuning_eps_options(data, start, end, min_clusters, index=None):
     """Returns a list of tuples (num_outliers, num_clusters, eps) such
     that runing dbscan with each eps results in more than min_clusters.
     The options are sorted according to the number of oulliers produced.
@@ -197,53 +825,209 @@ def tuning_eps_options(data, start, end, min_clusters):
         end: Largest eps that is tested.
         min_clusters: The minimum number of clusters that should be
             produced by dbscan.
+        index: A neighbors.NeighborIndex built on data. If None, one is
+            built.
 
     Returns:
         A list of tuples where each tuple has num_outliers, num_clusters,
         and eps.
     """
+    # With min_samples=2 a time series is a core point as soon as it has
+    # a neighbor within eps, so there are no border points: the clusters
+    # are the connected components of the graph of the neighbors within
+    # eps and the outliers are the time series without a neighbor. The
+    # graph is computed once for the largest eps.
+    if index is None:
+        index = neighbors.NeighborIndex(data)
+    num_ts = data.shape[0]
+    graph = index.radius_graph(end).tocoo()
     ops = []
     while start <= end:
-        dbscan_result = DBSCAN(eps=start, min_samples=2).fit(data)
-        num_outliers = len(np.where(dbscan_result.labels_ == -1)[0])
-        num_clusters = len(np.unique(dbscan_result.labels_))
+        within = graph.data <= start
+        rows, cols = graph.row[within], graph.col[within]
+        num_components, _ = connected_components(
+            sparse.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                              shape=(num_ts, num_ts)), directed=False)
+        num_outliers = num_ts - len(np.unique(rows))
+        num_clusters = num_components - num_outliers + (num_outliers > 0)
         if num_clusters > min_clusters:
             ops.append((num_outliers, num_clusters, start))
         start += 0.1
     ops.sort()
     return ops
 
-def kmeans(data, outlier):
+def kmeans(data, outlier, init=None, return_scores=False):
     """Generates clusters using kmeans.
 
     Args:
         data: A timeSeries object.
-        outlier: Indicates whether outliers are labeled as outliers.
+        outlier: Indicates whether outliers are labeled as outliers, one
+            of OUTLIER_MODES.
+        init: The assignment of a previous clustering of the same time
+            series, see warm_start_centers. If it fits data, k-means is
+            run once from the centers of its clusters instead of from
+            random initializations.
+        return_scores: Whether the outlier scores are returned as well.
 
     Returns:
         A list of cluster labels such that the nth element in the list
         represents the cluster the nth element was placed in. Cluster
-        labels are integers.
+        labels are integers. If return_scores, a tuple of the labels
+        and the outlier scores of outliers_kmeans, None if outlier is
+        "off".
     """
-    data = scale(data)
-    tuning_ratio = len(data) // KMEANS_RATIO
-    kmeans_result = KMeans(n_clusters=tuning_ratio + KMEANS_MIN,
-                           random_state=0).fit(data)
+    data = scale_columns(data)
+    num_clusters = data.shape[0] // KMEANS_RATIO + KMEANS_MIN
+    centers = None
+    if init is not None:
+        centers = warm_start_centers(dense(data), init, num_clusters)
+    if centers is None:
+        kmeans_result = KMeans(n_clusters=num_clusters,
+                               random_state=0).fit(data)
+    else:
+        kmeans_result = KMeans(n_clusters=num_clusters, init=centers,
+                               n_init=1, random_state=0).fit(data)
     labels = np.copy(kmeans_result.labels_) + 1
-    if outlier == "on":
-        outliers_kmeans(data, labels, kmeans_result.cluster_centers_)
-    return labels
+    scores = None
+    if outlier != "off":
+        scores = outliers_kmeans(data, labels, kmeans_result.cluster_centers_,
+                                 outlier)
+    return (labels, scores) if return_scores else labels
+
+def mini_batch_kmeans(data, outlier, batch_size=MINI_BATCH_SIZE,
+                      return_scores=False):
+    """Generates clusters using mini-batch k-means, which updates the
+    centroids from random batches of the time series. It is faster and
+    uses less memory than kmeans on large charts, at the cost of a
+    slightly higher inertia.
+
+    Args:
+        data: A timeSeries object.
+        outlier: Indicates whether outliers are labeled as outliers, one
+            of OUTLIER_MODES.
+        batch_size: The number of time series in each batch.
+        return_scores: Whether the outlier scores are returned as well.
 
-def dbscan(data, similarity, encoding, outlier):
+    Returns:
+        The labels, or the labels and the outlier scores, as kmeans.
+    """
+    data = scale_columns(data)
+    tuning_ratio = data.shape[0] // KMEANS_RATIO
+    kmeans_result = MiniBatchKMeans(n_clusters=tuning_ratio + KMEANS_MIN,
+                                    batch_size=batch_size,
+                                    random_state=0).fit(data)
+    labels = np.copy(kmeans_result.labels_) + 1
+    scores = None
+    if outlier != "off":
+        scores = outliers_kmeans(data, labels, kmeans_result.cluster_centers_,
+                                 outlier)
+    return (labels, scores) if return_scores else labels
+
+def warm_start_centers(data, assignment, num_clusters, algorithm="k-means"):
+    """Returns the centers of the clusters of a previous assignment,
+    computed on the current data, to restart the clustering from them
+    when the time series got new points.
+
+    Args:
+        data: An np array where each row is a time series.
+        assignment: An array where the nth element is the cluster, from
+            0, the nth time series was placed in by the previous
+            clustering.
+        num_clusters: The number of clusters.
+        algorithm: "k-medians" for the cluster medians, otherwise the
+            cluster means are returned.
+
+    Returns:
+        An np array where the ith row is the center of the ith cluster,
+        or None if the assignment does not fit data, e.g. if time series
+        were added or a cluster is empty.
+    """
+    assignment = np.asarray(assignment)
+    if len(assignment) != data.shape[0] or np.any(assignment < 0) or \
+            np.any(assignment >= num_clusters):
+        return None
+    if algorithm == "k-medians":
+        centers, valid = cluster_medians(data, assignment)
+    else:
+        centers, valid = cluster_means(data, assignment, num_clusters)
+    if not valid or len(centers) != num_clusters:
+        return None
+    return centers
+
+def linkage_tree(data, method="ward"):
+    """Computes the linkage tree of agglomerative clustering, which
+    agglomerative cuts into any number of clusters. The tree needs the
+    distance between every pair of time series.
+
+    Args:
+        data: An np array or sparse matrix where each row is a time
+            series.
+        method: The linkage method, one of LINKAGES.
+
+    Returns:
+        The linkage matrix returned by scipy.cluster.hierarchy.linkage.
+
+    Raises:
+        ValueError: data has more than AGGLOMERATIVE_MAX_SERIES rows.
+    """
+    if data.shape[0] > AGGLOMERATIVE_MAX_SERIES:
+        raise ValueError("Too many time series for agglomerative clustering")
+    return linkage(dense(scale_columns(data)), method=method,
+                   metric="euclidean")
+
+def agglomerative(tree, outlier, load, num_clusters=None, threshold=None,
+                  return_scores=False):
+    """Generates clusters by cutting the linkage tree of data, which only
+    needs the data to score the outliers.
+
+    Args:
+        tree: The linkage tree returned by linkage_tree.
+        outlier: Indicates whether outliers are labeled as outliers, one
+            of OUTLIER_MODES.
+        load: A function returning the np array or sparse matrix the tree
+            was computed on, only called when outlier is not "off".
+        num_clusters: The number of clusters. If None, the number of
+            clusters of kmeans is used.
+        threshold: If not None, the tree is cut at this distance instead
+            of into num_clusters clusters.
+        return_scores: Whether the outlier scores are returned as well.
+
+    Returns:
+        The labels, or the labels and the outlier scores, as kmeans.
+    """
+    if threshold is not None:
+        labels = fcluster(tree, threshold, criterion="distance")
+    else:
+        if num_clusters is None:
+            # A tree of n time series has n - 1 merges.
+            num_clusters = (len(tree) + 1) // KMEANS_RATIO + KMEANS_MIN
+        labels = fcluster(tree, num_clusters, criterion="maxclust")
+    labels = labels.astype(int)
+    scores = None
+    if outlier != "off":
+        scaled = dense(scale_columns(load()))
+        centers, _ = cluster_means(scaled, labels - 1, labels.max())
+        scores = outliers_kmeans(scaled, labels, centers, outlier)
+    return (labels, scores) if return_scores else labels
+
+def dbscan(data, similarity, encoding, outlier, index=None, num_dates=None):
     """Generates clusters using DBSCAN.
 
     Args:
         data: A timeSeries object.
         similarity: The similarity measure used for scaling the data
-            before clustering. Must be "proximity" or "correlation".
+            before clustering. Must be "proximity", "correlation" or
+            "dtw".
         label_encoding: The method used for encoding the labels. Must
             be "none" or "one-hot".
-        outlier: Indicates whether outliers are labeled as outliers.
+        outlier: Indicates whether outliers are labeled as outliers. The
+            outliers are the noise points of DBSCAN for "on" and
+            "adaptive".
+        index: A neighbors.NeighborIndex built on data, whose radius
+            neighbor graph DBSCAN runs on. If None, one is built.
+            Unused for "dtw".
+        num_dates: For "dtw", the number of columns of data that are
+            dates, the other columns are encoded labels.
 
     Returns:
         A list of cluster labels such that the nth element in the list
@@ -254,21 +1038,41 @@ def dbscan(data, similarity, encoding, outlier):
         eps_tuned = EPS_CORRELATION_NONE
     elif similarity == "correlation" and encoding == "one-hot":
         eps_tuned = EPS_CORRELATION_ONE_HOT
+    elif similarity == "dtw" and encoding == "none":
+        eps_tuned = EPS_DTW_NONE
+    elif similarity == "dtw":
+        eps_tuned = EPS_DTW_ONE_HOT
     elif encoding == "none":
         eps_tuned = EPS_PROXIMITY_NONE
     else:
         eps_tuned = EPS_PROXOMITY_ONE_HOT
 
-    dbscan_result = DBSCAN(eps=eps_tuned, min_samples=2).fit(data)
+    if similarity == "dtw":
+        data = dense(data)
+        graph, _ = dtw.radius_graph(data, eps_tuned, num_dates,
+                                    dtw.window_size(num_dates))
+    else:
+        if index is None:
+            index = neighbors.NeighborIndex(data)
+        graph = index.radius_graph(eps_tuned)
+    dbscan_result = DBSCAN(eps=eps_tuned, min_samples=2,
+                           metric="precomputed").fit(graph)
     cluster_assignment = np.copy(dbscan_result.labels_)
-    medians, _ = cluster_medians(data, cluster_assignment)
+    medians, _ = cluster_medians(dense(data), cluster_assignment)
 
     outlier_indexes = np.where(cluster_assignment == -1)[0]
     cluster_assignment += 1
-    closest = pairwise_distances_argmin(data[outlier_indexes, :], medians)
+    if len(outlier_indexes) == 0:
+        return cluster_assignment
+    # There are few medians, the closest one is found by brute force.
+    if similarity == "dtw":
+        closest, _, _ = dtw.nearest(data[outlier_indexes, :], medians,
+                                    num_dates, dtw.window_size(num_dates))
+    else:
+        closest = pairwise_distances_argmin(data[outlier_indexes, :], medians)
 
     for index, index_ts in enumerate(outlier_indexes):
-        if outlier == "on":
+        if outlier != "off":
             cluster_assignment[index_ts] = - (closest[index] + 1)
         else:
             cluster_assignment[index_ts] = closest[index] + 1
@@ -288,49 +1092,59 @@ def cluster_medians(data, cluster_assignment):
         the nth element is the median of the nth cluster if valid==True,
         meaning there was a valid assignment, otherwise returns an empty
         list and False.    """
-    clusters = {}
-
-    for index in np.where(cluster_assignment >= 0)[0]:
-        label = cluster_assignment[index]
-        if label not in clusters:
-            clusters[label] = [data[index]]
-        else:
-            clusters[label] = np.append(clusters[label], [data[index]], axis=0)
-    medians = []
-    for i in range(len(clusters)):
-        if i not in clusters:
-            return [], False
-        medians.append(np.median(clusters[i], axis=0))
-    return np.array(medians), True
+    labels = cluster_assignment[cluster_assignment >= 0]
+    points = np.asarray(data)[cluster_assignment >= 0]
+    present, sizes = np.unique(labels, return_counts=True)
+    if len(present) == 0 or present[-1] != len(present) - 1:
+        return [], False
+
+    # Sorts each column by value, then by cluster with a stable sort, so
+    # that the values of each cluster are a sorted segment of the column.
+    # The columns are sorted as contiguous rows of the transposed data,
+    # and the small integer type of the labels allows a radix sort.
+    columns = np.ascontiguousarray(points.T)
+    by_value = np.argsort(columns, axis=1)
+    labels = labels.astype(np.min_scalar_type(present[-1]))
+    by_cluster = np.argsort(labels[by_value], axis=1, kind="stable")
+    sorted_columns = np.take_along_axis(
+        columns, np.take_along_axis(by_value, by_cluster, axis=1), axis=1)
+    starts = np.cumsum(sizes) - sizes
+    lower = sorted_columns[:, starts + (sizes - 1) // 2]
+    upper = sorted_columns[:, starts + sizes // 2]
+    return ((lower + upper) / 2).T, True
 
 def cluster_to_labels(cluster_labels, resource_to_label):
     """Returns a list of the percentage of elements in a cluster that
     share the same label.
 
+    The clusters are numbered in sorted order with np.unique, so the
+    labels of the clusters may be any integers, and the label counts of
+    all the clusters are a single product of a sparse cluster indicator
+    matrix with resource_to_label.
+
     Args:
         cluster_labels: An array where the ith element indicates what
             cluster the ith time series was assigned to.
-        resource_to_label: An array where entry [i][j] is a 0 if time
-            series i had the label with index j.
+        resource_to_label: An array or sparse matrix where entry [i][j]
+            is a 1 if time series i had the label with index j.
 
     Returns:
         A 2d list where each entry [i][j] represents the percentage of
-        time series in cluster i that have label j.
+        time series in the ith smallest cluster that have label j.
     """
-    cluster_count = {}
-    for label in cluster_labels:
-        if label not in cluster_count:
-            cluster_count[label] = 1
-        else:
-            cluster_count[label] += 1
-
-    ordered_cluster_count = sorted(cluster_count.items(), key=lambda x: x[0])
-    values = [x[1] for x in ordered_cluster_count]
-    cluster_to_label = np.zeros((len(cluster_count), len(resource_to_label[0])))
-
-    for index, element in enumerate(cluster_labels):
-        cluster_to_label[element] += resource_to_label[index]
-    return np.multiply(cluster_to_label.T, 1/np.array(values)).T
+    if not sparse.issparse(resource_to_label):
+        resource_to_label = np.asarray(resource_to_label)
+    clusters, inverse, values = np.unique(
+        cluster_labels, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+    # An integer indicator keeps integer labels from being converted to
+    # floats before the product.
+    indicator = sparse.csr_matrix(
+        (np.ones(len(inverse), dtype=np.int64),
+         (inverse, np.arange(len(inverse)))),
+        shape=(len(clusters), len(inverse)))
+    cluster_to_label = dense(indicator @ resource_to_label)
+    return np.multiply(cluster_to_label.T, 1/values).T
 
 def sort_labels(label_dict, cluster_labels, ts_to_labels):
     """Returns a list of the sorted labels, an np array of clusters to
@@ -343,24 +1157,23 @@ def sort_labels(label_dict, cluster_labels, ts_to_labels):
         label_dict: A dictionary where each key is a system label and
             each value is the index of the label in cluster_labels and
             ts_to_labels.
-        ts_to_labels: An array where each row is a time series and each
-            column is a label.
+        ts_to_labels: An array or sparse matrix where each row is a time
+            series and each column is a label.
     """
     system_labels = list(label_dict.keys())
-
     ordered = np.argsort(np.array(system_labels))
-    ordered_labels = [0]*len(system_labels)
-    ordered_ts_labels = np.zeros(ts_to_labels.shape)
-    ordered_cluster_labels = np.zeros(cluster_labels.shape)
-
-    for i, elt in enumerate(ordered):
-        ordered_ts_labels[:, i] = ts_to_labels[:, elt]
-        ordered_cluster_labels[:, i] = cluster_labels[:, elt]
-        ordered_labels[i] = system_labels[elt]
-
+    ordered_labels = [system_labels[index] for index in ordered]
+    if sparse.issparse(ts_to_labels):
+        ordered_ts_labels = ts_to_labels[:, ordered].astype(float)
+    else:
+        ordered_ts_labels = np.take(ts_to_labels, ordered,
+                                    axis=1).astype(float)
+    ordered_cluster_labels = np.take(np.asarray(cluster_labels, dtype=float),
+                                     ordered, axis=1)
     return ordered_labels, ordered_cluster_labels, ordered_ts_labels
 
-def outliers_kmeans(data, ts_cluster_labels, cluster_centers):
+def outliers_kmeans(data, ts_cluster_labels, cluster_centers, mode="on",
+                    distances=None):
     """Updates ts_cluster_labels to reflect whether a time series is an
     outlier in the cluster it was assigned to. '-n' indicates an outlier
     in cluster n.
@@ -372,124 +1185,387 @@ def outliers_kmeans(data, ts_cluster_labels, cluster_centers):
             the ith time series was placed in.
         cluster_centers: The centroids that were outputted when the
             clustering algorithm was run.
+        mode: "on" for the fixed OUTLIER_DISTANCE threshold or
+            "adaptive" for the threshold of each cluster, see
+            outlier_thresholds.
+        distances: The distance of each time series to its centroid, if
+            the clustering algorithm already computed them.
+
+    Returns:
+        An array with the score of each time series, its distance to its
+        centroid divided by the threshold. Outliers have a score above 1.
     """
-    for index, label in enumerate(ts_cluster_labels):
-        euc_dist = distance.euclidean(data[index], cluster_centers[label - 1])
-        if euc_dist > 6.75:
-            ts_cluster_labels[index] = -label
+    labels = np.asarray(ts_cluster_labels)
+    if distances is None:
+        centers = np.asarray(cluster_centers)[labels - 1]
+        distances = center_distances(data, centers)
+    thresholds = outlier_thresholds(distances, labels, mode)
+    for index in np.where(distances > thresholds)[0]:
+        ts_cluster_labels[index] = -ts_cluster_labels[index]
+    return distances / np.maximum(thresholds, np.finfo(np.float64).tiny)
+
+def outlier_thresholds(distances, labels, mode="on"):
+    """Returns the distance above which each time series is an outlier.
 
-def kmeans_kmedians(data, label_dict, ts_to_labels, algorithm, outlier):
+    Args:
+        distances: An array with the distance of each time series to the
+            center of its cluster.
+        labels: An array with the cluster of each time series.
+        mode: "on" for OUTLIER_DISTANCE, or "adaptive" for the median of
+            the distances in the cluster plus OUTLIER_MAD_FACTOR times
+            their median absolute deviation.
+    """
+    if mode != "adaptive":
+        return np.full(len(distances), OUTLIER_DISTANCE)
+    _, inverse = np.unique(labels, return_inverse=True)
+    inverse = inverse.ravel()
+    medians, _ = cluster_medians(distances[:, np.newaxis], inverse)
+    medians = medians[inverse, 0]
+    deviations, _ = cluster_medians(np.abs(distances - medians)[:, np.newaxis],
+                                    inverse)
+    return medians + OUTLIER_MAD_FACTOR * deviations[inverse, 0]
+
+def center_distances(data, centers):
+    """Returns the euclidean distance between each time series and its
+    center.
+
+    Args:
+        data: Array or sparse matrix where each row is a time series.
+        centers: Array where the ith row is the center of the ith time
+            series.
+    """
+    if sparse.issparse(data):
+        squared = (row_norms(data, squared=True) -
+                   2 * np.asarray(data.multiply(centers).sum(axis=1)).ravel() +
+                   row_norms(centers, squared=True))
+        return np.sqrt(np.maximum(squared, 0))
+    return np.linalg.norm(data - centers, axis=1)
+
+def kmeans_kmedians(data, label_dict, ts_to_labels, algorithm, outlier,
+                    workers=1, num_dates=None, init=None, return_scores=False):
     """Runs k-means with constraints or k-medians based on algorithm.
     Uses a k-means++ initialization.
 
     Args:
-        data: An np array where each row is a time series and each
-            column is a time.
+        data: An np array or sparse matrix where each row is a time
+            series and each column is a time.
         label_dict: A dictionary where the keys are labels and the
             values are the indexes of the labels in data.
         ts_to_labels: An array where each row is a timeSeries and each
             column is a label.
         algorithm: The algorithm run on data, must be k-means or k-medians.
-        outlier: Indicates whether outliers are labeled as outliers.
+        outlier: Indicates whether outliers are labeled as outliers, one
+            of OUTLIER_MODES.
+        workers: The number of processes the NUM_RUNS runs are spread
+            over. If 1, the runs are done in this process. The result
+            does not depend on workers.
+        num_dates: If not None, the time series are compared with DTW
+            over the first num_dates columns of data, the other columns
+            are encoded labels.
+        init: The assignment of a previous clustering of the same time
+            series, see warm_start_centers. If it fits data, a single
+            run starts from the centers of its clusters.
+        return_scores: Whether the outlier scores are returned as well.
 
     Returns:
         An np array where the ith element is the cluster the ith time
-        series was placed in.
+        series was placed in. If return_scores, a tuple of the labels
+        and the outlier scores of outliers_kmeans, None if outlier is
+        "off".
     """
+    data = dense(data)
     must_link, can_not_link = {}, {}
     if algorithm == "k-means-constrained":
         must_link, can_not_link = make_constraints(ts_to_labels)
     num_clusters = (len(data) // KMEANS_RATIO) + KMEANS_MIN
-    clusters_distances = []
+    points, weights, components = data, None, None
+    if must_link:
+        # The runs cluster one weighted super-point per group of time
+        # series that must link.
+        points, weights, components, can_not_link = collapse_constraints(
+            data, must_link, can_not_link)
+        must_link = {}
+    args = num_clusters, algorithm, must_link, can_not_link, num_dates
+
+    num_runs = NUM_RUNS if num_dates is None else DTW_NUM_RUNS
+    runs = []
+    if init is not None:
+        centroids = warm_start_centers(data, init, num_clusters, algorithm)
+        if centroids is not None:
+            runs = [kmeans_kmedians_run(points, 0, *args, centroids, weights)]
+    if not runs or runs[0] is None:
+        # There is no warm start, or it lost a cluster.
+        if workers > 1:
+            runs = parallel_map(
+                kmeans_kmedians_run, points,
+                [(run_num,) + args + (None, weights)
+                 for run_num in range(num_runs)], workers)
+        else:
+            runs = (kmeans_kmedians_run(points, run_num, *args, None, weights)
+                    for run_num in range(num_runs))
+    best = None
+    for run in runs:
+        if run is not None and (best is None or run[0] < best[0]):
+            best = run
+    if best is None and num_dates is not None:
+        # Every DTW run lost a cluster, the euclidean or manhattan
+        # distance is used instead.
+        return kmeans_kmedians(data, label_dict, ts_to_labels, algorithm,
+                               outlier, workers, None, init, return_scores)
+    if best is None:
+        raise ValueError("Every run of %s lost a cluster" % algorithm)
+
+    assignment = best[1] if components is None else best[1][components]
+    result = assignment + 1
+    scores = None
+    if outlier != "off":
+        # The distances of the run are reused when they are the
+        # euclidean distances of the time series.
+        distances = None
+        if components is None and num_dates is None and \
+                algorithm == "k-means-constrained":
+            distances = best[3]
+        scores = outliers_kmeans(data, result, best[2], outlier, distances)
+    return (result, scores) if return_scores else result
+
+def kmeans_kmedians_run(data, run_num, num_clusters, algorithm, must_link,
+                        can_not_link, num_dates=None, centroids=None,
+                        weights=None):
+    """Runs one initialization of kmeans_kmedians.
 
-    for run_num in range(NUM_RUNS):
-        centroids = k_means_init(data, num_clusters, run_num)
+    Args:
+        data: An np array where each row is a time series and each
+            column is a time.
+        run_num: The number of the run, used as the seed of the
+            initialization.
+        num_clusters: The number of clusters.
+        algorithm: The algorithm run on data, must be k-means-constrained
+            or k-medians.
+        must_link: A dictionary mapping time series that must link.
+        can_not_link: A dictionary mapping time series that can't link.
+        num_dates: If not None, the number of columns of data compared
+            with DTW, see kmeans_kmedians.
+        centroids: The initial centroids. If None, they are picked by
+            k_means_init.
+        weights: The number of time series each row of data stands for,
+            see collapse_constraints. If None, each row is one time
+            series.
 
-        while True:
-            old_centroids = centroids.copy()
-
-            clusters, ts_to_cluster = update_clusters(data, centroids,
-                                                      must_link, can_not_link)
-            if algorithm == "k-means-constrained":
-                valid_clusters = update_centroids(data, clusters, centroids)
-            if algorithm == "k-medians":
-                ts_cluster_ar = np.array([v for k, v in sorted(
-                    ts_to_cluster.items(), key=lambda item: item[0])])
-                centroids, valid_clusters = cluster_medians(data, ts_cluster_ar)
-            if not valid_clusters:
-                break
+    Returns:
+        A tuple (center_dist, assignment, centroids, distances) where
+        distances has the distance of each row of data to its centroid
+        and center_dist is their sum weighted by weights, or None if a
+        cluster is still empty after it was reseeded. k-medians uses the
+        manhattan distance and k-means-constrained the euclidean one, and
+        their centroids are the means or the medians of their time
+        series. If num_dates is given, both use DTW and the centroids are
+        the medoids of the clusters, see dtw.medoids.
+    """
+    if num_dates is not None:
+        metric = "dtw"
+    elif algorithm == "k-medians":
+        metric = "manhattan"
+    else:
+        metric = "euclidean"
+    tolerance = CONVERGENCE_TOL * np.mean(np.var(data, axis=0))
+    if centroids is None:
+        centroids = k_means_init(data, num_clusters, run_num)
 
-            if np.array_equal(old_centroids, centroids):
-                assignment = [v for k, v in sorted(ts_to_cluster.items(),
-                                                   key=lambda item: item[0])]
-                center_dist = 0
-                for index, cluster in enumerate(assignment):
-                    center_dist += distance.euclidean(data[index],
-                                                      centroids[cluster])
-                clusters_distances.append([center_dist, assignment, centroids])
-                break
+    for _ in range(MAX_ITERATIONS):
+        assignment = assign_clusters(data, centroids, must_link, can_not_link,
+                                     metric, num_dates)
+        empty = np.flatnonzero(np.bincount(assignment,
+                                           minlength=num_clusters) == 0)
+        if len(empty):
+            # Each empty cluster is reseeded with one of the time series
+            # farthest from their centroid. The medians of DTW clusters
+            # often lose a cluster this way.
+            distances = row_distances(data, centroids[assignment], metric,
+                                      num_dates)
+            farthest = np.argsort(-distances, kind="stable")[:len(empty)]
+            centroids = np.copy(centroids)
+            centroids[empty[:len(farthest)]] = data[farthest]
+            assignment = assign_clusters(data, centroids, must_link,
+                                         can_not_link, metric, num_dates)
+        if metric == "dtw":
+            valid_clusters = np.all(np.bincount(
+                assignment, minlength=num_clusters) > 0)
+            new_centroids = centroids
+            if valid_clusters:
+                new_centroids = data[dtw.medoids(
+                    data, assignment, num_clusters, num_dates,
+                    dtw.window_size(num_dates), weights)]
+        elif algorithm == "k-means-constrained":
+            new_centroids, valid_clusters = cluster_means(data, assignment,
+                                                          num_clusters,
+                                                          weights)
+        elif algorithm == "k-medians":
+            new_centroids, valid_clusters = cluster_medians(data, assignment)
+        if not valid_clusters or len(new_centroids) != num_clusters:
+            return None
+        shift = np.sum((new_centroids - centroids) ** 2)
+        centroids = new_centroids
+        if shift <= tolerance:
+            break
+
+    distances = row_distances(data, centroids[assignment], metric, num_dates)
+    if weights is None:
+        center_dist = np.sum(distances)
+    else:
+        center_dist = np.sum(distances * weights)
+    return center_dist, assignment, centroids, distances
+
+def row_distances(data, centers, metric, num_dates=None):
+    """Returns the distance between each row of data and the same row of
+    centers for the metric of kmeans_kmedians_run."""
+    if metric == "dtw":
+        return dtw.distances(data, centers, num_dates,
+                             dtw.window_size(num_dates))
+    if metric == "manhattan":
+        return np.sum(np.abs(data - centers), axis=1)
+    return np.linalg.norm(data - centers, axis=1)
+
+_executor = None
+_executor_workers = 0
+_executor_lock = threading.Lock()
+
+def parallel_map(function, data, args_list, workers):
+    """Calls function(data, *args) for each args of args_list in a pool
+    of worker processes. The data is passed to the workers through
+    shared memory instead of being pickled for each call.
 
-    clusters_distances.sort()
-    result = np.array(clusters_distances[0][1]) + 1
-    if outlier == "on":
-        outliers_kmeans(data, result, clusters_distances[0][2])
-    return result
+    Args:
+        function: A module level function.
+        data: An np array.
+        args_list: A list of tuples of the other arguments of function.
+        workers: The number of worker processes.
 
-def update_clusters(data, centroids, must_link, can_not_link):
-    """Updates the cluster assignments based on the centroids and the
-    must_link and can_not_link constraints. Assigns each time series
-    to the closest centroid which does not violate the constraints.
+    Returns:
+        A list with the result of each call, in the order of args_list.
+    """
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is None or _executor_workers != workers:
+            if _executor is not None:
+                _executor.shutdown()
+            _executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context(PARALLEL_START_METHOD))
+            _executor_workers = workers
+        executor = _executor
+
+    memory = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+    shared = np.ndarray(data.shape, dtype=data.dtype, buffer=memory.buf)
+    try:
+        shared[:] = data
+        futures = [executor.submit(_shared_call, function, memory.name,
+                                   data.shape, data.dtype, args)
+                   for args in args_list]
+        return [future.result() for future in futures]
+    except BrokenProcessPool:
+        # A worker died, the next call starts a new pool.
+        with _executor_lock:
+            if _executor is executor:
+                executor.shutdown(wait=False)
+                _executor = None
+        raise
+    finally:
+        del shared
+        memory.close()
+        memory.unlink()
+
+def _shared_call(function, name, shape, dtype, args):
+    """Calls function in a worker on the data in the shared memory block
+    name."""
+    memory = shared_memory.SharedMemory(name=name)
+    data = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+    try:
+        return function(data, *args)
+    finally:
+        del data
+        memory.close()
+
+def assign_clusters(data, centroids, must_link, can_not_link,
+                    metric="euclidean", num_dates=None):
+    """Assigns each time series to the closest centroid which does not
+    violate the must_link and can_not_link constraints.
+
+    Time series without constraints are placed in their closest centroid
+    at once. The constrained time series are placed in order of their
+    index, each in the closest centroid that does not violate a
+    constraint with the time series placed before it, or in the closest
+    centroid if every centroid violates a constraint.
 
     Args:
         data: An np array where each row is a time series and each
             column is a time.
-        centroids: A list of the centroids.
+        centroids: An np array where the ith row is the ith centroid.
         must_link: A dictionary mapping time series that must link.
         can_not_link: A dictionary mapping time series that can't link.
+        metric: The distance between the time series and the centroids,
+            "euclidean", "manhattan" or "dtw".
+        num_dates: For "dtw", the number of columns of data that are
+            dates, the other columns are encoded labels.
 
     Returns:
-        clusters: A list where the ith element is a list of the indexes
-            of the elements in the ith cluster.
-        ts_to_cluster: A dictionary mapping each time series to its
-            cluster assignment.
+        An np array where the ith element is the cluster the ith time
+        series was placed in.
     """
-    distances_ts_to_cluster = pairwise_distances(data, centroids)
-    clusters = [[] for i in range(len(centroids))]
+    constrained = sorted(must_link.keys() | can_not_link.keys())
+    if metric == "dtw":
+        # Only the constrained time series need the distance to every
+        # centroid, the others only need the closest one.
+        window = dtw.window_size(num_dates)
+        assignment, _, _ = dtw.nearest(data, centroids, num_dates, window)
+        num_centroids = len(centroids)
+        distances = np.zeros((len(data), num_centroids))
+        rows = np.repeat(constrained, num_centroids).astype(np.intp)
+        cols = np.tile(np.arange(num_centroids), len(constrained))
+        distances[rows, cols] = dtw.distances(data, centroids, num_dates,
+                                              window, rows, cols)
+    else:
+        distances = pairwise_distances(data, centroids, metric=metric)
+        assignment = np.argmin(distances, axis=1)
     ts_to_cluster = {}
-
-    for ts_index, dist in enumerate(distances_ts_to_cluster):
-        options = np.argsort(dist)
+    for ts_index in constrained:
+        options = np.argsort(distances[ts_index], kind="stable")
         for option in options:
-            invalid = violates_cons(option, ts_index, ts_to_cluster,
-                                    must_link, can_not_link)
-            if not invalid:
-                ts_to_cluster[ts_index] = option
-                clusters[option].append(ts_index)
+            if not violates_cons(option, ts_index, ts_to_cluster, must_link,
+                                 can_not_link):
+                assignment[ts_index] = option
                 break
-    return clusters, ts_to_cluster
+        ts_to_cluster[ts_index] = assignment[ts_index]
+    return assignment
 
-def update_centroids(data, clusters, centroids):
-    """Updates the centroids based on the elements in each cluster.
+def cluster_means(data, assignment, num_clusters, weights=None):
+    """Calculates the cluster means based on the assignment.
 
     Args:
         data: An np array where each row is a time series and each
             column is a time.
-        clusters: A list where the ith element is a list of the indexes
-            of the elements in the ith cluster.
-        centroids: A list of the centroids.
+        assignment: An array where the nth element is the cluster the
+            nth time series was placed in.
+        num_clusters: The number of clusters.
+        weights: An array with the weight of each row of data, e.g. the
+            number of time series it stands for. If None, every row has
+            a weight of 1.
 
     Returns:
-        True if the centroids were updated without an error, False
-        otherwise.
+        A tuple (means, valid) where means is an array where the nth row
+        is the mean of the nth cluster if valid==True, meaning no
+        cluster is empty, otherwise returns an empty list and False.
     """
-    for cluster_ind, _ in enumerate(centroids):
-        if len(clusters[cluster_ind]) == 0:
-            return False
-        total = np.zeros((centroids.shape[1]))
-        for ts_index in clusters[cluster_ind]:
-            total += data[ts_index]
-        centroids[cluster_ind] = total / len(clusters[cluster_ind])
-    return True
+    sizes = np.bincount(assignment, minlength=num_clusters)
+    if np.any(sizes == 0):
+        return [], False
+    totals = np.zeros((num_clusters, data.shape[1]))
+    if weights is None:
+        np.add.at(totals, assignment, data)
+    else:
+        np.add.at(totals, assignment, data * weights[:, np.newaxis])
+        sizes = np.bincount(assignment, weights, minlength=num_clusters)
+    means = totals / sizes[:, np.newaxis]
+    return means.astype(data.dtype, copy=False), True
 
 def k_means_init(data, num_clusters, run_num):
     """Runs k-means++ initialization which aims to spread out the
@@ -508,14 +1584,20 @@ def k_means_init(data, num_clusters, run_num):
     np.random.seed(run_num)
     num_ts = len(data)
     first = int(num_ts * .2)
-    centroids = np.array([data[first]])
+    centroids = [data[first]]
+    # The distance of each time series to its closest centroid, updated
+    # with each new centroid.
+    distances = pairwise_distances(data, [data[first]])[:, 0]
 
     for _ in range(num_clusters -1):
-        _, distances = pairwise_distances_argmin_min(data, centroids)
+        # np.random.choice checks that p sums to 1 with float64 precision.
+        distances = distances.astype(np.float64)
         choices = np.random.choice(num_ts, 1, p=distances/np.sum(distances))
         picked = choices[0]
-        centroids = np.append(centroids, [data[picked]], axis=0)
-    return centroids
+        centroids.append(data[picked])
+        distances = np.minimum(distances,
+                               pairwise_distances(data, [data[picked]])[:, 0])
+    return np.array(centroids)
 
 def violates_cons(option, ts_1, ts_to_cluster, must_link, can_not_link):
     """Checks if any constraint is violated by placing ts_1 in the
@@ -554,8 +1636,8 @@ def make_constraints(ts_to_labels):
     constraints based on the label similarity of the time series.
 
     Args:
-        ts_to_labels: An array where each row is a time series and each
-            column is a label.
+        ts_to_labels: An array or sparse matrix where each row is a time
+            series and each column is a label.
 
     Returns:
         must_link: A dictionary mapping time series that must link.
@@ -565,13 +1647,15 @@ def make_constraints(ts_to_labels):
     np.random.seed(0)
     must_link, can_not_link = {}, {}
 
-    limit = len(ts_to_labels) * .03
-    unique_label_patterns = np.unique(ts_to_labels, axis=0)
+    limit = ts_to_labels.shape[0] * .03
+    if sparse.issparse(ts_to_labels):
+        pattern_rows = sparse_label_patterns(ts_to_labels)
+    else:
+        pattern_rows = dense_label_patterns(ts_to_labels)
     pattern_to_rows = {}
     greater_than_limit = []
 
-    for index, row in enumerate(unique_label_patterns):
-        ts_indexes = np.where(np.all(ts_to_labels == row, axis=1))[0]
+    for index, ts_indexes in enumerate(pattern_rows):
         pattern_to_rows[index] = ts_indexes
         if len(ts_indexes) > limit:
             greater_than_limit.append(index)
@@ -587,6 +1671,104 @@ def make_constraints(ts_to_labels):
 
     return must_link, can_not_link
 
+def dense_label_patterns(ts_to_labels):
+    """Groups the time series by their label pattern in a single pass.
+
+    Args:
+        ts_to_labels: An array where each row is a time series and each
+            column is a label.
+
+    Returns:
+        A list with an array of the time series indexes of each unique
+        label pattern, in the order np.unique sorts the rows, and with
+        the indexes in increasing order.
+    """
+    _, inverse, sizes = np.unique(ts_to_labels, axis=0, return_inverse=True,
+                                  return_counts=True)
+    by_pattern = np.argsort(inverse.ravel(), kind="stable")
+    return np.split(by_pattern, np.cumsum(sizes)[:-1])
+
+def must_link_components(must_link, num_ts):
+    """Finds the groups of time series that must end up in the same
+    cluster, the connected components of the must link constraints,
+    with a union-find.
+
+    Args:
+        must_link: A dictionary mapping time series that must link.
+        num_ts: The number of time series.
+
+    Returns:
+        An array where the ith element is the component of the ith time
+        series. The components are numbered in the order of their first
+        time series.
+    """
+    parent = list(range(num_ts))
+
+    def find(index):
+        while parent[index] != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+    for ts_1, linked in must_link.items():
+        for ts_2 in linked:
+            root_1, root_2 = find(ts_1), find(ts_2)
+            # The smallest index of a component is its root.
+            parent[max(root_1, root_2)] = min(root_1, root_2)
+    roots = [find(index) for index in range(num_ts)]
+    return np.unique(roots, return_inverse=True)[1].ravel()
+
+def collapse_constraints(data, must_link, can_not_link):
+    """Replaces each group of time series that must link by one weighted
+    super-point, the mean of the group, so that the must link
+    constraints hold by construction.
+
+    Args:
+        data: An np array where each row is a time series.
+        must_link: A dictionary mapping time series that must link.
+        can_not_link: A dictionary mapping time series that can't link.
+
+    Returns:
+        A tuple (points, weights, components, can_not_link) where points
+        has a row per super-point, weights is the number of time series
+        of each super-point, components[i] is the super-point of the ith
+        time series and can_not_link maps the super-points that can't
+        link. Can not link constraints within a super-point are dropped.
+    """
+    components = must_link_components(must_link, len(data))
+    num_points = components.max() + 1 if len(components) else 0
+    points, _ = cluster_means(data, components, num_points)
+    weights = np.bincount(components, minlength=num_points).astype(float)
+    point_can_not_link = {}
+    for ts_1, linked in can_not_link.items():
+        for ts_2 in linked:
+            point_1, point_2 = int(components[ts_1]), int(components[ts_2])
+            if point_1 != point_2 and point_2 not in point_can_not_link.get(
+                    point_1, ()):
+                add_link(point_1, point_2, point_can_not_link)
+    return (np.asarray(points, dtype=data.dtype), weights, components,
+            point_can_not_link)
+
+def sparse_label_patterns(ts_to_labels):
+    """Groups the time series by their label pattern.
+
+    Args:
+        ts_to_labels: A sparse CSR matrix with sorted indices where each
+            row is a time series and each column is a label.
+
+    Returns:
+        A list with an array of the time series indexes of each unique
+        label pattern, in the order np.unique sorts the dense rows.
+    """
+    patterns = {}
+    for index in range(ts_to_labels.shape[0]):
+        start, end = ts_to_labels.indptr[index], ts_to_labels.indptr[index + 1]
+        patterns.setdefault(tuple(ts_to_labels.indices[start:end]),
+                            []).append(index)
+    # Of two dense rows, the greater one is the one that has the first
+    # label they do not share, which is the order of the negated indices.
+    ordered = sorted(patterns, key=lambda pattern: [-col for col in pattern])
+    return [np.array(patterns[pattern]) for pattern in ordered]
+
 def add_link(index_1, index_2, link_dict):
     """Adds a link from index_1 to index_2 and index_2 to index_1.
 
@@ -613,69 +1795,95 @@ def cluster_zone(label_dict, ts_to_labels):
         label_dict: A dictionary where each key is a system label and
             each value is the index of the label (column) in
             ts_to_labels. All keys are zone keys.
-        ts_to_labels: An array where each row is a time series and each
-            column is a label.
+        ts_to_labels: An array or sparse matrix where each row is a time
+            series and each column is a label.
 
     Returns:
         A list where the ith entry is the name of the cluster the ith
         time series was placed in."""
     index_to_label = dict((v, k) for k, v in label_dict.items())
     labels = [0] * ts_to_labels.shape[0]
-    zone_label = np.argwhere(ts_to_labels)
-    for ts_index, zone_index in zone_label:
+    for ts_index, zone_index in zip(*ts_to_labels.nonzero()):
         labels[ts_index] = index_to_label[zone_index]
     return labels
 
-def clusters_min_max(data, assignment, date_to_index, old_range, outlier):
+def clusters_min_max(data, assignment, date_to_index, old_range, outlier,
+                     statistics=False):
     """Calculates the min and max value at each point for each cluster.
 
+    The time series are sorted by cluster once, and the values of each
+    cluster are reduced at once with fmin and fmax, which skip the
+    missing values.
+
     Args:
         data: Array where each row is a time series and each column is
-            a date.
+            a date. Missing values are NaN or -1.
         assignment: Array where the ith element is the cluster the ith
             time series was placed in.
         date_to_index: A dictionary mapping each date to its index.
         old_range: The original range for the values in data.
-        outlier: Whether outliers are identified, must be "on" or "off".
+        outlier: Whether outliers are identified, one of OUTLIER_MODES.
+        statistics: Whether the BAND_STATISTICS of each cluster are
+            returned as well.
 
     Returns:
-        A tuple of the fomrat (min_max, dates) where min_max[i] has a
-        list of the minimum and maximum values of time series i and
-        dates has the corresponding dates for the given values.
+        A tuple of the fomrat (min_max, dates, outlier_indexes) where
+        min_max[i] has a list of the minimum and maximum values of
+        cluster i + 1, dates has the corresponding dates for the given
+        values and outlier_indexes the time series left out of the
+        clusters. If statistics, the tuple also has a dictionary mapping
+        each of BAND_STATISTICS to a list with the values of each cluster
+        at each date. Points where a cluster has no value are
+        old_range[0].
     """
     sorted_dates = sorted(date_to_index.items(), key=lambda x: x[1])
     dates = [date for date, index in sorted_dates]
 
-    # Rescales num to its original scale, otheriwse returns nan.
-    def original_scale(num):
-        if num != -1:
-            return scale_to_range([0, 10], num, old_range)
-        return np.nan
-
-    clusters, outlier_indexes = {}, []
-    # Each iteration rescales the time series at index to its original scale
-    # and appends it to the list of time series for the cluster. If 
-    # outlier == "on" then the time series is not appended to the list of time
-    # series for that cluster, instead, the c;uster index is added to the list
-    # of outlier_indexes
-    for index, label in enumerate(assignment):
-        if outlier == "off" or label > 0:
-            abs_label = abs(label)
-            time_series = np.array(list(map(original_scale, data[index])))
-            if abs_label not in clusters:
-                clusters[abs_label] = np.expand_dims(time_series, axis=0)
-            else:
-                clusters[abs_label] = np.append(clusters[abs_label],
-                                                [time_series], axis=0)
-        else:
-            outlier_indexes.append(index)
+    # Rescales the data to its original scale, missing values are nan.
+    rescaled = scale_to_range([0, 10], data, old_range)
+    rescaled[data == -1] = np.nan
+
+    # If outliers are identified, they are left out of the clusters and
+    # their indexes are returned instead.
+    assignment = np.asarray(assignment)
+    kept = np.ones(len(assignment), dtype=bool)
+    if outlier != "off":
+        kept = assignment > 0
+    outlier_indexes = np.where(~kept)[0].tolist()
+    labels = np.abs(assignment[kept])
+    band_stats = {name: [] for name in BAND_STATISTICS}
+    if len(labels) == 0:
+        if statistics:
+            return [], dates, outlier_indexes, band_stats
+        return [], dates, outlier_indexes
+
+    order = np.argsort(labels, kind="stable")
+    labels = labels[order]
+    rows = rescaled[np.where(kept)[0][order]]
+    starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+    clusters = labels[starts] - 1
 
     entries = data.shape[1]
-    min_max = np.full((max(clusters.keys()), 2, entries), old_range[0])
-    for label in clusters:
-        for col in range(entries):
-            if not np.all(np.isnan(np.array(clusters[label])[:, col])):
-                min_max[label -1][0][col] = np.nanmin(clusters[label][:, col])
-                min_max[label -1][1][col] = np.nanmax(clusters[label][:, col])
-
-    return min_max.tolist(), dates, outlier_indexes
+    min_max = np.full((labels[-1], 2, entries), np.nan)
+    min_max[clusters, 0] = np.fmin.reduceat(rows, starts, axis=0)
+    min_max[clusters, 1] = np.fmax.reduceat(rows, starts, axis=0)
+    min_max[np.isnan(min_max)] = old_range[0]
+    if not statistics:
+        return min_max.tolist(), dates, outlier_indexes
+
+    values = np.full((len(BAND_STATISTICS), labels[-1], entries), np.nan)
+    missing = np.isnan(rows)
+    sums = np.add.reduceat(np.where(missing, 0, rows), starts, axis=0)
+    counts = np.add.reduceat(~missing, starts, axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        values[-1, clusters] = sums / counts
+    # The percentiles need the values of each cluster sorted, which is
+    # done for each cluster rather than for each date.
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        for cluster, group in zip(clusters, np.split(rows, starts[1:])):
+            values[:-1, cluster] = np.nanpercentile(
+                group, BAND_PERCENTILES, axis=0)
+    values[np.isnan(values)] = old_range[0]
+    band_stats = dict(zip(BAND_STATISTICS, values.tolist()))
+    return min_max.tolist(), dates, outlier_indexes, band_stats
@@ -0,0 +1,125 @@
+"""This module reads and writes charts in a compact columnar format.
+
+A chart is stored as a directory with:
+    values.npy: The scaled value matrix where each row is a time series
+        and each column is a date, missing values are NaN. It is
+        memory-mapped when loaded.
+    label_indptr.npy, label_indices.npy: The label matrix for all label
+        values, in compressed sparse row form.
+    meta.json: The dates of the columns, the original range of the
+        values, the label dictionary and the labels of each time series.
+"""
+import json
+import os
+import numpy as np
+import count
+
+FORMAT_VERSION = 2
+
+class UnsupportedVersionError(ValueError):
+    """Raised for a chart written in another version of the format."""
+
+class ColumnarChart:
+    """A chart loaded from the columnar format.
+
+    Attributes:
+        values: Memory-mapped array where each row is a time series and
+            each column is a date.
+        date_to_index: A dictionary mapping each date to its column.
+        min_max: Original range of the values, [min, max].
+        label_to_index: A dictionary mapping each label kept when no key
+            is selected to its index.
+        series_labels: A list with the [metric labels, resource labels]
+            dictionaries of each time series.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json"), "r") as meta_file:
+            meta = json.load(meta_file)
+        if meta["version"] != FORMAT_VERSION:
+            raise UnsupportedVersionError(
+                "Unsupported columnar format version: " +
+                str(meta["version"]))
+        self.path = path
+        self.values = np.load(os.path.join(path, "values.npy"), mmap_mode="r")
+        self.date_to_index = {date: index for index, date in
+                              enumerate(meta["dates"])}
+        self.min_max = meta["min_max"]
+        self.label_to_index = {label: index for index, label in
+                               enumerate(meta["labels"])}
+        self.series_labels = meta["series_labels"]
+        self._label_indptr = np.load(os.path.join(path, "label_indptr.npy"))
+        self._label_indices = np.load(os.path.join(path, "label_indices.npy"))
+
+    def time_series_array(self, key, dtype=np.float64, missing=np.nan):
+        """Returns the same tuple as clustering.time_series_array without
+        reading the value matrix into memory.
+
+        Args:
+            key: The key for the time series labels that are saved. If
+                None, then all label values may be kept, otherwise only
+                label values with that key are kept.
+            dtype: The float type of the data array. The values are
+                stored as float64, other types are read into memory.
+            missing: The value of missing points. Values other than NaN
+                are read into memory.
+        """
+        num_instances = len(self.series_labels)
+        if not key:
+            label_to_index = self.label_to_index
+            rows = np.repeat(np.arange(num_instances),
+                             np.diff(self._label_indptr))
+            instance_labels = count.label_matrix(
+                rows, self._label_indices, (num_instances, len(label_to_index)))
+        else:
+            label_to_count = {}
+            for metric_labels, resource_labels in self.series_labels:
+                count.count_labels(metric_labels, label_to_count, key)
+                count.count_labels(resource_labels, label_to_count, key)
+            labels = count.select_labels(label_to_count, num_instances, key)
+            label_to_index = dict(zip(labels, range(len(labels))))
+            instance_labels = count.encode_labels(
+                [list(metric_labels.values()) + list(resource_labels.values())
+                 for metric_labels, resource_labels in self.series_labels],
+                label_to_index)
+        values = self.values
+        if not np.isnan(missing):
+            values = np.where(np.isnan(values), missing, values)
+        if values.dtype != dtype:
+            values = values.astype(dtype)
+        return (values, label_to_index, instance_labels, self.date_to_index,
+                self.min_max)
+
+def write(path, arrays, series_labels):
+    """Writes a chart in the columnar format.
+
+    Args:
+        path: The directory the chart is written to.
+        arrays: The tuple returned by clustering.time_series_array when
+            no key is selected, with NaN for missing values. The label
+            matrix may be dense or sparse.
+        series_labels: A list with the [metric labels, resource labels]
+            dictionaries of each time series.
+    """
+    data, label_to_index, instance_labels, date_to_index, min_max = arrays
+    os.makedirs(path, exist_ok=True)
+    meta_path = os.path.join(path, "meta.json")
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    np.save(os.path.join(path, "values.npy"),
+            np.ascontiguousarray(data, dtype=np.float64))
+    rows, cols = instance_labels.nonzero()
+    indptr = np.zeros(len(data) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=len(data)), out=indptr[1:])
+    np.save(os.path.join(path, "label_indptr.npy"), indptr)
+    np.save(os.path.join(path, "label_indices.npy"), cols.astype(np.int64))
+
+    # meta.json is written last, so a partially written chart is never
+    # picked up by the loader.
+    meta = {"version": FORMAT_VERSION,
+            "dates": sorted(date_to_index, key=date_to_index.get),
+            "min_max": min_max,
+            "labels": sorted(label_to_index, key=label_to_index.get),
+            "series_labels": series_labels}
+    with open(meta_path, "w") as meta_file:
+        json.dump(meta, meta_file)
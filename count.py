@@ -1,5 +1,11 @@
 """This module contains functions for counting elements: dates, labels.
 """
+import numpy as np
+from scipy import sparse
+
+# Label matrices with a smaller fraction of ones than this are stored as
+# sparse CSR matrices instead of dense arrays.
+SPARSE_LABEL_DENSITY = 0.05
 
 def one_hot_encoding(ts_labels, label_to_index, labels_encoded):
     """Updates labels_encoded based on ts_labels.
@@ -63,3 +69,65 @@ def get_dates_labels(data, date_to_index, label_to_count, min_max, key):
 
         count_labels(time_series["metric"]["labels"], label_to_count, key)
         count_labels(time_series["resource"]["labels"], label_to_count, key)
+
+def select_labels(label_to_count, num_instances, key):
+    """Returns the labels that are kept for encoding.
+
+    Args:
+        label_to_count: Dictionary where each key is a label and each
+            value is the number of times the label appears in the data.
+        num_instances: The number of time series.
+        key: The key for the time series labels that are saved. If None,
+            only labels that occur in more than 1 and less than all of
+            the time series are kept, otherwise all labels are kept.
+
+    Returns:
+        A list of the kept labels in the order they were first counted.
+    """
+    if key:
+        return list(label_to_count.keys())
+    return [label for label, num in label_to_count.items()
+            if 2 <= num < num_instances]
+
+def encode_labels(series_labels, label_to_index):
+    """Returns the one hot encoded labels of the time series.
+
+    Args:
+        series_labels: A list where the ith element is an iterable of
+            the label values of the ith time series.
+        label_to_index: Dictionary where a key is a label and the value
+            is the index of the label.
+
+    Returns:
+        A label matrix as returned by label_matrix.
+    """
+    rows, cols = [], []
+    for index, ts_labels in enumerate(series_labels):
+        encoded = {label_to_index[label_value] for label_value in ts_labels
+                   if label_value in label_to_index}
+        rows.extend([index] * len(encoded))
+        cols.extend(encoded)
+    return label_matrix(np.array(rows, dtype=np.int64),
+                        np.array(cols, dtype=np.int64),
+                        (len(series_labels), len(label_to_index)))
+
+def label_matrix(rows, cols, shape):
+    """Builds a label matrix where entry [i][j] is 1 if time series i has
+    the label with index j. The matrix is a sparse CSR matrix if its
+    density is below SPARSE_LABEL_DENSITY and an np array otherwise.
+
+    Args:
+        rows: Array of the time series index of each one.
+        cols: Array of the label index of each one, without duplicate
+            (row, col) pairs.
+        shape: The shape of the matrix, (num_instances, num_labels).
+    """
+    size = shape[0] * shape[1]
+    if size and len(rows) / size < SPARSE_LABEL_DENSITY:
+        matrix = sparse.csr_matrix((np.ones(len(rows), dtype=int),
+                                    (rows, cols)), shape=shape)
+        matrix.sort_indices()
+        return matrix
+    matrix = np.zeros(shape, dtype=int)
+    matrix[rows, cols] = 1
+    return matrix
@@ -0,0 +1,283 @@
+"""This module computes dynamic time warping (DTW) distances, which match
+time series whose shapes are the same but shifted in time.
+
+The distances are computed for batches of pairs of time series at once
+and are restricted to a Sakoe-Chiba window. Most pairs are never
+compared in full: the LB_Kim and LB_Keogh lower bounds rule them out
+first.
+
+The data passed to the functions may have columns after the first
+num_dates columns, e.g. encoded labels. They are static features whose
+squared euclidean distance is added to the squared DTW distance.
+"""
+import numpy as np
+from scipy import sparse
+from scipy.ndimage import maximum_filter1d, minimum_filter1d
+
+# The Sakoe-Chiba window, as a fraction of the length of the time series.
+WINDOW_RATIO = 0.1
+
+# Upper bound for the number of values in the temporary arrays of a batch.
+BATCH_VALUES = 1 << 22
+
+def window_size(num_dates):
+    """Returns the Sakoe-Chiba window for time series of num_dates points,
+    the largest shift in points between two matched points."""
+    return max(1, int(round(num_dates * WINDOW_RATIO)))
+
+def envelope(series, window):
+    """Returns a tuple (upper, lower) with the maximum and the minimum of
+    each row of series within window points of each point."""
+    size = 2 * window + 1
+    return (maximum_filter1d(series, size, axis=1, mode="nearest"),
+            minimum_filter1d(series, size, axis=1, mode="nearest"))
+
+def lb_kim(x, y):
+    """Returns the squared LB_Kim lower bound between each row of x and
+    the same row of y: the first and the last points are always matched
+    with each other."""
+    bound = (x[:, 0] - y[:, 0]) ** 2
+    if x.shape[1] > 1:
+        bound += (x[:, -1] - y[:, -1]) ** 2
+    return bound
+
+def lb_keogh(x, upper, lower):
+    """Returns the squared LB_Keogh lower bound between each row of x and
+    the time series whose envelope is the same row of upper and lower:
+    every point of x is matched with a point within the envelope."""
+    above = np.maximum(x - upper, 0)
+    below = np.maximum(lower - x, 0)
+    return np.sum(above ** 2 + below ** 2, axis=1)
+
+def dtw_squared(x, y, window):
+    """Returns the squared DTW distance between each row of x and the
+    same row of y, with the squared difference as the cost of matching
+    two points.
+
+    The cost matrices of all the pairs are filled one row at a time.
+    Within a row, each cell depends on the cell to its left, which is
+    resolved without a loop: with S the running sum of the costs of the
+    row, cell j is S[j] + min over k <= j of (best[k] - S[k - 1]), where
+    best[k] is the smaller of the cells above and above left of cell k.
+
+    Args:
+        x: An array where each row is a time series.
+        y: An array with the same shape as x.
+        window: The Sakoe-Chiba window, see window_size.
+    """
+    num_pairs, length = x.shape
+    if num_pairs == 0:
+        return np.zeros(0)
+    # The arrays are transposed so that the running sums and minimums
+    # along a row of the cost matrices run over contiguous pairs.
+    x, y = np.ascontiguousarray(x.T), np.ascontiguousarray(y.T)
+    previous = np.full((length + 1, num_pairs), np.inf)
+    current = np.full((length + 1, num_pairs), np.inf)
+    # Row 0 is the cell left of the first point, row j + 1 is the jth
+    # point.
+    previous[0] = 0
+    for i in range(length):
+        start, end = max(0, i - window), min(length, i + window + 1)
+        cost = (x[i] - y[start:end]) ** 2
+        best = np.minimum(previous[start:end], previous[start + 1:end + 1])
+        totals = np.cumsum(cost, axis=0)
+        best -= totals - cost
+        current[start + 1:end + 1] = totals + np.minimum.accumulate(best,
+                                                                    axis=0)
+        if i == 0:
+            previous[0] = np.inf
+        previous, current = current, previous
+    return previous[length]
+
+def _split(data, num_dates):
+    """Splits data into the time series and the static features."""
+    return data[:, :num_dates], data[:, num_dates:]
+
+def _batches(num_items, values_per_item):
+    """Yields slices of at most BATCH_VALUES values."""
+    size = max(1, BATCH_VALUES // max(1, values_per_item))
+    for start in range(0, num_items, size):
+        yield slice(start, min(num_items, start + size))
+
+def distances(data, others, num_dates, window, rows=None, cols=None):
+    """Returns the DTW distance between each row of data and the same row
+    of others, in batches.
+
+    With rows and cols, the ith distance is between data[rows[i]] and
+    others[cols[i]] instead. The pairs are gathered one batch at a time,
+    so the time series of all the pairs are never copied at once.
+    """
+    if rows is None:
+        rows = cols = np.arange(len(data))
+    series, static = _split(data, num_dates)
+    other_series, other_static = _split(others, num_dates)
+    result = np.empty(len(rows))
+    # The gathered and transposed time series and the two rows of cost
+    # matrices take about 4 * num_dates values per pair.
+    for batch in _batches(len(rows), 4 * (num_dates + 2 * window + 1)):
+        batch_rows, batch_cols = rows[batch], cols[batch]
+        result[batch] = dtw_squared(series[batch_rows],
+                                    other_series[batch_cols], window)
+        result[batch] += np.sum((static[batch_rows] -
+                                 other_static[batch_cols]) ** 2, axis=1)
+    return np.sqrt(result)
+
+def nearest(data, centers, num_dates, window):
+    """Finds the closest center of each row of data.
+
+    The candidate centers of each time series are ordered by their lower
+    bound. In each round, the DTW distance to the next candidate is
+    computed for all the time series at once, and a time series is done
+    once the lower bound of its next candidate is not below its closest
+    distance so far.
+
+    Args:
+        data: An array where each row is a time series.
+        centers: An array where each row is a center.
+        num_dates: The number of columns that are points in time.
+        window: The Sakoe-Chiba window, see window_size.
+
+    Returns:
+        A tuple (closest, distance, stats) where closest[i] is the index
+        of the center closest to the ith time series, distance[i] its
+        distance and stats a dictionary with the number of "pairs" and
+        the number of pairs whose DTW distance was "computed".
+    """
+    series, static = _split(data, num_dates)
+    center_series, center_static = _split(centers, num_dates)
+    num_ts, num_centers = len(data), len(centers)
+    upper, lower = envelope(center_series, window)
+    bounds = np.empty((num_ts, num_centers))
+    for batch in _batches(num_ts, num_centers * num_dates):
+        rows = np.repeat(np.arange(batch.start, batch.stop), num_centers)
+        cols = np.tile(np.arange(num_centers), batch.stop - batch.start)
+        bounds[batch] = np.maximum(
+            lb_kim(series[rows], center_series[cols]),
+            lb_keogh(series[rows], upper[cols], lower[cols])).reshape(
+                -1, num_centers)
+    bounds += np.sum((static[:, np.newaxis, :] -
+                      center_static[np.newaxis, :, :]) ** 2, axis=2)
+
+    order = np.argsort(bounds, axis=1, kind="stable")
+    best = np.full(num_ts, np.inf)
+    closest = np.zeros(num_ts, dtype=np.intp)
+    active = np.arange(num_ts)
+    computed = 0
+    for rank in range(num_centers):
+        candidates = order[active, rank]
+        keep = bounds[active, candidates] < best[active]
+        active, candidates = active[keep], candidates[keep]
+        if len(active) == 0:
+            break
+        squared = distances(data, centers, num_dates, window, active,
+                            candidates) ** 2
+        computed += len(active)
+        better = squared < best[active]
+        best[active[better]] = squared[better]
+        closest[active[better]] = candidates[better]
+    return closest, np.sqrt(best), {"pairs": num_ts * num_centers,
+                                    "computed": computed}
+
+def medoids(data, assignment, num_clusters, num_dates, window, weights=None):
+    """Returns the index of the medoid of each cluster, the time series
+    with the smallest sum of DTW distances to the other time series of
+    its cluster. Unlike a mean or a median, a medoid is one of the time
+    series, so it is a valid center for DTW.
+
+    Args:
+        data: An array where each row is a time series.
+        assignment: An array with the cluster of each row of data.
+        num_clusters: The number of clusters, which must not be empty.
+        num_dates: The number of columns that are points in time.
+        window: The Sakoe-Chiba window, see window_size.
+        weights: An array with the weight of each row of data in the
+            sums. If None, every row has a weight of 1.
+    """
+    if weights is None:
+        weights = np.ones(len(data))
+    order = np.argsort(assignment, kind="stable")
+    sizes = np.bincount(assignment, minlength=num_clusters)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    # The pairs of distinct time series of each cluster, each pair once.
+    rows, cols = [], []
+    for start, size in zip(starts, sizes):
+        first, second = np.triu_indices(size, 1)
+        rows.append(order[start + first])
+        cols.append(order[start + second])
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    pair_distances = distances(data, data, num_dates, window, rows, cols)
+    sums = np.zeros(len(data))
+    np.add.at(sums, rows, pair_distances * weights[cols])
+    np.add.at(sums, cols, pair_distances * weights[rows])
+    result = np.empty(num_clusters, dtype=np.intp)
+    for cluster, (start, size) in enumerate(zip(starts, sizes)):
+        members = order[start:start + size]
+        result[cluster] = members[np.argmin(sums[members])]
+    return result
+
+def radius_graph(data, radius, num_dates, window):
+    """Returns the graph of the pairs of distinct time series within
+    radius of each other.
+
+    The pairs are filtered by LB_Kim, then by LB_Keogh in both
+    directions, and the DTW distance is only computed for the rest. The
+    pairs are enumerated in batches of rows, and only the steps that need
+    whole time series gather them, in their own smaller batches.
+
+    Args:
+        data: An array where each row is a time series.
+        radius: The largest distance between neighbors.
+        num_dates: The number of columns that are points in time.
+        window: The Sakoe-Chiba window, see window_size.
+
+    Returns:
+        A tuple (graph, stats) where graph is a sparse CSR matrix with
+        the distance of each pair of neighbors, including explicit zeros,
+        and stats a dictionary with the number of "pairs" and the number
+        of pairs ruled out by "lb_kim" and "lb_keogh" and whose DTW
+        distance was "computed".
+    """
+    series, static = _split(data, num_dates)
+    num_ts = len(data)
+    upper, lower = envelope(series, window)
+    # LB_Kim only needs the first and the last points.
+    ends = series[:, [0, -1]] if num_dates > 1 else series[:, :1]
+    limit = radius ** 2
+    stats = {"pairs": num_ts * (num_ts - 1) // 2, "lb_kim": 0, "lb_keogh": 0,
+             "computed": 0}
+    all_rows, all_cols, all_distances = [], [], []
+    # Each pair of a batch of rows holds its indexes, its end points and
+    # its static features.
+    for batch in _batches(num_ts, num_ts * (8 + 2 * static.shape[1])):
+        rows, cols = np.nonzero(np.arange(num_ts)[np.newaxis, :] >
+                                np.arange(batch.start, batch.stop)[:, np.newaxis])
+        rows += batch.start
+        static_distances = np.sum((static[rows] - static[cols]) ** 2, axis=1)
+        within = lb_kim(ends[rows], ends[cols]) + static_distances <= limit
+        stats["lb_kim"] += int(len(rows) - np.count_nonzero(within))
+        rows, cols = rows[within], cols[within]
+        static_distances = static_distances[within]
+        within = np.zeros(len(rows), dtype=bool)
+        for pairs in _batches(len(rows), 4 * num_dates):
+            pair_rows, pair_cols = rows[pairs], cols[pairs]
+            bound = np.maximum(
+                lb_keogh(series[pair_rows], upper[pair_cols],
+                         lower[pair_cols]),
+                lb_keogh(series[pair_cols], upper[pair_rows],
+                         lower[pair_rows]))
+            within[pairs] = bound + static_distances[pairs] <= limit
+        stats["lb_keogh"] += int(len(rows) - np.count_nonzero(within))
+        rows, cols = rows[within], cols[within]
+        stats["computed"] += len(rows)
+        pair_distances = distances(data, data, num_dates, window, rows, cols)
+        within = pair_distances <= radius
+        all_rows.append(rows[within])
+        all_cols.append(cols[within])
+        all_distances.append(pair_distances[within])
+    rows, cols = np.concatenate(all_rows), np.concatenate(all_cols)
+    pair_distances = np.concatenate(all_distances)
+    graph = sparse.csr_matrix(
+        (np.concatenate((pair_distances, pair_distances)),
+         (np.concatenate((rows, cols)), np.concatenate((cols, rows)))),
+        shape=(num_ts, num_ts))
+    return graph, stats
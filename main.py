@@ -1,9 +1,50 @@
+import hashlib
 import json
-from flask import Flask, render_template, jsonify
+import os
+import numpy as np
+from flask import Flask, Response, render_template, jsonify, request
+import charts
 import clustering
+import neighbors
+from cache import LRUCache
 
 # initializes the flask app
 app = Flask(__name__)
+# The float type of the clustering pipeline, "float64" or "float32". It can
+# be overridden per request with the "dtype" query parameter.
+app.config["DTYPE"] = os.environ.get("CHART_DTYPE", "float64")
+# The number of processes the runs of the k-means-constrained and k-medians
+# algorithms and the fits of the fast k-means tuning are spread over.
+app.config["WORKERS"] = int(os.environ.get("CHART_WORKERS",
+                                           clustering.NUM_WORKERS))
+
+# The results of the tuning route, which are recomputed when the chart
+# changes.
+TUNING_CACHE_MAX_BYTES = 16 * 1024 * 1024
+tuning_cache = LRUCache(TUNING_CACHE_MAX_BYTES)
+
+# The PCA projections fitted for dbscan, which are refitted when the chart
+# changes.
+PROJECTION_CACHE_MAX_BYTES = 64 * 1024 * 1024
+projection_cache = LRUCache(PROJECTION_CACHE_MAX_BYTES)
+
+# The assignments of the last k-means, k-means-constrained and k-medians
+# clustering of each chart, which the "incremental" mode restarts from. They
+# are kept when the chart changes, as a refreshed chart has the same time
+# series with new points.
+WARM_START_CACHE_MAX_BYTES = 16 * 1024 * 1024
+warm_start_cache = LRUCache(WARM_START_CACHE_MAX_BYTES)
+
+# The linkage trees of agglomerative clustering, which are recomputed when
+# the chart changes.
+LINKAGE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+linkage_cache = LRUCache(LINKAGE_CACHE_MAX_BYTES)
+
+# The json bodies of the clustering route, which are recomputed when the
+# chart changes. They are sent with a strong ETag, so the browser can
+# revalidate them without downloading them again.
+RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+result_cache = LRUCache(RESULT_CACHE_MAX_BYTES)
 
 @app.route("/")
 def homepage():
@@ -19,12 +60,97 @@ def load_data(chart_id):
     """Tries to load the data. Returns an error message if the file is
     not found, otherwise returns the loaded data."""
     try:
-        with open('./data/chart-' + str(chart_id) + ".json", "r") as json_file:
+        with open(charts.chart_path(chart_id), "r") as json_file:
             return json.load(json_file)
     except:
-        response = {"success": False, "error": {"type": "FileNotFoundError",
-                                                "message": "No such chart"}}
-        return response, 404
+        return chart_not_found()
+
+def load_arrays(chart_id, key):
+    """Tries to load the parsed time series arrays of the chart, which
+    are cached between requests. The float type of the arrays is given
+    by the "dtype" query parameter or the DTYPE config. If the "step"
+    query parameter is given, the time series are resampled to time
+    buckets of step seconds, combining the values in a bucket according
+    to the "aggregation" query parameter, "mean" by default. Missing
+    values are NaN, see impute_missing. The query parameters of
+    date_reduction are validated as well.
+
+    Returns:
+        A tuple (arrays, error) where arrays is the output of
+        clustering.time_series_array and error is None, or arrays is
+        None and error is an error message if the file is not found or
+        a query parameter is invalid.
+    """
+    dtype = clustering.DTYPES.get(request.args.get("dtype",
+                                                   app.config["DTYPE"]))
+    if dtype is None:
+        return None, invalid_parameter("dtype")
+    step = request.args.get("step", type=int)
+    if "step" in request.args and (step is None or step <= 0):
+        return None, invalid_parameter("step")
+    aggregation = request.args.get("aggregation", "mean")
+    if aggregation not in clustering.AGGREGATIONS:
+        return None, invalid_parameter("aggregation")
+    if imputation() not in clustering.IMPUTATIONS:
+        return None, invalid_parameter("impute")
+    segments = request.args.get("paa", type=int)
+    if "paa" in request.args and (segments is None or segments <= 0):
+        return None, invalid_parameter("paa")
+    alphabet_size = request.args.get("sax", type=int)
+    if "sax" in request.args and alphabet_size not in range(
+            2, clustering.SAX_MAX_ALPHABET + 1):
+        return None, invalid_parameter("sax")
+    try:
+        return charts.load_arrays(chart_id, key, dtype, step,
+                                  aggregation), None
+    except (OSError, ValueError, KeyError):
+        return None, chart_not_found()
+
+def imputation():
+    """Returns the "impute" query parameter, "sentinel" by default."""
+    return request.args.get("impute", "sentinel")
+
+def impute_missing(data, date_to_index):
+    """Fills the missing values of data according to the "impute" query
+    parameter. See clustering.impute."""
+    return clustering.impute(data, imputation(), date_to_index)
+
+def date_reduction(date_to_index):
+    """Returns the keyword arguments of clustering.preprocess that reduce
+    the dates of the time series: the number of segments given by the
+    "paa" query parameter and the alphabet size given by the "sax" query
+    parameter, each None if not given."""
+    return {"segments": request.args.get("paa", type=int),
+            "alphabet_size": request.args.get("sax", type=int),
+            "date_to_index": date_to_index}
+
+def batch_size():
+    """Returns the "batch_size" query parameter of mini-batch k-means,
+    clustering.MINI_BATCH_SIZE by default, or None if it is invalid."""
+    size = request.args.get("batch_size", clustering.MINI_BATCH_SIZE,
+                            type=int)
+    if size is None or size <= 0:
+        return None
+    return size
+
+def chart_not_found():
+    """Returns the error message for a chart that can not be loaded."""
+    response = {"success": False, "error": {"type": "FileNotFoundError",
+                                            "message": "No such chart"}}
+    return response, 404
+
+def too_many_series():
+    """Returns the error message for a chart with more time series than
+    the algorithm supports."""
+    response = {"success": False, "error": {"type": "ValueError",
+                                            "message": "Too many time series"}}
+    return response, 400
+
+def invalid_parameter(name):
+    """Returns the error message for an invalid query parameter."""
+    response = {"success": False, "error": {"type": "ValueError",
+                                            "message": "Invalid " + name}}
+    return response, 400
 
 @app.route("/clustering/<algorithm>/<similarity>/<encoding>/<outlier>/<rep>/<chart_id>")
 @app.route("/clustering/<algorithm>/<similarity>/<encoding>/<outlier>/<rep>/<chart_id>/<key>")
@@ -32,13 +158,38 @@ def cluster(algorithm, similarity, encoding, outlier, rep, chart_id, key=None):
     """Returns the cluster each time series was placed in.
 
     Args:
-        algorithm: The algorithm used for clustering. Must be "K-means"
-            or "DBSCAN".
+        algorithm: The algorithm used for clustering. Must be "k-means",
+            "mini-batch-k-means", "k-means-constrained", "k-medians",
+            "agglomerative", "zone" or "dbscan". The batch size of
+            mini-batch k-means is given by the "batch_size" query
+            parameter. The linkage method of agglomerative clustering is
+            given by the "linkage" query parameter, "ward" by default,
+            and its tree is cut at the distance given by the "threshold"
+            query parameter, or into the number of clusters given by the
+            "clusters" query parameter. Charts with more than
+            clustering.AGGLOMERATIVE_MAX_SERIES time series are rejected
+            for agglomerative clustering. With the "incremental" query
+            parameter "on", k-means, k-means-constrained and k-medians
+            restart from their last clusters of the chart, which
+            converges in a few iterations when the chart only got new
+            points. The "paa" and "sax" query parameters reduce the dates
+            before clustering, see date_reduction, while the bands use
+            every date. With the "stats" query parameter "on", the bands
+            also have "band_stats", the 10th, 50th and 90th percentiles
+            and the mean of each cluster at each date.
         similarity: The similarity measure used for scaling the data
-            before clustering. Must be "Proximity" or "Correlation".
+            before clustering. Must be "Proximity", "Correlation" or
+            "DTW". DTW is only supported by "k-means-constrained",
+            "k-medians" and "dbscan", the other algorithms use the
+            euclidean distance.
         encoding: The method used for encoding the labels. Must
             be "None" or "One-Hot".
-        outlier: Whether outliers are identified, must be "on" or "off".
+        outlier: Whether outliers are identified, must be "on", "off" or
+            "adaptive". With "adaptive", the outliers of each cluster are
+            the time series farther from its center than the median
+            distance plus a multiple of the median absolute deviation,
+            see clustering.outlier_thresholds. DBSCAN flags its noise
+            points in both modes.
         rep: Whether the data is represented as "lines" or "bands".
         chart_id: The id of the file containing the data that k-means
             clustering is run on.
@@ -50,34 +201,129 @@ def cluster(algorithm, similarity, encoding, outlier, rep, chart_id, key=None):
         A json with a list containing the label of the cluster each
         time series was grouped in, and the min_max of each cluster and
         the corresponding dates for each value if rep == "bands",
-        otheriwse and dates are empty lists.
+        otheriwse and dates are empty lists. For dbscan, except with DTW,
+        "pca" has the number of principal components, the variance they
+        explain and the solver of the PCA. "outlier_scores" has the
+        distance of each time series to the center of its cluster divided
+        by the outlier threshold, for the algorithms with centers when
+        outliers are identified, and is empty otherwise. The json is
+        cached, see cached_response.
     """
-    data = load_data(chart_id)
-    if "timeSeries" not in data:
-        return data
-    (time_series_data, label_dict, ts_to_labels, dates,
-     old_range) = clustering.time_series_array(data, key)
-    ts_data_updated = clustering.preprocess(time_series_data, encoding,
-                                            similarity, ts_to_labels, algorithm)
+    return cached_response(chart_id, lambda: clusters_response(
+        algorithm, similarity, encoding, outlier, rep, chart_id, key))
+
+def clusters_response(algorithm, similarity, encoding, outlier, rep,
+                      chart_id, key):
+    """Clusters the time series of the chart and returns the response of
+    the cluster route, or an error message."""
+    arrays, error = load_arrays(chart_id, key)
+    if error:
+        return error
+    size = batch_size()
+    if size is None:
+        return invalid_parameter("batch_size")
+    incremental = request.args.get("incremental", "off")
+    if incremental not in ("on", "off"):
+        return invalid_parameter("incremental")
+    if outlier not in clustering.OUTLIER_MODES:
+        return invalid_parameter("outlier")
+    if similarity == "dtw" and algorithm not in clustering.DTW_ALGORITHMS:
+        return invalid_parameter("similarity")
+    statistics = request.args.get("stats", "off")
+    if statistics not in ("on", "off"):
+        return invalid_parameter("stats")
+    time_series_data, label_dict, ts_to_labels, dates, old_range = arrays
+    response = {}
+    scores = None
+    warm_key = (chart_id, key, algorithm, similarity, encoding) + \
+        data_parameters()
+    init = warm_start_cache.get(warm_key) if incremental == "on" else None
+    reduction = date_reduction(dates)
+    num_dates = None
+    if similarity == "dtw":
+        num_dates = time_series_data.shape[1]
+        if reduction["segments"] is not None:
+            num_dates = min(num_dates, reduction["segments"])
+
+    def preprocessed():
+        return clustering.preprocess(
+            impute_missing(time_series_data, dates), encoding, similarity,
+            ts_to_labels, algorithm, **reduction)
     if algorithm == "k-means":
-        labels = clustering.kmeans(ts_data_updated, outlier).tolist()
+        labels, scores = clustering.kmeans(preprocessed(), outlier, init,
+                                           return_scores=True)
+        labels = labels.tolist()
+        warm_start_cache.put(warm_key, np.abs(labels) - 1)
+    elif algorithm == "mini-batch-k-means":
+        labels, scores = clustering.mini_batch_kmeans(
+            preprocessed(), outlier, size, return_scores=True)
+        labels = labels.tolist()
     elif algorithm == "k-means-constrained" or algorithm == "k-medians":
-        labels = clustering.kmeans_kmedians(ts_data_updated, label_dict,
-                                            ts_to_labels, algorithm,
-                                            outlier).tolist()
+        labels, scores = clustering.kmeans_kmedians(
+            preprocessed(), label_dict, ts_to_labels, algorithm, outlier,
+            app.config["WORKERS"], num_dates, init, return_scores=True)
+        labels = labels.tolist()
+        warm_start_cache.put(warm_key, np.abs(labels) - 1)
+    elif algorithm == "agglomerative":
+        method = request.args.get("linkage", "ward")
+        if method not in clustering.LINKAGES:
+            return invalid_parameter("linkage")
+        num_clusters = request.args.get("clusters", type=int)
+        if "clusters" in request.args and (num_clusters is None or
+                                           num_clusters <= 0):
+            return invalid_parameter("clusters")
+        threshold = request.args.get("threshold", type=float)
+        if "threshold" in request.args and (threshold is None or
+                                            threshold < 0):
+            return invalid_parameter("threshold")
+        if len(time_series_data) > clustering.AGGLOMERATIVE_MAX_SERIES:
+            return too_many_series()
+        # A cached tree is cut without preprocessing the data, which is
+        # only needed for the outlier scores.
+        data = []
+
+        def load():
+            if not data:
+                data.append(preprocessed())
+            return data[0]
+        tree = linkage_tree(chart_id, key, similarity, encoding, method, load)
+        labels, scores = clustering.agglomerative(
+            tree, outlier, load, num_clusters, threshold, return_scores=True)
+        labels = labels.tolist()
     elif algorithm == "zone":
         labels = clustering.cluster_zone(label_dict, ts_to_labels)
+    elif similarity == "dtw":
+        labels = clustering.dbscan(preprocessed(), similarity, encoding,
+                                   outlier, num_dates=num_dates).tolist()
     else:
-        labels = clustering.dbscan(ts_data_updated, similarity, encoding,
-                                   outlier).tolist()
+        projection = pca_projection(chart_id, similarity, time_series_data,
+                                    dates)
+        index, error = neighbor_index(
+            chart_id, key, similarity, encoding,
+            lambda: (clustering.preprocess(
+                time_series_data, encoding, similarity, ts_to_labels,
+                algorithm, projection, imputation=imputation(),
+                **reduction), None))
+        if error:
+            return error
+        labels = clustering.dbscan(index.data, similarity, encoding, outlier,
+                                   index).tolist()
+        response["pca"] = pca_summary(projection)
     min_max, ordered_dates, outlier_indexes = [], [], []
     if rep == "bands":
-        min_max, ordered_dates, outlier_indexes = clustering.clusters_min_max(
-            time_series_data, labels, dates, old_range, outlier)
-    return  jsonify({"cluster_labels": labels,
+        bands = clustering.clusters_min_max(
+            time_series_data, labels, dates, old_range, outlier,
+            statistics == "on")
+        min_max, ordered_dates, outlier_indexes = bands[:3]
+        if statistics == "on":
+            response["band_stats"] = bands[3]
+    response.update({"cluster_labels": labels,
                      "min_max": min_max,
                      "dates": ordered_dates,
-                     "outlier_indexes": outlier_indexes})
+                     "outlier_indexes": outlier_indexes,
+                     "outlier_scores": [] if scores is None else
+                                       scores.tolist()})
+    return jsonify(response)
 
 @app.route("/frequency/<algorithm>/<similarity>/<label_encoding>/<chart_id>")
 def frequency(similarity, algorithm, label_encoding, chart_id):
@@ -98,18 +344,28 @@ def frequency(similarity, algorithm, label_encoding, chart_id):
         labels per cluster.
 
     """
-    data = load_data(chart_id)
-    if "timeSeries" not in data:
-        return data
-    (time_series_data, label_dict, ts_to_labels, _,
-     _) = clustering.time_series_array(data, None)
-    time_series_data = clustering.preprocess(time_series_data, label_encoding,
-                                             similarity, ts_to_labels, "k-means")
+    arrays, error = load_arrays(chart_id, None)
+    if error:
+        return error
+    size = batch_size()
+    if size is None:
+        return invalid_parameter("batch_size")
+    # The frequencies are computed from clusters found with the euclidean
+    # distance.
+    if similarity == "dtw":
+        return invalid_parameter("similarity")
+    time_series_data, label_dict, ts_to_labels, dates, _ = arrays
+    time_series_data = clustering.preprocess(
+        impute_missing(time_series_data, dates), label_encoding, similarity,
+        ts_to_labels, "k-means", **date_reduction(dates))
     if algorithm == "k-means":
         labels = clustering.kmeans(time_series_data, "off")
+    elif algorithm == "mini-batch-k-means":
+        labels = clustering.mini_batch_kmeans(time_series_data, "off", size)
     elif algorithm == "k-means-constrained":
         labels = clustering.kmeans_kmedians(time_series_data, label_dict,
-                                            ts_to_labels, algorithm, "off")
+                                            ts_to_labels, algorithm, "off",
+                                            app.config["WORKERS"])
 
     cluster_labels = clustering.cluster_to_labels(labels, ts_to_labels)
 
@@ -117,7 +373,7 @@ def frequency(similarity, algorithm, label_encoding, chart_id):
         label_dict, cluster_labels, ts_to_labels)
 
     return jsonify({"labels": ordered_labels,
-                    "ts_labels": ordered_ts.tolist(),
+                    "ts_labels": clustering.dense(ordered_ts).tolist(),
                     "cluster_labels": ordered_clusters.tolist()})
 
 @app.route("/tuning/<algorithm>/<similarity>/<label_encoding>/<chart_id>")
@@ -134,20 +390,252 @@ def tune_parameters(algorithm, similarity, label_encoding, chart_id):
             be "None" or "One-Hot".
         chart_id: The id of the file containing the data that k-means
             clustering is run on.
+
+    Returns:
+        The list from clustering.tuning_k or clustering.tuning_eps. If
+        algorithm is "k-means" and the "mode" query parameter is
+        "fast", a json with the output of clustering.tuning_k_fast. The
+        results are cached until the chart changes.
     """
-    data = load_data(chart_id)
-    if "timeSeries" not in data:
-        return data
-    time_series_data, _, ts_to_labels, _, _ = clustering.time_series_array(
-        data, None)
-    time_series_data = clustering.preprocess(time_series_data, label_encoding,
-                                             similarity, ts_to_labels,
-                                             algorithm)
-    if algorithm == "k-means":
-        distances = clustering.tuning_k(time_series_data)
-    else:
-        distances = clustering.tuning_eps(time_series_data)
-    return str(distances)
+    mode = request.args.get("mode", "full")
+    if mode not in ("full", "fast"):
+        return invalid_parameter("mode")
+    # The k-means tuning uses the euclidean distance and the dbscan tuning
+    # the PCA projection of the time series, neither supports DTW.
+    if similarity not in clustering.PCA_VARIANCE:
+        return invalid_parameter("similarity")
+
+    def compute():
+        if algorithm != "k-means":
+            index, error = neighbor_index(
+                chart_id, None, similarity, label_encoding,
+                lambda: load_tuning_data(chart_id, similarity,
+                                         label_encoding, "dbscan"))
+            if error:
+                return None, error
+            return str(clustering.tuning_eps(index.data, index)), None
+        time_series_data, error = load_tuning_data(chart_id, similarity,
+                                                   label_encoding, algorithm)
+        if error:
+            return None, error
+        if mode == "fast":
+            return clustering.tuning_k_fast(time_series_data,
+                                            app.config["WORKERS"]), None
+        return str(clustering.tuning_k(time_series_data)), None
+    return cached_tuning(chart_id, compute)
+
+@app.route("/tuning/eps-options/<similarity>/<label_encoding>/<chart_id>")
+def tune_eps_options(similarity, label_encoding, chart_id):
+    """Returns the eps for which dbscan produces more than min_clusters
+    clusters on the chart chart_id, with the eps between the "start"
+    and "end" query parameters (0.1 and 3 by default) in steps of 0.1
+    and min_clusters given by the "min_clusters" query parameter (1 by
+    default).
+
+    Args:
+        similarity: The similarity measure used for scaling the data
+            before clustering. Must be "proximity" or "correlation".
+        label_encoding: The method used for encoding the labels. Must
+            be "none" or "one-hot".
+        chart_id: The id of the file containing the data that dbscan is
+            run on.
+
+    Returns:
+        A json where "options" is the list of [num_outliers,
+        num_clusters, eps] from clustering.tuning_eps_options. The
+        results are cached until the chart changes.
+    """
+    start = request.args.get("start", type=float)
+    end = request.args.get("end", type=float)
+    min_clusters = request.args.get("min_clusters", type=int)
+    for name, value in [("start", start), ("end", end),
+                        ("min_clusters", min_clusters)]:
+        if name in request.args and value is None:
+            return invalid_parameter(name)
+    if similarity not in clustering.PCA_VARIANCE:
+        return invalid_parameter("similarity")
+    if label_encoding not in clustering.LABEL_ENCODINGS:
+        return invalid_parameter("label_encoding")
+    start = 0.1 if start is None else start
+    end = 3.0 if end is None else end
+    min_clusters = 1 if min_clusters is None else min_clusters
+    if not 0 < start <= end:
+        return invalid_parameter("start")
+
+    def compute():
+        index, error = neighbor_index(
+            chart_id, None, similarity, label_encoding,
+            lambda: load_tuning_data(chart_id, similarity, label_encoding,
+                                     "dbscan"))
+        if error:
+            return None, error
+        options = clustering.tuning_eps_options(index.data, start, end,
+                                                min_clusters, index)
+        return {"options": options}, None
+    return cached_tuning(chart_id, compute)
+
+def load_tuning_data(chart_id, similarity, label_encoding, algorithm):
+    """Returns a tuple (data, error) with the preprocessed time series
+    of the chart chart_id for tuning algorithm, see load_arrays."""
+    arrays, error = load_arrays(chart_id, None)
+    if error:
+        return None, error
+    time_series_data, _, ts_to_labels, dates, _ = arrays
+    projection = None
+    if algorithm == "dbscan":
+        projection = pca_projection(chart_id, similarity, time_series_data,
+                                    dates)
+    return clustering.preprocess(
+        time_series_data, label_encoding, similarity, ts_to_labels,
+        algorithm, projection, imputation=imputation(),
+        **date_reduction(dates)), None
+
+def data_parameters():
+    """Returns a tuple with the query parameters that change the arrays
+    returned by load_arrays or the reduction of their dates."""
+    return (request.args.get("dtype", app.config["DTYPE"]),) + tuple(
+        request.args.get(name) for name in ("step", "aggregation", "impute",
+                                            "paa", "sax"))
+
+def pca_projection(chart_id, similarity, data, date_to_index):
+    """Returns the PCA projection fitted by clustering.dbscan_projection,
+    which is cached per chart, similarity and query parameters that
+    change the data until the chart changes. The missing values are
+    imputed and the dates reduced one batch of rows at a time.
+
+    Args:
+        chart_id: The id of the chart.
+        similarity: The similarity measure used for scaling the data.
+        data: The time series of the chart, with missing values.
+        date_to_index: A dictionary mapping each date to its column.
+    """
+    signature = charts.chart_signature(chart_id)
+    cache_key = (chart_id, similarity) + data_parameters()
+    projection = projection_cache.get(cache_key, signature)
+    if projection is None:
+        reduction = date_reduction(date_to_index)
+        projection = clustering.dbscan_projection(
+            data, similarity,
+            lambda rows: clustering.reduce_dates(
+                impute_missing(rows, date_to_index), **reduction))
+        projection_cache.put(cache_key, projection, signature)
+    return projection
+
+def pca_summary(projection):
+    """Returns a dictionary with the number of components, the explained
+    variance and the solver of a projection."""
+    return {"components": len(projection["components"]),
+            "explained_variance": float(np.sum(
+                projection["explained_variance_ratio"])),
+            "solver": projection["solver"]}
+
+def linkage_tree(chart_id, key, similarity, encoding, method, load):
+    """Returns the linkage tree of agglomerative clustering computed by
+    clustering.linkage_tree, which is cached per chart, preprocessing,
+    linkage method and query parameters that change the data until the
+    chart changes.
+
+    Args:
+        chart_id: The id of the chart.
+        key: The key for the time series labels that are saved.
+        similarity: The similarity measure used for scaling the data.
+        encoding: The method used for encoding the labels.
+        method: The linkage method.
+        load: A function returning the preprocessed time series of the
+            chart, called if the tree is not cached.
+    """
+    signature = charts.chart_signature(chart_id)
+    cache_key = (chart_id, key, similarity, encoding, method) + \
+        data_parameters()
+    tree = linkage_cache.get(cache_key, signature)
+    if tree is None:
+        tree = clustering.linkage_tree(load(), method)
+        linkage_cache.put(cache_key, tree, signature)
+    return tree
+
+def neighbor_index(chart_id, key, similarity, encoding, load):
+    """Returns the neighbors.NeighborIndex of the time series of the
+    chart preprocessed for dbscan, which is cached per chart,
+    preprocessing and query parameters that change the data until the
+    chart changes.
+
+    Args:
+        chart_id: The id of the chart.
+        key: The key for the time series labels that are saved.
+        similarity: The similarity measure used for scaling the data.
+        encoding: The method used for encoding the labels.
+        load: A function returning a tuple (data, error) with the
+            preprocessed data, called if the index is not cached.
+
+    Returns:
+        A tuple (index, error) where error is None or an error message.
+    """
+    try:
+        signature = charts.chart_signature(chart_id)
+    except OSError:
+        return None, chart_not_found()
+    cache_key = (chart_id, key, similarity, encoding) + data_parameters()
+    return neighbors.cached_index(cache_key, signature, load)
+
+def cached_tuning(chart_id, compute):
+    """Returns the result of compute for the current request, which is
+    cached by route and query parameters until the chart changes.
+
+    Args:
+        chart_id: The id of the chart the result is computed from.
+        compute: A function returning a tuple (result, error) where
+            error is None or an error message, which is not cached.
+    """
+    try:
+        signature = charts.chart_signature(chart_id)
+    except OSError:
+        return chart_not_found()
+    cache_key = (request.path, tuple(sorted(request.args.items())))
+    result = tuning_cache.get(cache_key, signature)
+    if result is not None:
+        return result
+    result, error = compute()
+    if error:
+        return error
+    tuning_cache.put(cache_key, result, signature)
+    return result
+
+def cached_response(chart_id, compute):
+    """Returns the json response of compute for the current request, which
+    is cached by route, query parameters and config until the chart
+    changes, with a strong ETag computed from its body.
+
+    The response has "Cache-Control: no-cache", so the browser revalidates
+    it with the ETag and gets a 304 without a body if it is unchanged.
+    Requests with the "incremental" query parameter "on" depend on the
+    previous clusterings of the chart and are not cached.
+
+    Args:
+        chart_id: The id of the chart the response is computed from.
+        compute: A function returning a json Response, or an error
+            message, which is not cached.
+    """
+    try:
+        signature = charts.chart_signature(chart_id)
+    except OSError:
+        return chart_not_found()
+    cacheable = request.args.get("incremental", "off") != "on"
+    cache_key = (request.path, tuple(sorted(request.args.items())),
+                 app.config["DTYPE"], app.config["WORKERS"])
+    entry = result_cache.get(cache_key, signature) if cacheable else None
+    if entry is None:
+        response = compute()
+        if not isinstance(response, Response) or response.status_code != 200:
+            return response
+        body = response.get_data()
+        entry = (body, hashlib.sha256(body).hexdigest())
+        if cacheable:
+            result_cache.put(cache_key, entry, signature)
+    body, etag = entry
+    response = app.response_class(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
 
 @app.route("/<path>")
 def invalid_route(path):
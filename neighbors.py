@@ -0,0 +1,124 @@
+"""This module contains a neighbor index over the preprocessed time series
+of a chart. It keeps the results of the neighbor searches, so that dbscan
+and the dbscan tuning share them, and the indexes are cached per chart
+and preprocessing.
+"""
+import threading
+import numpy as np
+from scipy import sparse
+from sklearn.neighbors import NearestNeighbors
+from cache import LRUCache, nbytes
+
+# KD trees prune well in few dimensions, ball trees hold up better in
+# more dimensions. Sparse data is searched by brute force.
+KD_TREE_MAX_DIMENSIONS = 20
+
+# Upper bound for the memory used by the cached indexes.
+INDEX_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+class NeighborIndex:
+    """A neighbor index over the rows of data which keeps the radius
+    neighbor graph of the largest radius and the nearest neighbors it
+    computed.
+
+    Attributes:
+        data: The array or sparse matrix the index is built on.
+        algorithm: The search algorithm, "kd_tree", "ball_tree" or
+            "brute".
+        on_grow: A function called without arguments after the index
+            keeps a larger result, e.g. to measure it again in a cache.
+    """
+
+    def __init__(self, data, on_grow=None):
+        self.data = data
+        self.on_grow = on_grow
+        if sparse.issparse(data):
+            self.algorithm = "brute"
+        elif data.shape[1] <= KD_TREE_MAX_DIMENSIONS:
+            self.algorithm = "kd_tree"
+        else:
+            self.algorithm = "ball_tree"
+        self._nearest = NearestNeighbors(algorithm=self.algorithm).fit(data)
+        self._graph = None
+        self._radius = None
+        self._kneighbors = None
+        self._lock = threading.Lock()
+
+    def radius_graph(self, radius):
+        """Returns a sparse CSR matrix with the distance between each pair
+        of distinct rows within radius, including explicit zeros for
+        duplicate rows. Only the graph of the largest radius computed so
+        far is kept, and it is filtered for smaller radiuses, so the
+        memory of the index does not grow with the number of radiuses."""
+        with self._lock:
+            graph, largest = self._graph, self._radius
+        if graph is not None and radius == largest:
+            return graph
+        if graph is not None and radius < largest:
+            graph = graph.tocoo()
+            within = graph.data <= radius
+            return sparse.csr_matrix(
+                (graph.data[within], (graph.row[within], graph.col[within])),
+                shape=graph.shape)
+        graph = self._nearest.radius_neighbors_graph(radius=radius,
+                                                     mode="distance")
+        with self._lock:
+            if self._radius is None or radius > self._radius:
+                self._graph, self._radius = graph, radius
+        self._grew()
+        return graph
+
+    def kneighbors(self, n_neighbors):
+        """Returns a tuple (distances, indices) of the n_neighbors closest
+        other rows of each row, closest first."""
+        with self._lock:
+            cached = self._kneighbors
+        if cached is None or cached[0].shape[1] < n_neighbors:
+            cached = self._nearest.kneighbors(n_neighbors=n_neighbors)
+            with self._lock:
+                self._kneighbors = cached
+            self._grew()
+        return cached[0][:, :n_neighbors], cached[1][:, :n_neighbors]
+
+    def nbytes(self):
+        """Estimates the memory used by the index. The tree holds a copy
+        of the data and the order of the rows."""
+        with self._lock:
+            results = [self._graph, self._kneighbors]
+        tree = 0 if self.algorithm == "brute" else nbytes(self.data) + \
+            self.data.shape[0] * np.dtype(np.intp).itemsize
+        return nbytes(self.data) + tree + nbytes(results)
+
+    def _grew(self):
+        if self.on_grow is not None:
+            self.on_grow()
+
+index_cache = LRUCache(INDEX_CACHE_MAX_BYTES,
+                       sizeof=lambda index: index.nbytes())
+
+def cached_index(key, signature, load):
+    """Returns the NeighborIndex cached for key, or builds it from the
+    data returned by load and caches it. The entry is measured again
+    whenever the index keeps a larger result.
+
+    Args:
+        key: The key of the index, e.g. the chart and the preprocessing
+            parameters.
+        signature: The signature of the chart file, see
+            charts.chart_signature.
+        load: A function returning a tuple (data, error) where data is
+            the preprocessed data, or None and an error message.
+
+    Returns:
+        A tuple (index, error) where error is None, or index is None and
+        error is the error message returned by load.
+    """
+    index = index_cache.get(key, signature)
+    if index is not None:
+        return index, None
+    data, error = load()
+    if error:
+        return None, error
+    index = NeighborIndex(data, lambda: index_cache.resize(key))
+    index_cache.put(key, index, signature)
+    return index, None
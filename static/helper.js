@@ -1,8 +1,10 @@
 /**
- * Wrapper for fetch that appends the application url.
+ * Wrapper for fetch that appends the application url. Responses are
+ * revalidated with the server, which answers with a 304 and no body if
+ * they did not change.
  * @param {string} query Route for fetch.
  * @return {Promise} Response for fetch.
  */
 let callFetch = (query) => {
-  return fetch('http://127.0.0.1:5000/' + query);
+  return fetch('http://127.0.0.1:5000/' + query, {cache: 'no-cache'});
 };
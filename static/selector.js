@@ -13,23 +13,26 @@
  */
 const selectors = async (svg, tsData, colorScale, yScale, dateScale,
   margin, chartId, zones) => {
-  const modes = ["Default", "DBSCAN", "K-means", "K-means-constrained",
-    "K-medians", "Zone"];
-  const similarity = ["Correlation", "Proximity"];
+  const modes = ["Default", "DBSCAN", "K-means", "Mini-batch-K-means",
+    "K-means-constrained", "K-medians", "Agglomerative", "Zone"];
+  const similarity = ["Correlation", "Proximity", "DTW"];
+  // The modes that support the DTW similarity, the others only use the
+  // euclidean distance.
+  const dtwModes = ["DBSCAN", "K-means-constrained", "K-medians"];
   const encoding = ["None", "One-Hot"];
-  const outlier = ["Off", "On"];
+  const outlier = ["Off", "On", "Adaptive"];
   clusters = ["All"];
   allZones = ["All"].concat(zones);
   const filterBy = ["Cluster", "Zone"];
   const rep = ["Lines", "Bands"];
   updateSelector("mode", modes);
-  updateSelector("similarity", similarity);
+  updateSelector("similarity", similarity.filter((elt) => elt != "DTW"));
   updateSelector("encoding", encoding);
   updateSelector("outlier", outlier);
   updateSelector("cluster", clusters);
   updateSelector("filter", filterBy);
   updateSelector("rep", rep);
-  d3.select("select#" + "mode" + "Selector").on("change", updateChart);
+  d3.select("select#" + "mode" + "Selector").on("change", updateMode);
   d3.select("select#" + "similarity" + "Selector").on("change", updateChart);
   d3.select("select#" + "encoding" + "Selector").on("change", updateChart);
   d3.select("select#" + "outlier" + "Selector").on("change", updateChart);
@@ -37,6 +40,22 @@ const selectors = async (svg, tsData, colorScale, yScale, dateScale,
   d3.select("select#" + "filter" + "Selector").on("change", updateFilter);
   d3.select("select#" + "rep" + "Selector").on("change", updateChart);
 
+  /**
+   * Offers the DTW similarity only for the modes that support it, keeping
+   * the selected similarity if it is still offered, then updates the chart.
+   */
+  async function updateMode() {
+    const currentMode = d3.select("select#modeSelector").property("value");
+    const currentSimilarity = d3.select("select#similaritySelector")
+        .property("value");
+    const options = dtwModes.includes(currentMode) ? similarity :
+        similarity.filter((elt) => elt != "DTW");
+    updateSelector("similarity", options);
+    d3.select("select#similaritySelector").property("value",
+        options.includes(currentSimilarity) ? currentSimilarity : options[0]);
+    await updateChart();
+  }
+
   /**
    * Updates the chart according to the values of the selectors.
    */
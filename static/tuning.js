@@ -1,5 +1,7 @@
 /**
  * Draws a graph for each shart, showing the results of the tuning algorithm.
+ * For k-means, the fast tuning mode is used and the knee of the curve is
+ * marked.
  * @param {string} mode The algorithm for which a paramter is being tuned.
  * @param {string} similarity The similarity measure used for clustering.
  * @param {string} encoding The encoding for the labels.
@@ -12,11 +14,30 @@ const tuning = async (mode, similarity, encoding) => {
 
   for (let index = 0; index < chartIds.length; index++) {
     try {
-      const response = await callFetch("tuning/" + mode + "/" + similarity +
-      "/" + encoding + "/" + chartIds[index]);
-      const distances = await response.json();
+      let query = "tuning/" + mode + "/" + similarity + "/" + encoding + "/" +
+        chartIds[index];
+      if (mode == "k-means") {
+        query = query + "?mode=fast";
+      }
+      const response = await callFetch(query);
+      const result = await response.json();
 
-      const points = distances.map((elt, index) => index+1);
+      let points;
+      let distances;
+      const traces = [];
+      if (mode == "k-means") {
+        points = result["ks"];
+        distances = result["inertia"];
+      } else {
+        distances = result;
+        points = distances.map((elt, index) => index+1);
+      }
+      traces.push({x: points, y: distances});
+      if (mode == "k-means" && result["knee"] !== null) {
+        traces.push({x: [result["knee"]],
+          y: [distances[points.indexOf(result["knee"])]], mode: "markers",
+          name: "knee"});
+      }
 
       d3.select("body")
           .append("div")
@@ -26,7 +47,7 @@ const tuning = async (mode, similarity, encoding) => {
       const chart = document.getElementById('tuningChart' + chartIds[index] +
       similarity);
 
-      Plotly.newPlot(chart, [{x: points, y: distances}],
+      Plotly.newPlot(chart, traces,
           {margin: {t: 30, l: 50, b: 80, r: 20}, title: mode + "-" + similarity,
             xaxis: {title: xLabel[mode]}, yaxis: {title: yLabel[mode]}});
     } catch (error) {
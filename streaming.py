@@ -0,0 +1,118 @@
+"""This module reads large chart files incrementally. Only one time
+series object is decoded at a time, instead of the whole document.
+"""
+import json
+import re
+import numpy as np
+import clustering
+
+# Number of characters read from the file at a time.
+CHUNK_SIZE = 1 << 20
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+class _Reader:
+    """Decodes json values from a text file, one value at a time."""
+
+    def __init__(self, json_file, chunk_size):
+        self.json_file = json_file
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+
+    def fill(self):
+        """Reads more of the file into the buffer. The amount read grows
+        with the buffer so that large values are not decoded over and
+        over. Returns False at the end of the file."""
+        remaining = len(self.buffer) - self.pos
+        chunk = self.json_file.read(max(self.chunk_size, remaining))
+        if not chunk:
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Skips whitespace and returns the next character."""
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                raise ValueError("Unexpected end of the json file")
+
+    def expect(self, chars):
+        """Consumes the next character, which must be one of chars, and
+        returns it."""
+        char = self.peek()
+        if char not in chars:
+            raise ValueError("Expected one of " + repr(chars) + " but found " +
+                             repr(char))
+        self.pos += 1
+        return char
+
+    def decode(self):
+        """Decodes and returns the next json value."""
+        self.peek()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self.buffer, self.pos)
+                # A number at the end of the buffer may be cut off.
+                if end < len(self.buffer) or not self.fill():
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+
+def iter_time_series(json_file, chunk_size=CHUNK_SIZE):
+    """Yields the time series objects of a chart one at a time.
+
+    Args:
+        json_file: A chart file opened in text mode.
+        chunk_size: Number of characters read from the file at a time.
+
+    Yields:
+        Each element of the top level "timeSeries" array, in order.
+        Other top level values are skipped.
+    """
+    reader = _Reader(json_file, chunk_size)
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+    while True:
+        key = reader.decode()
+        reader.expect(":")
+        if key == "timeSeries":
+            reader.expect("[")
+            if reader.peek() == "]":
+                reader.pos += 1
+            else:
+                while True:
+                    yield reader.decode()
+                    if reader.expect(",]") == "]":
+                        break
+        else:
+            reader.decode()
+        if reader.expect(",}") == "}":
+            return
+
+def time_series_array(path, key, dtype=np.float64, missing=-1,
+                      chunk_size=CHUNK_SIZE):
+    """Builds the same output as clustering.time_series_array from the
+    chart file at path without loading the whole document.
+
+    Args:
+        path: The path of the chart file.
+        key: The key for the time series labels that are saved. If None,
+            then all label values may be kept, otherwise only label
+            values with that key are kept.
+        dtype: The float type of the data array.
+        missing: The value of missing points, -1 or np.nan.
+        chunk_size: Number of characters read from the file at a time.
+    """
+    with open(path, "r") as json_file:
+        flat = clustering.flatten_time_series(
+            iter_time_series(json_file, chunk_size), key)
+    return clustering.build_arrays(flat, key, dtype, missing)
@@ -0,0 +1,64 @@
+import unittest
+import numpy as np
+from cache import LRUCache
+
+class TestLRUCache(unittest.TestCase):
+    """Tests the LRU cache."""
+
+    def test_get_hit_miss(self):
+        """Should return the cached value and count hits and misses."""
+        cache = LRUCache(1000)
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", np.zeros(10))
+        self.assertEqual(cache.get("a").tolist(), [0] * 10)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_signature_mismatch(self):
+        """Should drop the entry when the signature changed."""
+        cache = LRUCache(1000)
+        cache.put("a", np.zeros(10), (1, 80))
+        self.assertIsNone(cache.get("a", (2, 80)))
+        self.assertNotIn("a", cache)
+        self.assertEqual(cache.current_bytes, 0)
+
+    def test_evict_least_recently_used(self):
+        """Should evict the least recently used entries once max_bytes
+        is exceeded."""
+        cache = LRUCache(200)
+        cache.put("a", np.zeros(10))
+        cache.put("b", np.zeros(10))
+        cache.get("a")
+        cache.put("c", np.zeros(10))
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertIn("c", cache)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.current_bytes, 160)
+
+    def test_too_large(self):
+        """Should not cache values larger than max_bytes."""
+        cache = LRUCache(10)
+        cache.put("a", np.zeros(10))
+        self.assertEqual(len(cache), 0)
+
+    def test_resize(self):
+        """Should measure a value again after it grew and evict the least
+        recently used entries, or the value once it is too large."""
+        cache = LRUCache(10, sizeof=len)
+        cache.put("a", [0] * 4)
+        cache.put("b", [0] * 4)
+        value = cache.get("b")
+        value.extend([0] * 3)
+        cache.resize("b")
+        self.assertNotIn("a", cache)
+        self.assertIn("b", cache)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.current_bytes, 7)
+        value.extend([0] * 4)
+        cache.resize("b")
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.current_bytes, 0)
+        cache.resize("b")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,24 @@
 import unittest
 import json
+import os
+import tempfile
+import warnings
+from concurrent.futures.process import BrokenProcessPool
+from unittest import mock
 import numpy as np
+from scipy import sparse
+from scipy.spatial.distance import pdist
+from sklearn.cluster import DBSCAN, KMeans
+from sklearn.decomposition import PCA, IncrementalPCA
+import charts
 import clustering
 
 
+def exit_worker(data, code):
+    """Ends the worker process that calls it, see parallel_map."""
+    os._exit(code)
+
+
 class TestClusteringMethods(unittest.TestCase):
     """Tests clustering methods. """
 
@@ -41,6 +56,144 @@ class TestClusteringMethods(unittest.TestCase):
         self.assertEqual(label_dict, {'us-central1-a': 0})
         self.assertEqual(instance_labels.tolist(), [[0], [1], [1], [1]])
 
+    def test_flatten_time_series(self):
+        """Should flatten the points of each time series and index the
+        dates in the order they are first seen."""
+        time_series = [
+            {"metric": {"labels": {"name": "a"}},
+             "resource": {"labels": {"zone": "east"}},
+             "points": [{"interval": {"startTime": "t1"},
+                         "value": {"doubleValue": 4.0}},
+                        {"interval": {"startTime": "t0"},
+                         "value": {"doubleValue": 2.0}}]},
+            {"metric": {"labels": {"name": "b"}},
+             "resource": {"labels": {"zone": "east"}},
+             "points": [{"interval": {"startTime": "t0"},
+                         "value": {"doubleValue": 6.0}}]}]
+        flat = clustering.flatten_time_series(time_series, None)
+        self.assertEqual(flat["counts"].tolist(), [2, 1])
+        self.assertEqual(flat["date_indexes"].tolist(), [0, 1, 1])
+        self.assertEqual(flat["values"].tolist(), [4.0, 2.0, 6.0])
+        self.assertEqual(flat["date_to_index"], {"t1": 0, "t0": 1})
+        self.assertEqual(flat["label_to_count"], {"a": 1, "b": 1, "east": 2})
+
+        np_data, label_dict, instance_labels, _, min_max = (
+            clustering.build_arrays(flat, None))
+        self.assertEqual(np_data.tolist(), [[5, 0], [-1, 10]])
+        self.assertEqual(label_dict, {})
+        self.assertEqual(instance_labels.shape, (2, 0))
+        self.assertEqual(min_max, [2.0, 6.0])
+
+    def test_time_series_array_float32(self):
+        """Should build the data array with the requested float type."""
+        with open('./data/chart-101.json', "r") as json_file:
+            data = json.load(json_file)
+        np_data, _, _, _, _ = clustering.time_series_array(data, None,
+                                                           np.float32)
+        self.assertEqual(np_data.dtype, np.float32)
+        self.assertEqual(np_data.tolist(), [[0, -1], [0, 10], [0, 10], [0, 10]])
+
+    def test_preprocess_float32(self):
+        """Should keep float32 data in float32 for every option."""
+        rng = np.random.RandomState(0)
+        data = rng.uniform(0, 10, (20, 8)).astype(np.float32)
+        instance_labels = rng.randint(0, 2, (20, 3))
+        for encoding in ["none", "one-hot"]:
+            for similarity in ["proximity", "correlation"]:
+                for algorithm in ["k-means", "dbscan"]:
+                    result = clustering.preprocess(data, encoding, similarity,
+                                                   instance_labels, algorithm)
+                    self.assertEqual(result.dtype, np.float32)
+
+    def test_float32_same_clusters(self):
+        """Clustering the fixture charts loaded in float32 should give the
+        same clusters as in float64, without numerical warnings."""
+        for chart_id in ["002", "100", "101", "102"]:
+            results = []
+            for dtype in [np.float64, np.float32]:
+                data, label_dict, ts_to_labels, _, _ = charts.load_arrays(
+                    chart_id, None, dtype)
+                self.assertEqual(data.dtype, dtype)
+                data = clustering.impute(data)
+                labels = []
+                with warnings.catch_warnings():
+                    warnings.simplefilter("error", UserWarning)
+                    for encoding in ["none", "one-hot"]:
+                        preprocessed = clustering.preprocess(
+                            data, encoding, "proximity", ts_to_labels,
+                            "k-means")
+                        self.assertEqual(preprocessed.dtype, dtype)
+                        tree = clustering.linkage_tree(preprocessed)
+                        labels.append(clustering.agglomerative(
+                            tree, "on", lambda: preprocessed).tolist())
+                        if len(data) <= clustering.KMEANS_MIN:
+                            continue
+                        labels.append(clustering.kmeans(preprocessed,
+                                                        "on").tolist())
+                        for algorithm in ["k-medians", "k-means-constrained"]:
+                            labels.append(clustering.kmeans_kmedians(
+                                preprocessed, label_dict, ts_to_labels,
+                                algorithm, "on").tolist())
+                        labels.append(clustering.dbscan(
+                            clustering.preprocess(data, encoding,
+                                                  "correlation",
+                                                  ts_to_labels, "dbscan"),
+                            "correlation", encoding, "on").tolist())
+                results.append(labels)
+            self.assertEqual(results[0], results[1])
+
+    def test_parse_dates(self):
+        """Should convert the dates to seconds since the epoch."""
+        result = clustering.parse_dates(["1970-01-01T00:01:00Z",
+                                         "2020-06-26T11:29:00.500Z"])
+        self.assertEqual(result.tolist(), [60, 1593170940])
+        self.assertEqual(clustering.format_dates(result),
+                         ["1970-01-01T00:01:00Z", "2020-06-26T11:29:00Z"])
+
+    def test_resample(self):
+        """Should merge the dates in the same time bucket, sort the
+        buckets and combine the values according to the aggregation."""
+        nan = np.nan
+        data = np.array([[1., nan, 3, 4, 5],
+                         [nan, nan, nan, 2, nan]])
+        date_to_index = {"2020-06-26T11:29:30Z": 0,
+                         "2020-06-26T11:29:10Z": 1,
+                         "2020-06-26T11:28:50Z": 2,
+                         "2020-06-26T11:28:00Z": 3,
+                         "2020-06-26T11:30:00Z": 4}
+        solutions = {"mean": [[3.5, 1, 5], [2, nan, nan]],
+                     "max": [[4, 1, 5], [2, nan, nan]],
+                     "last": [[3, 1, 5], [2, nan, nan]]}
+        for aggregation, solution in solutions.items():
+            result, bucket_to_index = clustering.resample(
+                data, date_to_index, 60, aggregation)
+            np.testing.assert_array_equal(result, solution)
+            self.assertEqual(bucket_to_index, {"2020-06-26T11:28:00Z": 0,
+                                               "2020-06-26T11:29:00Z": 1,
+                                               "2020-06-26T11:30:00Z": 2})
+
+    def test_impute(self):
+        """Missing values should be filled according to the strategy,
+        following the time order of the dates."""
+        nan = np.nan
+        data = np.array([[nan, 2., nan, 8],
+                         [1, nan, nan, nan],
+                         [nan, nan, nan, nan]])
+        date_to_index = {"2020-06-26T11:00:00Z": 0,
+                         "2020-06-26T11:01:00Z": 1,
+                         "2020-06-26T11:04:00Z": 2,
+                         "2020-06-26T11:02:00Z": 3}
+        solutions = {"sentinel": [[-1, 2, -1, 8], [1, -1, -1, -1],
+                                  [-1, -1, -1, -1]],
+                     "median": [[5, 2, 5, 8], [1, 1, 1, 1], [-1, -1, -1, -1]],
+                     "ffill": [[2, 2, 8, 8], [1, 1, 1, 1], [-1, -1, -1, -1]],
+                     "linear": [[2, 2, 8, 8], [1, 1, 1, 1], [-1, -1, -1, -1]]}
+        for strategy, solution in solutions.items():
+            result = clustering.impute(data, strategy, date_to_index)
+            self.assertEqual(result.tolist(), solution)
+        result = clustering.impute(data[:1], "linear")
+        self.assertEqual(result.tolist(), [[2, 2, 5, 8]])
+
     def test_preprocess_one_hot_correlation(self):
         """Data should be shifted to 0 and the encoded labeled should be
         appended."""
@@ -74,6 +227,16 @@ class TestClusteringMethods(unittest.TestCase):
                 [-1, 3.9998, 4.929278, 4.9389, 1, 0]]
         self.assertEqual(result.tolist(), data)
 
+    def test_preprocess_one_hot_sparse(self):
+        """Should append sparse labels as a sparse matrix."""
+        data = [[1.5, 2.5], [3.5, -1]]
+        instance_labels = sparse.csr_matrix([[0, 1, 0], [1, 0, 0]])
+        result = clustering.preprocess(np.array(data), "one-hot", "proximity",
+                                       instance_labels, "k-means")
+        self.assertTrue(sparse.isspmatrix_csr(result))
+        self.assertEqual(result.toarray().tolist(),
+                         [[1.5, 2.5, 0, 1, 0], [3.5, -1, 1, 0, 0]])
+
     def test_preprocess_none_proximity(self):
         """Data should not be changed."""
         data = [[1.883, 2.9374874, 3.927837, -1],
@@ -106,6 +269,40 @@ class TestClusteringMethods(unittest.TestCase):
                     [0, 2.7988, 3.929278, 3.93081]]
         self.assertEqual(result.tolist(), solution)
 
+    def test_paa(self):
+        """Should average the dates of each segment, in time order, and
+        scale the means so that distances lower-bound the full ones."""
+        data = np.array([[1., 2, 3, 4, 5], [5, 4, 3, 2, 1]])
+        scale = np.sqrt(5 / 2)
+        np.testing.assert_allclose(clustering.paa(data, 2),
+                                   np.array([[1.5, 4], [4.5, 2]]) * scale)
+        date_to_index = {"2020-06-26T11:0%d:00Z" % minute: index
+                         for index, minute in enumerate([4, 3, 2, 1, 0])}
+        np.testing.assert_allclose(clustering.paa(data, 2, date_to_index),
+                                   np.array([[4.5, 2], [1.5, 4]]) * scale)
+        self.assertIs(clustering.paa(data, 5), data)
+        series = np.random.RandomState(0).rand(6, 40)
+        self.assertTrue(np.all(pdist(clustering.paa(series, 8)) <=
+                               pdist(series)))
+
+    def test_sax(self):
+        """Should map the standardized values to equally likely symbols
+        scaled to [0, 10]."""
+        data = np.array([[1., 2, 3, 4], [8, 8, 8, 8]], dtype=np.float32)
+        result = clustering.sax(data, 3)
+        self.assertEqual(result.dtype, np.float32)
+        self.assertEqual(result.tolist(), [[0, 0, 10, 10], [5, 5, 5, 5]])
+
+    def test_preprocess_reduced(self):
+        """Should reduce the dates before encoding the labels."""
+        data = np.random.RandomState(0).rand(8, 12)
+        instance_labels = np.eye(8)[:, :2]
+        result = clustering.preprocess(data, "one-hot", "proximity",
+                                       instance_labels, "k-means",
+                                       segments=4, alphabet_size=4)
+        self.assertEqual(result.shape, (8, 6))
+        self.assertEqual(result[:, 4:].tolist(), instance_labels.tolist())
+
     def test_scale_to_range_ten_stay(self):
         """Should not change the value."""
         result = clustering.scale_to_range([0.0, 10.0], 7.0)
@@ -189,6 +386,49 @@ class TestClusteringMethods(unittest.TestCase):
                     [0, 0, 0]]
         self.assertEqual(result.tolist(), solution)
 
+    def test_cluster_to_labels_sparse(self):
+        """Should return the same percentages for a sparse label matrix."""
+        cluster_labels = [0, 0, 1, 0, 2]
+        resource_label = [[1, 1, 0],
+                          [1, 1, 1],
+                          [1, 1, 1],
+                          [0, 1, 1],
+                          [0, 0, 0]]
+        result = clustering.cluster_to_labels(
+            cluster_labels, sparse.csr_matrix(resource_label))
+        solution = clustering.cluster_to_labels(cluster_labels,
+                                                np.array(resource_label))
+        self.assertEqual(result.tolist(), solution.tolist())
+
+    def test_cluster_to_labels_one_based(self):
+        """Should accept the 1-based cluster labels of the clustering
+        algorithms."""
+        resource_label = np.eye(3)[[0, 1, 2, 2]]
+        result = clustering.cluster_to_labels(np.array([1, 1, 2, 2]),
+                                              resource_label)
+        self.assertEqual(result.tolist(), [[0.5, 0.5, 0], [0, 0, 1]])
+
+    def test_sort_labels_sparse(self):
+        """Should sort the columns of a sparse label matrix."""
+        label_dict = {"west": 0, "east": 1}
+        cluster_labels = np.array([[0.5, 1]])
+        ts_to_labels = sparse.csr_matrix([[1, 0], [0, 1]])
+        labels, clusters, ts_labels = clustering.sort_labels(
+            label_dict, cluster_labels, ts_to_labels)
+        self.assertEqual(labels, ["east", "west"])
+        self.assertEqual(clusters.tolist(), [[1, 0.5]])
+        self.assertEqual(ts_labels.toarray().tolist(), [[0, 1], [1, 0]])
+
+    def test_outliers_sparse(self):
+        """Should mark the same outliers for sparse data."""
+        data = np.array([[0, 10, 9, 7], [1, 7, 9, 6], [3, 4, 3, 3],
+                         [4, 3, 4, 3]])
+        ts_cluster_labels = np.array([1, 1, 2, 2])
+        cluster_centers = np.array([[0.5, 0, 9, 2], [3.5, 3.5, 3.5, 3]])
+        clustering.outliers_kmeans(sparse.csr_matrix(data), ts_cluster_labels,
+                                   cluster_centers)
+        self.assertEqual(ts_cluster_labels.tolist(), [-1, -1, 2, 2])
+
     def test_outliers_simple(self):
         """Should not make any of the cluster labels outliers."""
         data = np.array([[0, 10, 9, 7], [1, 7, 9, 6], [3, 4, 3, 3],
@@ -209,6 +449,35 @@ class TestClusteringMethods(unittest.TestCase):
         clustering.outliers_kmeans(data, ts_cluster_labels, cluster_centers)
         self.assertEqual(ts_cluster_labels.tolist(), solution.tolist())
 
+    def test_outliers_scores(self):
+        """Should return the distances divided by the threshold, reusing the
+        given distances."""
+        data = np.zeros((3, 2))
+        ts_cluster_labels = np.array([1, 1, 2])
+        distances = np.array([0, 13.5, 6.75])
+        scores = clustering.outliers_kmeans(data, ts_cluster_labels,
+                                            np.zeros((2, 2)),
+                                            distances=distances)
+        self.assertEqual(scores.tolist(), [0, 2, 1])
+        self.assertEqual(ts_cluster_labels.tolist(), [1, -1, 2])
+
+    def test_outlier_thresholds_adaptive(self):
+        """Should set the threshold of each cluster from the median and the
+        median absolute deviation of its distances."""
+        distances = np.array([1, 2, 3, 10, 0.5, 0.5])
+        labels = np.array([1, 1, 1, 1, 2, 2])
+        thresholds = clustering.outlier_thresholds(distances, labels,
+                                                   "adaptive")
+        # The median of cluster 1 is 2.5 and its deviations are 1.5, 0.5,
+        # 0.5 and 7.5.
+        self.assertEqual(thresholds.tolist(), [5.5] * 4 + [0.5] * 2)
+        ts_cluster_labels = np.copy(labels)
+        scores = clustering.outliers_kmeans(
+            np.zeros((6, 1)), ts_cluster_labels, np.zeros((2, 1)),
+            "adaptive", distances)
+        self.assertEqual(ts_cluster_labels.tolist(), [1, 1, 1, -1, 2, 2])
+        self.assertAlmostEqual(scores[3], 10 / 5.5)
+
     def test_cluster_medians(self):
         """Should return the cluster medians."""
         data = np.array([[0, 10, 9, 7], [1, 7, 9, 6], [3, 4, 3, 3],
@@ -236,6 +505,299 @@ class TestClusteringMethods(unittest.TestCase):
         solution = [[1, 7, 9, 6], [3.5, 3.5, 3.5, 3]]
         result, _ = clustering.cluster_medians(data, cluster_assignment)
         self.assertEqual(result.tolist(), solution)
+    def test_cluster_medians_outliers(self):
+        """Should skip the outliers (-1) and return False when a cluster
+        is empty."""
+        data = np.array([[0, 10], [1, 7], [3, 4], [4, 3]])
+        result, valid = clustering.cluster_medians(data, np.array([0, -1, 0,
+                                                                   1]))
+        self.assertEqual(result.tolist(), [[1.5, 7], [4, 3]])
+        self.assertTrue(valid)
+        _, valid = clustering.cluster_medians(data, np.array([0, 2, 0, 2]))
+        self.assertFalse(valid)
+
+    def test_clusters_min_max(self):
+        """Should return the bands of the clusters without the outliers,
+        skipping the missing values."""
+        data = np.array([[1, -1, 3], [5, 2, np.nan], [0, 4, 6], [9, 9, 9],
+                         [2, -1, np.nan]])
+        dates = {"b": 1, "a": 0, "c": 2}
+        min_max, ordered_dates, outlier_indexes = clustering.clusters_min_max(
+            data, [2, 2, 2, -2, 4], dates, [0, 10], "on")
+        self.assertEqual(ordered_dates, ["a", "b", "c"])
+        self.assertEqual(outlier_indexes, [3])
+        self.assertEqual(min_max, [[[0] * 3, [0] * 3],
+                                   [[0, 2, 3], [5, 4, 6]],
+                                   [[0] * 3, [0] * 3],
+                                   [[2, 0, 0], [2, 0, 0]]])
+        min_max, _, outlier_indexes, band_stats = clustering.clusters_min_max(
+            data, [2, 2, 2, -2, 4], dates, [0, 10], "off", True)
+        self.assertEqual(outlier_indexes, [])
+        self.assertEqual(min_max[1], [[0, 2, 3], [9, 9, 9]])
+        self.assertEqual(set(band_stats), set(clustering.BAND_STATISTICS))
+        self.assertEqual(band_stats["p50"][1], [3, 4, 6])
+        self.assertEqual(band_stats["mean"][1], [3.75, 5, 6])
+        self.assertEqual(band_stats["mean"][3], [2, 0, 0])
+
+    def test_assign_clusters_manhattan(self):
+        """Should assign each time series to the closest centroid for
+        the given metric."""
+        data = np.array([[0, 0], [3, 3]])
+        centroids = np.array([[2.5, 0], [1.6, 1.6]])
+        self.assertEqual(clustering.assign_clusters(
+            data, centroids, {}, {}).tolist(), [1, 1])
+        self.assertEqual(clustering.assign_clusters(
+            data, centroids, {}, {}, "manhattan").tolist(), [0, 1])
+
+    def test_assign_clusters_dtw(self):
+        """Should match time series to the centroids of the same shape
+        shifted in time, and keep the constraints."""
+        data = np.array([[0, 0, 5, 0, 0, 0], [0, 0, 0, 0, 5, 0]], dtype=float)
+        centroids = np.array([[0, 0, 0, 5, 0, 0], [1, 1, 1, 1, 1, 1]],
+                             dtype=float)
+        self.assertEqual(clustering.assign_clusters(
+            data, centroids, {}, {}).tolist(), [1, 1])
+        self.assertEqual(clustering.assign_clusters(
+            data, centroids, {}, {}, "dtw", 6).tolist(), [0, 0])
+        self.assertEqual(clustering.assign_clusters(
+            data, centroids, {}, {0: [1], 1: [0]}, "dtw", 6).tolist(), [0, 1])
+
+    def test_dbscan_dtw(self):
+        """Should group the time series of the same shape shifted in
+        time."""
+        shape = np.array([0, 0, 0, 9, 9, 0, 0, 0, 0, 0, 0, 0], dtype=float)
+        data = np.array([np.roll(shape, shift) for shift in [0, 1, 5, 6]])
+        self.assertEqual(clustering.dbscan(data, "dtw", "none", "off",
+                                           num_dates=12).tolist(),
+                         [1, 1, 2, 2])
+        labels = np.array([[1, 0], [1, 0], [0, 1], [0, 1]], dtype=float)
+        self.assertEqual(clustering.dbscan(np.hstack((data, labels)), "dtw",
+                                           "one-hot", "off",
+                                           num_dates=12).tolist(),
+                         [1, 1, 2, 2])
+
+    def test_tuning_eps_options(self):
+        """Should count the clusters and outliers dbscan finds for each
+        eps."""
+        data = np.array([[0, 0], [0, 1], [0, 2.5], [5, 5], [5, 6], [9, 9]])
+        result = clustering.tuning_eps_options(data, 1, 1.6, 1)
+        self.assertEqual([option[:2] for option in result],
+                         [(1, 3), (2, 3), (2, 3), (2, 3), (2, 3), (2, 3)])
+        for num_outliers, num_clusters, eps in result:
+            labels = DBSCAN(eps=eps, min_samples=2).fit(data).labels_
+            self.assertEqual(num_outliers, np.sum(labels == -1))
+            self.assertEqual(num_clusters, len(np.unique(labels)))
+
+    def test_fit_pca_solvers(self):
+        """Should keep the same components with the exact, randomized and
+        incremental solvers."""
+        rng = np.random.RandomState(0)
+        data = rng.rand(600, 8) @ rng.rand(8, 600) + rng.normal(
+            0, 0.01, (600, 600))
+        exact = clustering.fit_pca(data[:, :400], .85)
+        self.assertEqual(exact["solver"], "exact")
+        self.assertGreater(np.sum(exact["explained_variance_ratio"]), .85)
+        randomized = clustering.fit_pca(data, .85)
+        self.assertEqual(randomized["solver"], "randomized")
+        with mock.patch.object(clustering, "PCA_INCREMENTAL_MIN_BYTES",
+                               data.nbytes):
+            incremental = clustering.fit_pca(data, .85)
+        self.assertEqual(incremental["solver"], "incremental")
+        full = PCA(n_components=.85).fit(data)
+        for projection in [randomized, incremental]:
+            self.assertEqual(len(projection["components"]),
+                             full.n_components_)
+            np.testing.assert_allclose(
+                np.abs(clustering.project(data, projection)),
+                np.abs(full.transform(data)), atol=1e-3)
+
+    def test_fit_pca_memmap(self):
+        """A memory-mapped matrix should get the same solver and projection
+        as the same matrix in memory."""
+        data = np.random.RandomState(0).rand(40, 12)
+        with tempfile.TemporaryDirectory() as path:
+            mapped = np.lib.format.open_memmap(
+                os.path.join(path, "data.npy"), mode="w+", shape=data.shape)
+            mapped[:] = data
+            projection = clustering.fit_pca(mapped, .85)
+            del mapped
+        expected = clustering.fit_pca(data, .85)
+        self.assertEqual(projection["solver"], expected["solver"])
+        np.testing.assert_allclose(projection["components"],
+                                   expected["components"])
+
+    def test_fit_pca_transform_batches(self):
+        """Should fit a large matrix incrementally, transforming one batch
+        of rows at a time, as IncrementalPCA on the transformed matrix."""
+        rng = np.random.RandomState(0)
+        data = rng.rand(250, 8) @ rng.rand(8, 40)
+        data[rng.rand(*data.shape) < .05] = np.nan
+        sizes = []
+
+        def transform(rows):
+            sizes.append(len(rows))
+            return clustering.paa(clustering.impute(rows, "median"), 20)
+        with mock.patch.object(clustering, "PCA_INCREMENTAL_MIN_BYTES", 1), \
+                mock.patch.object(clustering, "PCA_BATCH_SIZE", 60):
+            projection = clustering.fit_pca(data, .85, transform)
+        self.assertEqual(projection["solver"], "incremental")
+        self.assertEqual(sizes, [1, 60, 60, 60, 70])
+        full = IncrementalPCA(n_components=20, batch_size=60).fit(
+            transform(data))
+        np.testing.assert_allclose(
+            projection["components"],
+            full.components_[:len(projection["components"])], atol=1e-8)
+
+    def test_preprocess_imputation(self):
+        """Should impute, reduce and project the rows for dbscan one batch
+        at a time, as on the imputed matrix."""
+        rng = np.random.RandomState(0)
+        data = rng.rand(50, 8) @ rng.rand(8, 30)
+        data[rng.rand(*data.shape) < .1] = np.nan
+        for similarity in ["proximity", "correlation"]:
+            expected = clustering.preprocess(
+                clustering.impute(data, "linear"), "none", similarity, None,
+                "dbscan", segments=10)
+            with mock.patch.object(clustering, "PCA_BATCH_SIZE", 7):
+                result = clustering.preprocess(
+                    data, "none", similarity, None, "dbscan", segments=10,
+                    imputation="linear")
+            np.testing.assert_allclose(result, expected, atol=1e-10)
+
+    def test_preprocess_projection(self):
+        """Should apply the given projection instead of fitting one."""
+        data = np.random.RandomState(0).rand(20, 6)
+        projection = clustering.dbscan_projection(data, "correlation")
+        self.assertEqual(
+            clustering.preprocess(data, "none", "correlation", None, "dbscan",
+                                  projection).tolist(),
+            clustering.preprocess(data, "none", "correlation", None,
+                                  "dbscan").tolist())
+
+    def test_knee(self):
+        """Should return the k where the curve flattens."""
+        self.assertEqual(clustering.knee([1, 2, 3, 4, 5, 6],
+                                         [100, 40, 10, 8, 7, 6]), 3)
+        self.assertEqual(clustering.knee([1], [100]), 1)
+
+    def test_tuning_k_fast(self):
+        """Should find the number of groups of the time series and match
+        the inertia of tuning_k."""
+        rng = np.random.RandomState(0)
+        data = rng.rand(5, 20)[np.repeat(np.arange(5), 12)] * 10 + \
+            rng.normal(0, 0.1, (60, 20))
+        result = clustering.tuning_k_fast(data)
+        self.assertEqual(result["knee"], 5)
+        inertia = clustering.tuning_k(data)
+        for k, value in zip(result["ks"], result["inertia"]):
+            self.assertLessEqual(value, inertia[k - 1] * 1.01)
+
+    def test_tuning_k_fast_workers(self):
+        """Should spread the fits between the neighbors of the knee over
+        the worker processes and find the same curve as in the calling
+        process."""
+        rng = np.random.RandomState(0)
+        data = rng.rand(8, 10)[np.repeat(np.arange(8), 12)] * 10 + \
+            rng.normal(0, 0.1, (96, 10))
+        serial = clustering.tuning_k_fast(data)
+        with mock.patch.object(clustering, "parallel_map",
+                               wraps=clustering.parallel_map) as parallel:
+            result = clustering.tuning_k_fast(data, workers=2)
+        self.assertEqual(parallel.call_count, 1)
+        self.assertEqual(parallel.call_args[0][3], 2)
+        self.assertEqual(result["ks"], serial["ks"])
+        np.testing.assert_allclose(result["inertia"], serial["inertia"])
+        self.assertEqual(result["knee"], serial["knee"])
+
+    def test_fit_kmeans_warm_start(self):
+        """Should start from the given centroids and only add a single
+        k-means++ initialization, without a full fit from scratch."""
+        rng = np.random.RandomState(0)
+        data = rng.rand(40, 5)
+        centers, _ = clustering.fit_kmeans(data, 3)
+        fits = []
+        with mock.patch.object(clustering, "KMeans", side_effect=lambda **kwargs:
+                               fits.append(kwargs) or KMeans(**kwargs)):
+            new_centers, _ = clustering.fit_kmeans(data, 5, centers)
+        self.assertEqual(len(new_centers), 5)
+        self.assertEqual(len(fits), 2)
+        self.assertTrue(all(fit["n_init"] == 1 for fit in fits))
+        np.testing.assert_array_equal(fits[0]["init"][:3], centers)
+
+    def test_mini_batch_kmeans(self):
+        """Should use the same number of clusters as kmeans and label
+        the outliers with negative labels."""
+        data = np.random.RandomState(0).rand(60, 5)
+        labels = clustering.mini_batch_kmeans(data, "off", batch_size=16)
+        self.assertEqual(len(np.unique(labels)), 60 // clustering.KMEANS_RATIO
+                         + clustering.KMEANS_MIN)
+        outliers = clustering.mini_batch_kmeans(data, "on", batch_size=16)
+        self.assertEqual(np.abs(outliers).tolist(), labels.tolist())
+
+    def test_agglomerative(self):
+        """Should cut the same linkage tree into the requested number of
+        clusters or at the requested distance."""
+        rng = np.random.RandomState(0)
+        data = np.concatenate([rng.normal(center, .1, (10, 4))
+                               for center in [0, 5, 10]])
+        for method in clustering.LINKAGES:
+            tree = clustering.linkage_tree(data, method)
+            labels = clustering.agglomerative(tree, "off", None, 3)
+            self.assertEqual(len(np.unique(labels)), 3)
+            self.assertEqual(len(np.unique(labels[:10])), 1)
+            self.assertEqual(len(np.unique(clustering.agglomerative(
+                tree, "off", None, threshold=0))), 30)
+        default = clustering.agglomerative(tree, "off", None)
+        self.assertEqual(len(np.unique(default)), 30 // clustering.KMEANS_RATIO
+                         + clustering.KMEANS_MIN)
+        outliers = clustering.agglomerative(tree, "on", lambda: data)
+        self.assertEqual(np.abs(outliers).tolist(), default.tolist())
+        with mock.patch.object(clustering, "AGGLOMERATIVE_MAX_SERIES", 29):
+            with self.assertRaises(ValueError):
+                clustering.linkage_tree(data)
+
+    def test_warm_start(self):
+        """Should restart from the clusters of a previous assignment when
+        the time series got new points."""
+        rng = np.random.RandomState(0)
+        data = np.concatenate([rng.normal(center, .3, (10, 12))
+                               for center in range(0, 16, 2)])
+        extended = np.hstack((data, data[:, -2:] + .1))
+        instance_labels = np.zeros((len(data), 1), dtype=int)
+        for algorithm in ["k-medians", "k-means-constrained"]:
+            labels = clustering.kmeans_kmedians(data, {}, instance_labels,
+                                                algorithm, "off")
+            warm = clustering.kmeans_kmedians(extended, {}, instance_labels,
+                                              algorithm, "off",
+                                              init=labels - 1)
+            self.assertEqual(warm.tolist(), labels.tolist())
+        labels = clustering.kmeans(data, "off")
+        self.assertEqual(clustering.kmeans(extended, "off",
+                                           labels - 1).tolist(),
+                         labels.tolist())
+        self.assertIsNone(clustering.warm_start_centers(data, labels[1:] - 1,
+                                                        8))
+        self.assertIsNone(clustering.warm_start_centers(data, labels % 2, 8))
+
+    def test_kmeans_kmedians_workers(self):
+        """Should find the same clusters when the runs are spread over
+        several processes."""
+        data = np.random.RandomState(0).rand(40, 5)
+        self.assertEqual(
+            clustering.kmeans_kmedians(data, {}, None, "k-medians", "off",
+                                       workers=2).tolist(),
+            clustering.kmeans_kmedians(data, {}, None, "k-medians",
+                                       "off").tolist())
+
+    def test_parallel_map_broken_pool(self):
+        """Should start a new pool after a worker died."""
+        data = np.arange(6, dtype=float).reshape(3, 2)
+        with self.assertRaises(BrokenProcessPool):
+            clustering.parallel_map(exit_worker, data, [(1,)], 2)
+        self.assertIsNone(clustering._executor)
+        self.assertEqual(clustering.parallel_map(np.sum, data, [()], 2),
+                         [15])
+
     def test_add_link_add_index(self):
         """Should add indexes if not in link_dict."""
         must_link = {1: [2, 3], 3: [4, 5], 5: [1, 2]}
@@ -292,54 +854,143 @@ class TestClusteringMethods(unittest.TestCase):
                                           must_link, can_not_link)
         self.assertEqual(True, result)
 
-    def test_update_centroids_one_elt(self):
-        """Should update the centroids to equal the data elements."""
-        data = [[1, 1, 0],
-                [1, 1, 1],
-                [1, 1, 1],
-                [0, 1, 1]]
-        clusters = [[0], [3]]
-        centroids = np.array([[1, 1, 0], [0, 0, 0]])
-        valid = clustering.update_centroids(np.array(data), clusters, centroids)
-        result = [[1, 1, 0], [0, 1, 1]]
-        self.assertEqual(centroids.tolist(), result)
-        self.assertEqual(True, valid)
-
-    def test_update_centroids_false(self):
-        """Should return False because one cluster is empty."""
-        data = [[1, 1, 0], [0, 0, 0]]
-        clusters = [[0], []]
-        centroids = np.array([[1, 1, 0], [0, 0, 0]])
-        valid = clustering.update_centroids(np.array(data), clusters, centroids)
-        self.assertEqual(False, valid)
-
-    def test_update_centroids_multiple(self):
-        """Should update centroids to equal the mean."""
-        data = [[1, 1, 0],
-                [1, 1, 1],
-                [0, 1, 1],
-                [2, 3, 4]]
-        clusters = [[0, 1], [2, 3]]
-        centroids = np.array([[1.0, 1.0, 0.0], [0.0, 0.0, 0.0]])
-        valid = clustering.update_centroids(np.array(data), clusters, centroids)
-        result = [[1, 1, 1/2], [1, 2, 2.5]]
-        self.assertEqual(centroids.tolist(), result)
-        self.assertEqual(True, valid)
-
-    def test_update_clusters(self):
-        """Should update cluster assignment."""
-        data = [[1, 1, 0],
-                [1, 1, 1],
-                [0, 1, 1],
-                [2, 3, 4]]
-        clusters = [[0, 1], [2, 3]]
-        centroids = np.array([[1.0, 1.0, 0.0], [5.0, 2.0, 3.0]])
-        clusters, ts_cluster = clustering.update_clusters(data, centroids,
-                                                          {}, {})
-        result_clusters = [[0, 1, 2], [3]]
-        result_assignment = {0: 0, 1: 0, 2: 0, 3: 1}
-        self.assertEqual(clusters, result_clusters)
-        self.assertEqual(ts_cluster, result_assignment)
+    def test_assign_clusters_constraints(self):
+        """Should place the time series like the loop over every time
+        series in index order, each in its closest centroid without a
+        constraint violation, or in its closest centroid if every one
+        violates a constraint."""
+        rng = np.random.RandomState(0)
+        data = rng.rand(30, 4)
+        centroids = rng.rand(4, 4)
+        must_link, can_not_link = {}, {}
+        for ts_1, ts_2 in [(2, 7), (7, 11), (20, 25)]:
+            clustering.add_link(ts_1, ts_2, must_link)
+        for ts_1, ts_2 in [(2, 3), (11, 14), (25, 5), (14, 28)]:
+            clustering.add_link(ts_1, ts_2, can_not_link)
+        ts_to_cluster = {}
+        for ts_index, distances in enumerate(
+                clustering.pairwise_distances(data, centroids)):
+            options = np.argsort(distances)
+            ts_to_cluster[ts_index] = options[0]
+            for option in options:
+                if not clustering.violates_cons(option, ts_index,
+                                                ts_to_cluster, must_link,
+                                                can_not_link):
+                    ts_to_cluster[ts_index] = option
+                    break
+        assignment = clustering.assign_clusters(data, centroids, must_link,
+                                                can_not_link)
+        self.assertEqual(assignment.tolist(),
+                         [ts_to_cluster[index] for index in range(30)])
+        for ts_1, linked in must_link.items():
+            for ts_2 in linked:
+                self.assertEqual(assignment[ts_1], assignment[ts_2])
+        for ts_1, linked in can_not_link.items():
+            for ts_2 in linked:
+                self.assertNotEqual(assignment[ts_1], assignment[ts_2])
+
+    def test_kmeans_kmedians_run_max_iterations(self):
+        """Should stop after MAX_ITERATIONS assignments."""
+        data = np.random.RandomState(0).rand(60, 5)
+        with mock.patch.object(clustering, "MAX_ITERATIONS", 2), \
+                mock.patch.object(clustering, "assign_clusters",
+                                  wraps=clustering.assign_clusters) as assign:
+            run = clustering.kmeans_kmedians_run(data, 0, 6,
+                                                 "k-means-constrained", {}, {})
+        self.assertIsNotNone(run)
+        self.assertEqual(assign.call_count, 2)
+
+    def test_kmeans_kmedians_run_converged(self):
+        """Should stop once the centroids move by at most CONVERGENCE_TOL
+        times the mean variance of the columns."""
+        rng = np.random.RandomState(0)
+        data = np.concatenate([rng.normal(center, .1, (10, 3))
+                               for center in (0, 5, 10)])
+        means = np.array([data[index:index + 10].mean(axis=0)
+                          for index in (0, 10, 20)])
+        with mock.patch.object(clustering, "assign_clusters",
+                               wraps=clustering.assign_clusters) as assign:
+            run = clustering.kmeans_kmedians_run(
+                data, 0, 3, "k-means-constrained", {}, {}, centroids=means)
+        # The means do not move, so the first iteration converges.
+        self.assertEqual(assign.call_count, 1)
+        self.assertEqual(run[1].tolist(), [0] * 10 + [1] * 10 + [2] * 10)
+        with mock.patch.object(clustering, "CONVERGENCE_TOL", 0), \
+                mock.patch.object(clustering, "assign_clusters",
+                                  wraps=clustering.assign_clusters) as assign:
+            clustering.kmeans_kmedians_run(data, 0, 3, "k-means-constrained",
+                                           {}, {}, centroids=means + 1)
+        self.assertGreater(assign.call_count, 1)
+
+    def test_make_constraints_sparse(self):
+        """Should make the same constraints for a sparse label matrix."""
+        ts_to_labels = np.zeros((40, 6), dtype=int)
+        for index in range(40):
+            ts_to_labels[index][index % 3] = 1
+            ts_to_labels[index][3 + index % 2] = index % 5 != 0
+            ts_to_labels[index][5] = index % 7 == 0
+        solution = clustering.make_constraints(ts_to_labels)
+        result = clustering.make_constraints(sparse.csr_matrix(ts_to_labels))
+        self.assertEqual(result, solution)
+
+    def test_dense_label_patterns(self):
+        """Should group the rows by pattern in the order of np.unique."""
+        ts_to_labels = np.array([[1, 0], [0, 1], [1, 0], [0, 0], [0, 1]])
+        result = clustering.dense_label_patterns(ts_to_labels)
+        self.assertEqual([rows.tolist() for rows in result],
+                         [[3], [1, 4], [0, 2]])
+
+    def test_collapse_constraints(self):
+        """Should merge the time series that must link, directly or
+        through others, into weighted super-points."""
+        data = np.array([[0, 0], [2, 2], [4, 4], [6, 6], [8, 8]], dtype=float)
+        must_link = {3: [1], 1: [3, 4], 4: [1]}
+        can_not_link = {0: [3, 1], 3: [0], 1: [0, 4], 4: [1]}
+        self.assertEqual(clustering.must_link_components(
+            must_link, 5).tolist(), [0, 1, 2, 1, 1])
+        points, weights, components, point_can_not_link = \
+            clustering.collapse_constraints(data, must_link, can_not_link)
+        self.assertEqual(points.tolist(), [[0, 0], [16 / 3, 16 / 3], [4, 4]])
+        self.assertEqual(weights.tolist(), [1, 3, 1])
+        self.assertEqual(components.tolist(), [0, 1, 2, 1, 1])
+        self.assertEqual(point_can_not_link, {0: [1], 1: [0]})
+
+    def test_kmeans_kmedians_run_reseeds(self):
+        """Should reseed an empty cluster with the farthest time series
+        instead of giving up the run."""
+        data = np.array([[0, 0], [0, 1], [10, 10], [10, 11], [30, 30]],
+                        dtype=float)
+        # The first two centroids are equal, so the second one is empty.
+        centroids = np.array([[0, 0], [0, 0], [10, 10]], dtype=float)
+        for algorithm in ["k-medians", "k-means-constrained"]:
+            run = clustering.kmeans_kmedians_run(data, 0, 3, algorithm, {}, {},
+                                                 centroids=centroids)
+            self.assertIsNotNone(run)
+            self.assertEqual(np.bincount(run[1]).tolist(), [2, 1, 2])
+            self.assertEqual(run[1][4], 1)
+
+    def test_kmeans_kmedians_dtw_medoids(self):
+        """Should keep every cluster with DTW, whose centroids are
+        medoids."""
+        rng = np.random.RandomState(0)
+        data = rng.rand(40, 12)
+        labels = clustering.kmeans_kmedians(data, {}, None, "k-medians", "off",
+                                            num_dates=12)
+        self.assertEqual(sorted(set(labels)), list(range(1, 9)))
+
+    def test_kmeans_constrained_must_link(self):
+        """Should place the time series that must link together."""
+        rng = np.random.RandomState(0)
+        data = rng.rand(40, 5)
+        ts_to_labels = np.eye(8, dtype=int)[np.arange(40) % 8]
+        must_link, _ = clustering.make_constraints(ts_to_labels)
+        self.assertEqual(must_link, {3: [19], 19: [3]})
+        labels = clustering.kmeans_kmedians(data, {}, ts_to_labels,
+                                            "k-means-constrained", "off")
+        for ts_1, linked in must_link.items():
+            for ts_2 in linked:
+                self.assertEqual(labels[ts_1], labels[ts_2])
+
     def test_cluster_zone(self):
         """Should assign time series to the label which they have,
         according to ts_to_labels."""
@@ -357,6 +1008,9 @@ class TestClusteringMethods(unittest.TestCase):
         result = clustering.cluster_zone(label_dict, ts_to_labels)
         solution = ["south", "west", "north", "west", "east"]
         self.assertEqual(result, solution)
+        result = clustering.cluster_zone(label_dict,
+                                         sparse.csr_matrix(ts_to_labels))
+        self.assertEqual(result, solution)
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+import json
+import os
+import shutil
+import tempfile
+from unittest import mock
+import numpy as np
+import charts
+import clustering
+import columnar
+
+class TestColumnarMethods(unittest.TestCase):
+    """Tests the columnar chart format."""
+
+    def write_chart(self, path):
+        """Converts chart-101 to the columnar format at path and returns
+        the loaded json data."""
+        with open('./data/chart-101.json', "r") as json_file:
+            data = json.load(json_file)
+        series_labels = [[time_series["metric"]["labels"],
+                          time_series["resource"]["labels"]]
+                         for time_series in data["timeSeries"]]
+        columnar.write(path, clustering.time_series_array(data, None,
+                                                          missing=np.nan),
+                       series_labels)
+        return data
+
+    def assert_same_arrays(self, result, solution):
+        """Checks that two time_series_array tuples are equal."""
+        np.testing.assert_array_equal(result[0], solution[0])
+        self.assertEqual(result[1], solution[1])
+        self.assertEqual(result[2].tolist(), solution[2].tolist())
+        self.assertEqual(result[3], solution[3])
+        self.assertEqual(result[4], solution[4])
+
+    def test_round_trip(self):
+        """Should load the same arrays as the json file, with the values
+        memory-mapped."""
+        with tempfile.TemporaryDirectory() as path:
+            data = self.write_chart(path)
+            chart = columnar.ColumnarChart(path)
+            result = clustering.time_series_array(chart, None, missing=np.nan)
+            self.assertEqual(result[0].filename,
+                             os.path.abspath(os.path.join(path, "values.npy")))
+            self.assert_same_arrays(
+                result, clustering.time_series_array(data, None,
+                                                     missing=np.nan))
+            self.assert_same_arrays(
+                clustering.time_series_array(chart, None),
+                clustering.time_series_array(data, None))
+
+    def test_round_trip_key(self):
+        """Should rebuild the labels for the selected key."""
+        with tempfile.TemporaryDirectory() as path:
+            data = self.write_chart(path)
+            result = clustering.time_series_array(
+                columnar.ColumnarChart(path), "zone")
+            self.assert_same_arrays(
+                result, clustering.time_series_array(data, "zone"))
+
+    def test_older_version(self):
+        """Should refuse a chart of another version of the format, which
+        charts.load_arrays then reads from its json file."""
+        with tempfile.TemporaryDirectory() as directory:
+            shutil.copy('./data/chart-101.json',
+                        os.path.join(directory, "chart-v1.json"))
+            path = os.path.join(directory, "chart-v1")
+            data = self.write_chart(path)
+            meta_path = os.path.join(path, "meta.json")
+            with open(meta_path, "r") as meta_file:
+                meta = json.load(meta_file)
+            meta["version"] = 1
+            with open(meta_path, "w") as meta_file:
+                json.dump(meta, meta_file)
+            with self.assertRaises(columnar.UnsupportedVersionError):
+                columnar.ColumnarChart(path)
+            with mock.patch.object(charts, "DATA_DIR", directory):
+                self.assertEqual(charts.chart_signature("v1")[0], "columnar")
+                self.assert_same_arrays(
+                    charts.load_arrays("v1", None),
+                    clustering.time_series_array(data, None, missing=np.nan))
+
+if __name__ == '__main__':
+    unittest.main()
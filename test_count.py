@@ -1,5 +1,7 @@
 import unittest
 import json
+import numpy as np
+from scipy import sparse
 import count
 
 class TestCountMethods(unittest.TestCase):
@@ -140,5 +142,28 @@ class TestCountMethods(unittest.TestCase):
         self.assertEqual(label_to_count, label_solution)
         self.assertEqual(min_max, min_max_sol)
 
+    def test_label_matrix_dense(self):
+        """Should return an np array when enough labels are set."""
+        result = count.label_matrix(np.array([0, 1, 1]), np.array([1, 0, 1]),
+                                    (2, 2))
+        self.assertIsInstance(result, np.ndarray)
+        self.assertEqual(result.tolist(), [[0, 1], [1, 1]])
+
+    def test_label_matrix_sparse(self):
+        """Should return a sparse matrix when few labels are set."""
+        result = count.label_matrix(np.array([3, 0]), np.array([1, 40]),
+                                    (4, 50))
+        self.assertTrue(sparse.isspmatrix_csr(result))
+        self.assertEqual(result.shape, (4, 50))
+        self.assertEqual(result.nonzero()[0].tolist(), [0, 3])
+        self.assertEqual(result.nonzero()[1].tolist(), [40, 1])
+
+    def test_encode_labels(self):
+        """Should set each label of a time series once."""
+        series_labels = [["east", "a", "east"], ["west"], []]
+        label_to_index = {"east": 0, "west": 1}
+        result = count.encode_labels(series_labels, label_to_index)
+        self.assertEqual(result.tolist(), [[1, 0], [0, 1], [0, 0]])
+
 if __name__ == '__main__':
     unittest.main()
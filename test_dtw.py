@@ -0,0 +1,112 @@
+import unittest
+from unittest import mock
+import numpy as np
+import dtw
+
+def naive_dtw(x, y, window):
+    """Fills the cost matrix of x and y one cell at a time."""
+    length = len(x)
+    cost = np.full((length + 1, length + 1), np.inf)
+    cost[0, 0] = 0
+    for i in range(length):
+        for j in range(max(0, i - window), min(length, i + window + 1)):
+            cost[i + 1, j + 1] = (x[i] - y[j]) ** 2 + min(
+                cost[i, j], cost[i, j + 1], cost[i + 1, j])
+    return cost[length, length]
+
+class TestDtwMethods(unittest.TestCase):
+    """Tests the DTW distances and their lower bounds."""
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.x = rng.rand(20, 30)
+        self.y = rng.rand(20, 30)
+
+    def test_dtw_squared(self):
+        """Should match the cell by cell dynamic programming."""
+        for window in [1, 3, 29]:
+            expected = [naive_dtw(x, y, window) for x, y in zip(self.x, self.y)]
+            np.testing.assert_allclose(
+                dtw.dtw_squared(self.x, self.y, window), expected)
+
+    def test_shifted(self):
+        """A time series shifted within the window should be at distance
+        zero, but not at euclidean distance zero."""
+        series = np.array([[0, 0, 1, 5, 1, 0, 0, 0]], dtype=float)
+        shifted = np.roll(series, 1, axis=1)
+        self.assertEqual(dtw.dtw_squared(series, shifted, 1)[0], 0)
+        self.assertGreater(np.sum((series - shifted) ** 2), 0)
+
+    def test_lower_bounds(self):
+        """LB_Kim and LB_Keogh should not exceed the DTW distance."""
+        window = 3
+        distances = dtw.dtw_squared(self.x, self.y, window)
+        upper, lower = dtw.envelope(self.y, window)
+        self.assertTrue(np.all(dtw.lb_kim(self.x, self.y) <= distances))
+        self.assertTrue(np.all(dtw.lb_keogh(self.x, upper, lower) <=
+                               distances + 1e-12))
+
+    def test_distances_indexes(self):
+        """Should gather the pairs given by their indexes in small batches
+        and match the distances of the gathered rows."""
+        data = np.hstack((self.x, np.eye(20)[:, :2]))
+        rows = np.array([0, 3, 3, 19, 7, 7, 12])
+        cols = np.array([1, 3, 5, 0, 2, 19, 12])
+        expected = dtw.distances(data[rows], data[cols], 30, 3)
+        with mock.patch.object(dtw, "BATCH_VALUES", 300):
+            result = dtw.distances(data, data, 30, 3, rows, cols)
+        np.testing.assert_allclose(result, expected)
+        self.assertEqual(result[1], 0)
+
+    def test_nearest(self):
+        """Should find the same centers as comparing every pair, with
+        the labels as static features."""
+        data = np.hstack((self.x, np.eye(20)[:, :2]))
+        centers = data[:5] + 0.1
+        closest, distance, stats = dtw.nearest(data, centers, 30, 3)
+        expected = np.array([[naive_dtw(row[:30], center[:30], 3) +
+                              np.sum((row[30:] - center[30:]) ** 2)
+                              for center in centers] for row in data])
+        self.assertEqual(closest.tolist(), np.argmin(expected, axis=1).tolist())
+        np.testing.assert_allclose(distance ** 2, np.min(expected, axis=1))
+        self.assertEqual(stats["pairs"], 100)
+        self.assertLessEqual(stats["computed"], 100)
+
+    def test_medoids(self):
+        """Should pick the time series of each cluster with the smallest
+        weighted sum of DTW distances to the others."""
+        assignment = np.arange(20) % 3
+        weights = np.arange(1, 21, dtype=float)
+        expected = []
+        for cluster in range(3):
+            members = np.flatnonzero(assignment == cluster)
+            sums = [sum(weights[j] * np.sqrt(naive_dtw(self.x[i], self.x[j],
+                                                       3))
+                        for j in members) for i in members]
+            expected.append(members[np.argmin(sums)])
+        medoids = dtw.medoids(self.x, assignment, 3, 30, 3, weights)
+        self.assertEqual(medoids.tolist(), expected)
+        # A cluster with a single time series is its own medoid.
+        assignment[7] = 3
+        self.assertEqual(dtw.medoids(self.x, assignment, 4, 30, 3)[3], 7)
+
+    def test_radius_graph(self):
+        """Should keep the pairs of distinct rows within the radius."""
+        data = np.vstack((self.x, self.x[:3] + 0.01))
+        graph, stats = dtw.radius_graph(data, 1, 30, 3)
+        expected = np.array([[np.sqrt(naive_dtw(x, y, 3)) for y in data]
+                             for x in data])
+        np.fill_diagonal(expected, np.inf)
+        self.assertEqual(sorted(zip(*graph.nonzero())),
+                         sorted(zip(*np.nonzero(expected <= 1))))
+        self.assertEqual(stats["pairs"], 23 * 22 // 2)
+        self.assertEqual(stats["lb_kim"] + stats["lb_keogh"] +
+                         stats["computed"], stats["pairs"])
+        # Batches of a few rows should find the same graph.
+        with mock.patch.object(dtw, "BATCH_VALUES", 100):
+            batched, batched_stats = dtw.radius_graph(data, 1, 30, 3)
+        self.assertEqual((batched != graph).nnz, 0)
+        self.assertEqual(batched_stats, stats)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,7 @@
 import unittest
+from unittest import mock
+import charts
+import clustering
 import main
 
 class TestFlaskApp(unittest.TestCase):
@@ -9,6 +12,7 @@ class TestFlaskApp(unittest.TestCase):
         main.app.config['TESTING'] = True
         main.app.config['DEBUG'] = False
         self.app = main.app.test_client()
+        main.result_cache.clear()
 
     def test_build_index_page(self):
         """Tests the index page."""
@@ -20,5 +24,316 @@ class TestFlaskApp(unittest.TestCase):
         response = self.app.get("/data/100", follow_redirects=True)
         self.assertEqual(response.status_code, 200)
 
+    def test_cluster_cached_chart(self):
+        """Repeated requests for a chart should reuse the parsed arrays."""
+        charts.chart_cache.clear()
+        hits = charts.chart_cache.hits
+        first = self.app.get(
+            "/clustering/zone/proximity/none/off/lines/100/zone")
+        second = self.app.get(
+            "/clustering/zone/correlation/none/off/lines/100/zone")
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(charts.chart_cache.hits, hits + 1)
+
+    def test_cluster_etag(self):
+        """Tests that the clustering route is cached and revalidated with
+        its ETag."""
+        query = "/clustering/k-means/proximity/none/on/bands/002"
+        response = self.app.get(query)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Cache-Control"], "no-cache")
+        etag, weak = response.get_etag()
+        self.assertFalse(weak)
+        hits = main.result_cache.hits
+        cached = self.app.get(query)
+        self.assertEqual(cached.get_data(), response.get_data())
+        self.assertEqual(main.result_cache.hits, hits + 1)
+        not_modified = self.app.get(query, headers={"If-None-Match":
+                                                    '"' + etag + '"'})
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.get_data(), b"")
+        self.assertEqual(main.result_cache.hits, hits + 2)
+        other = self.app.get(query + "?stats=on")
+        self.assertNotEqual(other.get_etag()[0], etag)
+
+    def test_cluster_incremental_not_cached(self):
+        """Tests that the incremental mode is not cached."""
+        query = "/clustering/k-means/proximity/none/off/lines/002"
+        self.app.get(query + "?incremental=on")
+        self.app.get(query + "?incremental=on")
+        self.assertEqual(len(main.result_cache), 0)
+        self.app.get(query)
+        self.assertEqual(len(main.result_cache), 1)
+
+    def test_cluster_missing_chart(self):
+        """Tests the clustering route with a chart that does not exist."""
+        response = self.app.get("/clustering/k-means/proximity/none/off/lines/0")
+        self.assertEqual(response.status_code, 404)
+
+    def test_cluster_invalid_dtype(self):
+        """Tests the clustering route with an unsupported float type."""
+        response = self.app.get(
+            "/clustering/zone/proximity/none/off/lines/100/zone?dtype=int8")
+        self.assertEqual(response.status_code, 400)
+
+    def test_cluster_float32(self):
+        """Tests that the clustering route finds the same clusters on the
+        fixture charts with the "dtype" query parameter float32 as with
+        float64."""
+        for query in ["k-means/proximity/none/on/bands/002",
+                      "k-medians/correlation/one-hot/on/lines/002",
+                      "k-means-constrained/proximity/none/off/lines/002",
+                      "dbscan/correlation/none/on/lines/002",
+                      "agglomerative/proximity/one-hot/on/bands/100",
+                      "dbscan/proximity/none/on/lines/101",
+                      "agglomerative/correlation/none/off/lines/102",
+                      "zone/proximity/none/off/lines/102/zone"]:
+            responses = [self.app.get("/clustering/" + query + "?dtype=" +
+                                      dtype)
+                         for dtype in ["float64", "float32"]]
+            for response in responses:
+                self.assertEqual(response.status_code, 200)
+            self.assertEqual(responses[1].json["cluster_labels"],
+                             responses[0].json["cluster_labels"])
+
+    def test_cluster_resampled(self):
+        """Tests the clustering route with resampled time series."""
+        response = self.app.get("/clustering/zone/proximity/none/off/lines/"
+                                "102/zone?step=3600&aggregation=max")
+        self.assertEqual(response.status_code, 200)
+        _, _, _, dates, _ = charts.load_arrays("102", "zone", step=3600,
+                                               aggregation="max")
+        self.assertEqual(dates, {"2020-06-22T15:00:00Z": 0,
+                                 "2020-06-26T11:00:00Z": 1})
+
+    def test_cluster_invalid_step(self):
+        """Tests the clustering route with an invalid resampling step."""
+        response = self.app.get(
+            "/clustering/zone/proximity/none/off/lines/100/zone?step=-5")
+        self.assertEqual(response.status_code, 400)
+
+    def test_cluster_invalid_batch_size(self):
+        """Tests the clustering route with an invalid mini-batch size."""
+        response = self.app.get("/clustering/mini-batch-k-means/proximity/"
+                                "none/off/lines/100?batch_size=0")
+        self.assertEqual(response.status_code, 400)
+
+    def test_tuning_fast_cached(self):
+        """Tests the fast k-means tuning route, which is cached."""
+        main.tuning_cache.clear()
+        response = self.app.get(
+            "/tuning/k-means/proximity/none/101?mode=fast")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.json), {"ks", "inertia", "knee"})
+        hits = main.tuning_cache.hits
+        cached = self.app.get("/tuning/k-means/proximity/none/101?mode=fast")
+        self.assertEqual(cached.json, response.json)
+        self.assertEqual(main.tuning_cache.hits, hits + 1)
+
+    def test_tuning_eps_options(self):
+        """Tests the eps options route and its query parameters."""
+        response = self.app.get("/tuning/eps-options/proximity/none/101"
+                                "?start=0.5&end=1&min_clusters=0")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json["options"]), 6)
+        response = self.app.get(
+            "/tuning/eps-options/proximity/none/101?start=high")
+        self.assertEqual(response.status_code, 400)
+        for query in ["euclidean/none", "proximity/binary"]:
+            response = self.app.get("/tuning/eps-options/" + query + "/101")
+            self.assertEqual(response.status_code, 400)
+
+    def test_cluster_dbscan_pca(self):
+        """Tests that the dbscan clustering route returns the PCA used."""
+        response = self.app.get("/clustering/dbscan/proximity/none/off/lines/"
+                                "101")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.json["pca"]),
+                         {"components", "explained_variance", "solver"})
+        self.assertGreater(response.json["pca"]["explained_variance"], .85)
+
+    def test_cluster_dtw(self):
+        """Tests the clustering route with the DTW similarity."""
+        response = self.app.get("/clustering/dbscan/dtw/one-hot/on/bands/101")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json["cluster_labels"]), 4)
+        self.assertNotIn("pca", response.json)
+
+    def test_tuning_dtw(self):
+        """Tests that the tuning routes, which use the euclidean distance or
+        the PCA projection, reject the DTW similarity."""
+        for query in ["dbscan/dtw/none/101", "eps-options/dtw/none/101",
+                      "k-means/dtw/none/002?mode=fast"]:
+            response = self.app.get("/tuning/" + query)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json["error"]["message"],
+                             "Invalid similarity")
+
+    def test_dtw_unsupported(self):
+        """Tests that the algorithms which only use the euclidean distance
+        and the frequency route reject the DTW similarity."""
+        for query in ["clustering/k-means/dtw/none/off/lines/002",
+                      "clustering/mini-batch-k-means/dtw/none/off/lines/002",
+                      "clustering/agglomerative/dtw/none/off/lines/101",
+                      "clustering/zone/dtw/none/off/lines/101/zone",
+                      "frequency/k-means/dtw/none/002"]:
+            response = self.app.get("/" + query)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json["error"]["message"],
+                             "Invalid similarity")
+
+    def test_cluster_dtw_centroids(self):
+        """Tests k-medians and k-means-constrained with the DTW similarity on
+        the main chart, where the medians and means of the clusters used to
+        lose clusters. The dates are reduced to keep the test fast."""
+        for query in ["k-medians/dtw/none", "k-means-constrained/dtw/one-hot"]:
+            response = self.app.get("/clustering/" + query +
+                                    "/on/lines/002?paa=80")
+            self.assertEqual(response.status_code, 200)
+            labels = response.json["cluster_labels"]
+            self.assertEqual(len(labels), 300)
+            self.assertEqual(len(set(map(abs, labels))),
+                             300 // clustering.KMEANS_RATIO +
+                             clustering.KMEANS_MIN)
+
+    def test_cluster_outlier_scores(self):
+        """Tests that the clustering route returns the outlier scores."""
+        for outlier in ["on", "adaptive"]:
+            response = self.app.get("/clustering/k-means/proximity/none/" +
+                                    outlier + "/lines/002")
+            self.assertEqual(response.status_code, 200)
+            labels = response.json["cluster_labels"]
+            scores = response.json["outlier_scores"]
+            self.assertEqual(len(scores), len(labels))
+            for label, score in zip(labels, scores):
+                self.assertEqual(label < 0, score > 1)
+        response = self.app.get("/clustering/k-means/proximity/none/off/"
+                                "lines/002")
+        self.assertEqual(response.json["outlier_scores"], [])
+        response = self.app.get("/clustering/k-means/proximity/none/maybe/"
+                                "lines/002")
+        self.assertEqual(response.status_code, 400)
+
+    def test_cluster_band_stats(self):
+        """Tests that the bands have their statistics with the "stats" query
+        parameter."""
+        query = "/clustering/k-means/proximity/none/on/bands/002"
+        response = self.app.get(query)
+        self.assertNotIn("band_stats", response.json)
+        with_stats = self.app.get(query + "?stats=on")
+        self.assertEqual(with_stats.status_code, 200)
+        self.assertEqual(with_stats.json["min_max"], response.json["min_max"])
+        for values in with_stats.json["band_stats"].values():
+            self.assertEqual(len(values), len(response.json["min_max"]))
+        response = self.app.get(query + "?stats=all")
+        self.assertEqual(response.status_code, 400)
+
+    def test_frequency(self):
+        """Tests the frequency route, whose clusters are 1-based."""
+        response = self.app.get("/frequency/k-means/proximity/none/002")
+        self.assertEqual(response.status_code, 200)
+        labels = response.json["labels"]
+        self.assertEqual(labels, sorted(labels))
+        self.assertEqual(len(response.json["ts_labels"]), 300)
+        for frequencies in response.json["cluster_labels"]:
+            self.assertEqual(len(frequencies), len(labels))
+            self.assertTrue(all(0 <= value <= 1 for value in frequencies))
+
+    def test_cluster_agglomerative(self):
+        """Tests that the agglomerative clustering route cuts the cached
+        linkage tree."""
+        main.linkage_cache.clear()
+        response = self.app.get("/clustering/agglomerative/proximity/none/"
+                                "on/bands/101?clusters=2")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(set(map(abs, response.json["cluster_labels"]))),
+                         2)
+        hits = main.linkage_cache.hits
+        # The last three time series are equal.
+        response = self.app.get("/clustering/agglomerative/proximity/none/"
+                                "off/lines/101?threshold=0")
+        self.assertEqual(len(set(response.json["cluster_labels"])), 2)
+        self.assertEqual(main.linkage_cache.hits, hits + 1)
+        for query in ["linkage=single", "clusters=0", "threshold=far"]:
+            response = self.app.get("/clustering/agglomerative/proximity/"
+                                    "none/off/lines/101?" + query)
+            self.assertEqual(response.status_code, 400)
+
+    def test_cluster_agglomerative_recut(self):
+        """Tests that a cut of the cached linkage tree does not preprocess
+        the time series without outliers, and that charts with too many
+        time series are rejected."""
+        main.linkage_cache.clear()
+        query = "/clustering/agglomerative/proximity/none/off/lines/002"
+        self.app.get(query + "?clusters=3")
+        with mock.patch.object(clustering, "preprocess",
+                               wraps=clustering.preprocess) as preprocess:
+            response = self.app.get(query + "?clusters=5")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(preprocess.call_count, 0)
+            response = self.app.get(query.replace("/off/", "/on/") +
+                                    "?clusters=5")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(preprocess.call_count, 1)
+        with mock.patch.object(clustering, "AGGLOMERATIVE_MAX_SERIES", 299):
+            response = self.app.get(query + "?clusters=7")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json["error"]["message"],
+                         "Too many time series")
+
+    def test_cluster_incremental(self):
+        """Tests that the incremental mode restarts from the last clusters
+        of the chart."""
+        main.warm_start_cache.clear()
+        query = "/clustering/k-means/proximity/none/off/lines/002"
+        cold = self.app.get(query)
+        hits = main.warm_start_cache.hits
+        warm = self.app.get(query + "?incremental=on")
+        self.assertEqual(warm.status_code, 200)
+        self.assertEqual(main.warm_start_cache.hits, hits + 1)
+        self.assertEqual(len(set(warm.json["cluster_labels"])),
+                         len(set(cold.json["cluster_labels"])))
+        response = self.app.get(query + "?incremental=yes")
+        self.assertEqual(response.status_code, 400)
+
+    def test_cluster_reduced(self):
+        """Tests the clustering route with PAA and SAX, which keeps the
+        bands at full resolution."""
+        response = self.app.get("/clustering/k-means/correlation/one-hot/"
+                                "off/bands/002?paa=24&sax=5")
+        self.assertEqual(response.status_code, 200)
+        _, _, _, dates, _ = charts.load_arrays("002", None)
+        self.assertEqual(len(response.json["dates"]), len(dates))
+        response = self.app.get("/clustering/dbscan/proximity/none/off/"
+                                "lines/101?paa=1")
+        self.assertEqual(response.status_code, 200)
+        for query in ["paa=0", "sax=1", "sax=many"]:
+            response = self.app.get("/clustering/dbscan/proximity/none/off/"
+                                    "lines/101?" + query)
+            self.assertEqual(response.status_code, 400)
+
+    def test_cluster_reduced_stable(self):
+        """Tests that dbscan gives the same clusters and outliers with the
+        dates reduced by PAA as at full resolution."""
+        for similarity in ["proximity", "correlation"]:
+            query = ("/clustering/dbscan/%s/none/on/lines/002?impute=linear"
+                     % similarity)
+            full = self.app.get(query)
+            reduced = self.app.get(query + "&paa=60")
+            self.assertEqual(reduced.status_code, 200)
+            self.assertEqual(reduced.json["cluster_labels"],
+                             full.json["cluster_labels"])
+
+    def test_cluster_imputed(self):
+        """Tests the clustering route with the missing values imputed."""
+        for strategy in ["median", "ffill", "linear"]:
+            response = self.app.get("/clustering/dbscan/proximity/none/off/"
+                                    "bands/101?impute=" + strategy)
+            self.assertEqual(response.status_code, 200)
+        response = self.app.get(
+            "/clustering/zone/proximity/none/off/lines/100/zone?impute=mean")
+        self.assertEqual(response.status_code, 400)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+import numpy as np
+from scipy import sparse
+import neighbors
+
+class TestNeighborsMethods(unittest.TestCase):
+    """Tests the neighbor index."""
+
+    def setUp(self):
+        self.data = np.array([[0, 0], [0, 1], [0, 1], [0, 3], [5, 5]],
+                             dtype=float)
+
+    def test_algorithm(self):
+        """Should pick the search algorithm by the kind of data."""
+        self.assertEqual(neighbors.NeighborIndex(self.data).algorithm,
+                         "kd_tree")
+        wide = np.random.RandomState(0).rand(10, 30)
+        self.assertEqual(neighbors.NeighborIndex(wide).algorithm, "ball_tree")
+        self.assertEqual(neighbors.NeighborIndex(
+            sparse.csr_matrix(self.data)).algorithm, "brute")
+
+    def test_radius_graph(self):
+        """Should keep the pairs of distinct rows within the radius,
+        filtering the graph of a larger radius."""
+        index = neighbors.NeighborIndex(self.data)
+        large = index.radius_graph(2)
+        self.assertEqual(large.nnz, 10)
+        small = index.radius_graph(1)
+        self.assertEqual(sorted(zip(*small.nonzero())),
+                         [(0, 1), (0, 2), (1, 0), (2, 0)])
+        # The duplicate rows are neighbors at distance 0.
+        self.assertEqual(small.nnz, 6)
+        self.assertIs(index.radius_graph(2), large)
+        self.assertEqual((index.radius_graph(1) != small).nnz, 0)
+
+    def test_radius_graph_memory(self):
+        """Should only keep the graph of the largest radius, so that the
+        cached index is measured again only when that graph grows."""
+        cache = neighbors.index_cache
+        cache.clear()
+        index, _ = neighbors.cached_index(("test", 2), "v1",
+                                          lambda: (self.data, None))
+        size = cache.current_bytes
+        index.radius_graph(1)
+        self.assertGreater(cache.current_bytes, size)
+        size = cache.current_bytes
+        self.assertEqual(size, index.nbytes())
+        for radius in [.5, .75, .9]:
+            index.radius_graph(radius)
+        self.assertEqual(index.nbytes(), size)
+        index.radius_graph(2)
+        self.assertGreater(cache.current_bytes, size)
+        self.assertEqual(cache.current_bytes, index.nbytes())
+
+    def test_kneighbors(self):
+        """Should return the closest other rows."""
+        index = neighbors.NeighborIndex(self.data)
+        distances, indices = index.kneighbors(1)
+        self.assertEqual(distances[:, 0].tolist(), [1, 0, 0, 2, np.sqrt(29)])
+        self.assertIn(indices[3, 0], (1, 2))
+
+    def test_cached_index(self):
+        """Should build the index once per key and signature."""
+        loads = []
+
+        def load():
+            loads.append(1)
+            return self.data, None
+        first, _ = neighbors.cached_index(("test", 1), "v1", load)
+        second, _ = neighbors.cached_index(("test", 1), "v1", load)
+        self.assertIs(first, second)
+        third, _ = neighbors.cached_index(("test", 1), "v2", load)
+        self.assertIsNot(first, third)
+        self.assertEqual(len(loads), 2)
+
+if __name__ == '__main__':
+    unittest.main()
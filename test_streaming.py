@@ -0,0 +1,47 @@
+import unittest
+import io
+import json
+import clustering
+import streaming
+
+class TestStreamingMethods(unittest.TestCase):
+    """Tests the incremental chart reader."""
+
+    def test_iter_time_series(self):
+        """Should yield each time series and skip other values, also when
+        values are split between chunks."""
+        text = ('{"unit": "By", "timeSeries": [{"points": [1.5, 20]}, '
+                '{"points": []}], "nextPageToken": {"a": [1, 2]}, "n": 12345}')
+        for chunk_size in [1, 3, 7, 1000]:
+            result = list(streaming.iter_time_series(io.StringIO(text),
+                                                     chunk_size))
+            self.assertEqual(result, [{"points": [1.5, 20]}, {"points": []}])
+
+    def test_iter_time_series_empty(self):
+        """Should not yield anything for an empty chart."""
+        for text in ['{}', '{"timeSeries": []}']:
+            result = list(streaming.iter_time_series(io.StringIO(text), 2))
+            self.assertEqual(result, [])
+
+    def test_iter_time_series_invalid(self):
+        """Should raise a ValueError for a truncated file."""
+        with self.assertRaises(ValueError):
+            list(streaming.iter_time_series(
+                io.StringIO('{"timeSeries": [{"points": [1'), 4))
+
+    def test_time_series_array(self):
+        """Should produce the same arrays as clustering.time_series_array."""
+        with open('./data/chart-102.json', "r") as json_file:
+            data = json.load(json_file)
+        for key in [None, "zone"]:
+            solution = clustering.time_series_array(data, key)
+            result = streaming.time_series_array('./data/chart-102.json',
+                                                 key, chunk_size=64)
+            self.assertEqual(result[0].tolist(), solution[0].tolist())
+            self.assertEqual(result[1], solution[1])
+            self.assertEqual(result[2].tolist(), solution[2].tolist())
+            self.assertEqual(result[3], solution[3])
+            self.assertEqual(result[4], solution[4])
+
+if __name__ == '__main__':
+    unittest.main()